@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import contextlib
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Benchmarks for the API hot paths and the model.
+#
+#   python benchmark.py api   [--mongod] [--url URL] [--concurrency 1 8 32] [--requests 300]
+#   python benchmark.py model [--sizes 1 10 100 1000 10000]
+#
+# Both print a JSON report (and write it with --out). Pass --compare with an
+# earlier report to flag regressions: api compares p95 latency, model the
+# median time per call. Exits 1 when something got slower than --tolerance.
+#
+# "api" seeds a stand-in database from final-data/ through the ETL loader
+# and drives the app in-process over ASGI, so numbers don't include network
+# noise. --mongod starts a throwaway mongod (must be on PATH) in a temp dir;
+# otherwise BENCH_DB_URI/BENCH_DB_NAME are used, and that database is
+# dropped and reseeded. --url benchmarks an already running server instead
+# and skips seeding. In-process runs answer /llm/analysis from fake_llm.py
+# on a local port instead of the real LLM.
+
+DATA_DIR = os.getenv("FINAL_DATA_DIR", "../final-data")
+BENCH_DB_URI = os.getenv("BENCH_DB_URI", "mongodb://localhost:27017")
+BENCH_DB_NAME = os.getenv("BENCH_DB_NAME", "yield_bench")
+
+ENDPOINTS = ["predict", "predict_year", "predict_my_field", "maps_districts", "maps_variability", "dashboard_summary", "llm_analysis"]
+PREDICT_FIELDS = [
+    "adm_id", "crop_name", "awc", "bulk_density", "drainage_class", "ssm", "rsm", "ndvi",
+    "tmin", "tmax", "prec", "rad", "tavg", "et0", "vpd", "cwb", "fpar",
+    "harvest_area", "harvest_year", "crop_area_percentage",
+]
+# Settings that change what the numbers mean; recorded in every report.
+RECORDED_ENV = [
+    "PREDICT_WORKERS", "PREDICT_BATCHING", "PREDICT_MAX_BATCH_SIZE", "PREDICT_MAX_WAIT_MS",
+    "PREDICT_CACHE", "PREDICT_CACHE_SIZE", "METRICS", "DB_MAX_POOL_SIZE",
+    "LLM_MAX_CONCURRENCY", "FAKE_LLM_FIRST_TOKEN_MS", "FAKE_LLM_TOKEN_MS",
+]
+
+
+def environment():
+    def git(*args):
+        try:
+            return subprocess.check_output(["git", *args], stderr=subprocess.DEVNULL, text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "describe": git("describe", "--always", "--dirty"),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "env": {k: os.environ[k] for k in RECORDED_ENV if k in os.environ},
+    }
+
+
+def percentiles(samples):
+    import numpy as np
+
+    a = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        "p50_ms": float(np.percentile(a, 50)),
+        "p95_ms": float(np.percentile(a, 95)),
+        "p99_ms": float(np.percentile(a, 99)),
+        "mean_ms": float(a.mean()),
+        "max_ms": float(a.max()),
+    }
+
+
+def merged_rows(limit=None, seed=0):
+    """
+    Historical rows from the merged yearly tables, shuffled deterministically.
+    """
+    import pandas as pd
+
+    paths = sorted(glob.glob(os.path.join(DATA_DIR, "*", "*_merged*_yearly.csv")))
+    frame = pd.concat([pd.read_csv(p, sep="\t") for p in paths], ignore_index=True)
+    frame = frame.dropna(subset=PREDICT_FIELDS + ["latitude", "longitude"])
+    frame = frame[frame["harvest_area"] >= 1]
+    frame = frame.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+    if limit:
+        frame = frame.head(limit)
+    frame["crop_name"] = frame["crop_name"].str.capitalize()
+    frame["harvest_area"] = frame["harvest_area"].round().astype(int)
+    frame["harvest_year"] = frame["harvest_year"].astype(int)
+    frame["drainage_class"] = frame["drainage_class"].round().astype(int)
+    return frame
+
+
+# ---------------------------------------------------------------- database
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mongod():
+    """
+    Starts a throwaway mongod; returns (uri, stop function).
+    """
+    binary = shutil.which("mongod")
+    if binary is None:
+        sys.exit("mongod not found on PATH; install it or point BENCH_DB_URI at a local server")
+    dbpath = tempfile.mkdtemp(prefix="bench-mongod-")
+    port = free_port()
+    proc = subprocess.Popen(
+        [binary, "--dbpath", dbpath, "--port", str(port), "--bind_ip", "127.0.0.1", "--quiet"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            break
+        except OSError:
+            time.sleep(0.2)
+    else:
+        proc.kill()
+        sys.exit("mongod did not start")
+
+    def stop():
+        proc.terminate()
+        proc.wait(timeout=30)
+        shutil.rmtree(dbpath, ignore_errors=True)
+
+    return f"mongodb://127.0.0.1:{port}", stop
+
+
+def start_fake_llm():
+    """
+    Serves fake_llm.py on a free port in a background thread; returns
+    (base_url, stop function).
+    """
+    import threading
+    import uvicorn
+    import fake_llm
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_llm.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    return f"http://127.0.0.1:{port}", stop
+
+
+async def seed(db):
+    """
+    Loads yield, districts and crop_mask for every crop the same way the
+    ETL does, without rewriting the merged CSVs.
+    """
+    import pandas as pd
+    import etl
+    from core.constant import CROP_CONFIG
+
+    for name in await db.list_collection_names():
+        await db.drop_collection(name)
+    await etl.ensure_indexes(db)
+
+    for crop in CROP_CONFIG:
+        files = etl.crop_inputs(crop, DATA_DIR)
+        read = lambda source: pd.read_csv(files[source], sep="\t")
+        yields = read("yield")[etl.YIELD_COLUMNS].dropna(subset=["yield", "production", "harvest_area"])
+        yields["harvest_year"] = yields["harvest_year"].astype(int)
+        districts = read("districts").drop_duplicates("adm_id")[["adm_id"] + etl.DISTRICT_COLUMNS]
+        districts = districts.dropna(subset=["latitude", "longitude"])
+        districts.insert(0, "crop_name", crop)
+        print(f"Seeding {crop}")
+        result = {"crop": crop, "yield": yields, "districts": districts, "crop_mask": read("crop_mask")}
+        await etl.load_crop(db, result, "bench")
+
+
+# -------------------------------------------------------------------- api
+
+def api_requests(n, seed=0):
+    """
+    n deterministic requests per endpoint as (method, path, params, json).
+    """
+    rows = merged_rows(limit=max(n, 1), seed=seed)
+    rng = random.Random(seed)
+    records = rows.to_dict("records")
+    out = {name: [] for name in ENDPOINTS}
+    for i in range(n):
+        r = records[i % len(records)]
+        body = {k: r[k] for k in PREDICT_FIELDS}
+        out["predict"].append(("POST", "/predict/", None, body))
+        out["predict_year"].append(("POST", "/predict/year", {
+            "lat": r["latitude"], "lon": r["longitude"], "harvest_area": r["harvest_area"],
+            "adm_id": r["adm_id"], "crop_name": r["crop_name"].lower(), "harvest_year": r["harvest_year"],
+        }, None))
+        # Points scattered around a district centroid, like farmers in one area.
+        out["predict_my_field"].append(("POST", "/predict/my-field", {
+            "lat": r["latitude"] + rng.uniform(-0.05, 0.05), "lon": r["longitude"] + rng.uniform(-0.05, 0.05),
+            "harvest_area": r["harvest_area"], "crop_name": r["crop_name"].lower(),
+        }, None))
+        out["maps_districts"].append(("GET", "/maps/districts", None, None))
+        out["maps_variability"].append(("GET", "/maps/variability", None, None))
+        out["dashboard_summary"].append(("GET", "/dashboard/summary", None, None))
+        out["llm_analysis"].append(("GET", "/llm/analysis", {
+            "lat": r["latitude"], "lon": r["longitude"], "crop_name": r["crop_name"].lower(),
+            "predicted_yield": round(r["yield"], 2),
+        }, None))
+    return out
+
+
+async def drive(client, requests, concurrency, warmup):
+    """
+    Sends requests with a fixed number of concurrent workers.
+    Returns throughput, latency percentiles and the error count.
+    """
+    for method, path, params, body in requests[:warmup]:
+        await client.request(method, path, params=params, json=body)
+
+    latencies = []
+    errors = 0
+    queue = iter(requests)
+
+    async def worker():
+        nonlocal errors
+        for method, path, params, body in queue:
+            start = time.perf_counter()
+            r = await client.request(method, path, params=params, json=body)
+            latencies.append(time.perf_counter() - start)
+            if r.status_code >= 400 or (r.headers.get("content-type", "").startswith("application/json") and '"error"' in r.text[:200]):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        **percentiles(latencies),
+    }
+
+
+async def run_api(args):
+    import httpx
+
+    stop_mongod = None
+    stop_llm = None
+    if args.url:
+        transport = None
+        base_url = args.url
+        lifespan = contextlib.nullcontext()
+    else:
+        uri = BENCH_DB_URI
+        if args.mongod:
+            uri, stop_mongod = start_mongod()
+        # database.py reads these at import time.
+        os.environ["DB_URI"] = uri
+        os.environ["DB_NAME"] = BENCH_DB_NAME
+        if "llm_analysis" in args.endpoints:
+            # routes/llm.py reads these at import time.
+            os.environ["LLM_BASE_URL"], stop_llm = start_fake_llm()
+            os.environ["CEREBRAS_API_KEY"] = "fake"
+        import database
+        await seed(database.connect())
+        database.close()
+
+        import main
+        lifespan = main.lifespan(main.app)
+        transport = httpx.ASGITransport(app=main.app)
+        base_url = "http://bench"
+
+    requests = api_requests(args.requests)
+    results = {}
+    try:
+        async with lifespan:
+            async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=60) as client:
+                for name in args.endpoints:
+                    results[name] = {}
+                    for c in args.concurrency:
+                        stats = await drive(client, requests[name], c, args.warmup)
+                        results[name][str(c)] = stats
+                        print(f"{name:20s} c={c:<4d} {stats['throughput_rps']:9.1f} rps  p50 {stats['p50_ms']:8.2f}  p95 {stats['p95_ms']:8.2f}  p99 {stats['p99_ms']:8.2f} ms  errors {stats['errors']}", file=sys.stderr)
+    finally:
+        if stop_mongod:
+            stop_mongod()
+        if stop_llm:
+            stop_llm()
+    return {"kind": "api", **environment(), "config": {"requests": args.requests, "concurrency": args.concurrency, "url": args.url}, "results": results}
+
+
+# ------------------------------------------------------------------ model
+
+def time_call(fn, repeat, number):
+    """
+    Median and best seconds per call over repeat rounds of number calls.
+    """
+    fn()
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+    rounds.sort()
+    return {"median_ms": rounds[len(rounds) // 2] * 1000, "best_ms": rounds[0] * 1000}
+
+
+def run_model(args):
+    import joblib
+    import pandas as pd
+    from core.predict import TargetEncoder
+    from core.inference import compile_predictor
+
+    sys.modules['__main__'].TargetEncoder = TargetEncoder # type: ignore
+    benches = {}
+
+    try:
+        pipeline = joblib.load('model/final_production_pipeline.pkl')
+        encoder = joblib.load('model/target_encoder.pkl')
+    except Exception as e:
+        print(f"Skipping production pipeline: {e}", file=sys.stderr)
+        pipeline = encoder = None
+
+    if pipeline is not None:
+        rows = merged_rows(limit=max(args.sizes))[PREDICT_FIELDS]
+        rows = pd.concat([rows] * (max(args.sizes) // len(rows) + 1), ignore_index=True)
+        predictor = compile_predictor(pipeline, encoder, rows.iloc[0].to_dict())
+        for size in args.sizes:
+            frame = rows.head(size)
+            encoded = encoder.transform(frame)
+            records = frame.to_dict("records")
+            number = max(1, 1000 // size)
+            benches.setdefault("target_encoder.transform", {})[str(size)] = time_call(lambda: encoder.transform(frame), args.repeat, number)
+            benches.setdefault("pipeline.predict", {})[str(size)] = time_call(lambda: pipeline.predict(encoded), args.repeat, number)
+            if predictor:
+                X = predictor.vectorize(records)
+                benches.setdefault("compiled.predict_many", {})[str(size)] = time_call(lambda: predictor.predict_many(records), args.repeat, number)
+                # Explanation cost against plain prediction on the same matrix.
+                benches.setdefault("compiled.predict_matrix", {})[str(size)] = time_call(lambda: predictor.predict_matrix(X), args.repeat, number)
+                benches.setdefault("compiled.explain_matrix", {})[str(size)] = time_call(lambda: predictor.explain_matrix(X), args.repeat, number)
+
+    # The Gujarat booster, fed from its own training data.
+    from core.guj_predictor import GujaratPredictor
+
+    guj = GujaratPredictor("model/xgb_crop_yield_model.json", "model/dataset.csv")
+    fields = pd.read_csv("model/dataset.csv", sep="\t", index_col=0).to_dict("records")
+    fields = (fields * (max(args.sizes) // len(fields) + 1))[:max(args.sizes)]
+    for size in args.sizes:
+        batch = fields[:size]
+        X = guj.vectorize(batch)
+        number = max(1, 1000 // size)
+        benches.setdefault("guj.vectorize", {})[str(size)] = time_call(lambda: guj.vectorize(batch), args.repeat, number)
+        benches.setdefault("guj_booster.inplace_predict", {})[str(size)] = time_call(lambda: guj.booster.inplace_predict(X), args.repeat, number)
+
+    for name, sizes in benches.items():
+        for size, stats in sizes.items():
+            stats["per_row_us"] = stats["median_ms"] * 1000 / int(size)
+            print(f"{name:30s} n={size:>6s}  median {stats['median_ms']:9.3f} ms  {stats['per_row_us']:9.2f} us/row", file=sys.stderr)
+    return {"kind": "model", **environment(), "config": {"sizes": args.sizes, "repeat": args.repeat}, "results": benches}
+
+
+# ---------------------------------------------------------------- compare
+
+def compare(report, baseline, tolerance):
+    """
+    Lists results that got slower than baseline by more than tolerance.
+    """
+    metric = "p95_ms" if report["kind"] == "api" else "median_ms"
+    regressions = []
+    for name, points in report["results"].items():
+        for key, stats in points.items():
+            old = baseline.get("results", {}).get(name, {}).get(key)
+            if not old or not old.get(metric):
+                continue
+            change = stats[metric] / old[metric] - 1
+            line = f"{name} [{key}] {metric} {old[metric]:.3f} -> {stats[metric]:.3f} ({change:+.1%})"
+            print(line, file=sys.stderr)
+            if change > tolerance:
+                regressions.append(line)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the API hot paths and the model.")
+    sub = parser.add_subparsers(dest="kind", required=True)
+
+    api = sub.add_parser("api", help="Drive the HTTP endpoints at fixed concurrency")
+    api.add_argument("--url", help="Benchmark a running server instead of the in-process app")
+    api.add_argument("--mongod", action="store_true", help="Start a throwaway mongod for the stand-in database")
+    api.add_argument("--endpoints", nargs="*", default=ENDPOINTS, choices=ENDPOINTS)
+    api.add_argument("--concurrency", nargs="*", type=int, default=[1, 8, 32])
+    api.add_argument("--requests", type=int, default=300, help="Requests per endpoint and concurrency level")
+    api.add_argument("--warmup", type=int, default=20)
+
+    model = sub.add_parser("model", help="Micro-benchmark encoding and inference")
+    model.add_argument("--sizes", nargs="*", type=int, default=[1, 10, 100, 1000, 10000])
+    model.add_argument("--repeat", type=int, default=7)
+
+    for p in (api, model):
+        p.add_argument("--out", help="Write the JSON report here")
+        p.add_argument("--compare", help="Earlier JSON report to compare against")
+        p.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown before failing (default 0.15)")
+
+    args = parser.parse_args()
+    # Keep stdout for the report; seeding and the app log with print().
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run_api(args)) if args.kind == "api" else run_model(args)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.tolerance:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,416 @@
+import asyncio
+import os
+import re
+import time
+from core.yield_stats import YieldStats
+
+# Materialized yield aggregates.
+#
+# yield_aggregates holds one document per (crop, year, adm_id) with the
+# count, sum and M2 (sum of squared deviations from the mean) of yield,
+# which core/yield_stats.py merges into per-district variability. Every write bumps a version number in
+# materialized_meta; YieldAggregateCache keeps an in-process copy and only
+# reloads when that version moves, so routes read the aggregates in O(1).
+#
+# Refreshes come from the ETL (rebuild_aggregates as a post-load hook) and,
+# on a replica set, from a change stream on yield (watch_yield_changes).
+# The watcher collects events for AGG_DEBOUNCE_SECONDS and refreshes each
+# touched cell once. Writes made by an ETL load are left to that load's own
+# rebuild: etl.py records each load in materialized_meta (begin_etl_load /
+# cover_etl_load) with server timestamps the change events can be compared to.
+# A failed window is kept and retried, and a dropped stream is reopened from
+# its resume token, both with backoff up to AGG_WATCH_MAX_RETRY_SECONDS.
+
+AGG_COLLECTION = "yield_aggregates"
+META_COLLECTION = "materialized_meta"
+CHECK_SECONDS = float(os.getenv("AGG_CHECK_SECONDS", 5))
+DEBOUNCE_SECONDS = float(os.getenv("AGG_DEBOUNCE_SECONDS", 1.0))
+ETL_LOAD_PREFIX = "etl_load|"
+RETRY_SECONDS = float(os.getenv("AGG_WATCH_RETRY_SECONDS", 1))
+MAX_RETRY_SECONDS = float(os.getenv("AGG_WATCH_MAX_RETRY_SECONDS", 60))
+# Change streams need a replica set; standalone servers fail with this code.
+CHANGE_STREAM_UNSUPPORTED = 40573
+# The resume token is no longer in the oplog, or can't be used.
+RESUME_FAILED = {260, 280, 286}
+
+
+def _group_pipeline(match=None):
+    return [
+        {"$match": {
+            "crop_name": {"$exists": True},
+            "adm_id": {"$exists": True},
+            "harvest_year": {"$type": "number"},
+            "yield": {"$type": "number"},
+            **(match or {}),
+        }},
+        {"$group": {
+            "_id": {"crop": {"$toLower": "$crop_name"}, "year": "$harvest_year", "adm_id": "$adm_id"},
+            "count": {"$sum": 1},
+            "sum": {"$sum": "$yield"},
+            "std": {"$stdDevPop": "$yield"},
+        }},
+    ]
+
+
+def _crop_regex(crop):
+    return {"$regex": f"^{re.escape(crop)}$", "$options": "i"}
+
+
+def _cell(group):
+    key = group["_id"]
+    count = group["count"]
+    total = float(str(group["sum"]))
+    std = float(str(group.get("std") or 0.0))
+    return {
+        "_id": f"{key['crop']}|{key['year']}|{key['adm_id']}",
+        "crop": key["crop"],
+        "year": int(key["year"]),
+        "adm_id": key["adm_id"],
+        "count": count,
+        "sum": total,
+        "avg": total / count if count else 0.0,
+        "m2": std * std * count,
+    }
+
+
+async def bump_version(db, name=AGG_COLLECTION):
+    doc = await db[META_COLLECTION].find_one_and_update(
+        {"_id": name},
+        {"$inc": {"version": 1}, "$set": {"updated_at": time.time()}},
+        upsert=True,
+        return_document=True,
+    )
+    return doc["version"]
+
+
+async def get_version(db, name=AGG_COLLECTION):
+    doc = await db[META_COLLECTION].find_one({"_id": name}, {"version": 1})
+    return doc["version"] if doc else 0
+
+
+async def rebuild_aggregates(db, crop=None):
+    """
+    Recomputes every cell (or every cell of one crop) from the yield collection.
+    """
+    from pymongo import ReplaceOne
+
+    match = {"crop_name": _crop_regex(crop)} if crop else None
+    groups = await db["yield"].aggregate(_group_pipeline(match), allowDiskUse=True).to_list(None)
+    cells = [_cell(g) for g in groups]
+    for start in range(0, len(cells), 1000):
+        ops = [ReplaceOne({"_id": c["_id"]}, c, upsert=True) for c in cells[start:start + 1000]]
+        await db[AGG_COLLECTION].bulk_write(ops, ordered=False)
+
+    stale = {"_id": {"$nin": [c["_id"] for c in cells]}}
+    if crop:
+        stale["crop"] = crop.lower()
+    await db[AGG_COLLECTION].delete_many(stale)
+    await bump_version(db)
+    return len(cells)
+
+
+async def refresh_cell(db, crop, year, adm_id, bump=True):
+    """
+    Recomputes a single (crop, year, adm_id) cell after a yield write.
+    With bump=False the caller bumps the version once for many cells.
+    """
+    match = {
+        "crop_name": _crop_regex(crop),
+        "harvest_year": year,
+        "adm_id": adm_id,
+    }
+    groups = await db["yield"].aggregate(_group_pipeline(match)).to_list(None)
+    cell_id = f"{crop.lower()}|{year}|{adm_id}"
+    if groups:
+        cell = _cell(groups[0])
+        await db[AGG_COLLECTION].replace_one({"_id": cell_id}, cell, upsert=True)
+    else:
+        await db[AGG_COLLECTION].delete_one({"_id": cell_id})
+    if bump:
+        await bump_version(db)
+
+
+async def begin_etl_load(db, crop, version):
+    """
+    Records that the ETL started (re)loading crop's yield rows as version.
+    """
+    await db[META_COLLECTION].update_one(
+        {"_id": ETL_LOAD_PREFIX + crop},
+        {
+            "$set": {"crop": crop, "etl_version": version},
+            "$unset": {"covered_until": ""},
+            "$currentDate": {"started_at": {"$type": "timestamp"}},
+        },
+        upsert=True,
+    )
+
+
+async def cover_etl_load(db, crop):
+    """
+    Marks the end of a load's yield writes, right before the post-load
+    hooks rebuild the crop; the watcher skips the load's events up to here.
+    """
+    await db[META_COLLECTION].update_one(
+        {"_id": ETL_LOAD_PREFIX + crop},
+        {"$currentDate": {"covered_until": {"$type": "timestamp"}}},
+    )
+
+
+async def abort_etl_load(db, crop):
+    """
+    Forgets a load that failed before its rebuild, so the watcher handles
+    its writes itself.
+    """
+    await db[META_COLLECTION].delete_one({"_id": ETL_LOAD_PREFIX + crop})
+
+
+async def etl_hook(db, crop, result):
+    """
+    etl.POST_LOAD_HOOKS entry: refresh the crop's aggregates after a load.
+    """
+    n = await rebuild_aggregates(db, crop)
+    print(f"  {AGG_COLLECTION}: {n} cells")
+
+
+class YieldAggregateCache:
+    """
+    In-process copy of yield_aggregates with the rollups the routes need.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+        self.cells = []
+        self.by_crop_year = {}
+        self.by_adm = {}
+        self.by_crop = {}
+        self.by_year = {}
+        self.average_yield = 0.0
+        self.stats = YieldStats([])
+
+    async def get(self, db):
+        """
+        Returns self after making sure it's no older than CHECK_SECONDS.
+        """
+        now = time.monotonic()
+        if self.version is not None and now - self.checked_at < CHECK_SECONDS:
+            return self
+        async with self.lock:
+            if self.version is not None and now - self.checked_at < CHECK_SECONDS:
+                return self
+            version = await get_version(db)
+            if version == 0:
+                # Nothing materialized yet, build it from the yield collection.
+                await rebuild_aggregates(db)
+                version = await get_version(db)
+            if version != self.version:
+                await self._load(db)
+                if any("m2" not in c for c in self.cells):
+                    # Cells materialized before M2 was added.
+                    await rebuild_aggregates(db)
+                    version = await get_version(db)
+                    await self._load(db)
+                self.version = version
+            self.checked_at = now
+        return self
+
+    def invalidate(self):
+        self.checked_at = 0.0
+
+    async def _load(self, db):
+        projection = {"_id": 0, "crop": 1, "year": 1, "adm_id": 1, "count": 1, "sum": 1, "m2": 1}
+        cells = await db[AGG_COLLECTION].find({}, projection).to_list(None)
+        by_crop_year, by_adm, by_crop, by_year = {}, {}, {}, {}
+        for c in cells:
+            for table, key in (
+                (by_crop_year, (c["crop"], c["year"])),
+                (by_adm, c["adm_id"]),
+                (by_crop, c["crop"]),
+                (by_year, c["year"]),
+            ):
+                count, total = table.get(key, (0, 0.0))
+                table[key] = (count + c["count"], total + c["sum"])
+
+        self.cells = cells
+        self.by_crop_year = by_crop_year
+        self.by_adm = by_adm
+        self.by_crop = by_crop
+        self.by_year = by_year
+        # Same number the old per-request pipeline produced: it grouped on a
+        # field that doesn't exist, so it summed the mean yield of each year.
+        self.average_yield = sum(total / count for count, total in by_year.values() if count)
+        self.stats = YieldStats(cells)
+
+
+yield_aggregates = YieldAggregateCache()
+
+
+def _etl_coverage(change, loads):
+    """
+    "skip" when an ETL load's rebuild covers the change, "wait" while the
+    load that would cover it is still writing, None otherwise.
+    """
+    ts = change.get("clusterTime")
+    doc = change.get("fullDocument")
+    if ts is None:
+        return None
+    if doc is not None:
+        # Only the load that wrote this version of the row covers it.
+        load = loads.get(str(doc.get("crop_name", "")).lower())
+        candidates = [load] if load and doc.get("etl_version") == load["etl_version"] else []
+    else:
+        # Deletes don't say which crop they were; any load may have made them.
+        candidates = list(loads.values())
+    state = None
+    for load in candidates:
+        if "started_at" not in load or ts < load["started_at"]:
+            continue
+        if "covered_until" not in load:
+            state = "wait"
+        elif ts <= load["covered_until"]:
+            return "skip"
+    return state
+
+
+async def apply_yield_changes(db, changes):
+    """
+    Refreshes the aggregates for one window of change events: each touched
+    cell once, or a single rebuild when the window has deletes. Returns the
+    events that have to wait for an ETL load still in progress.
+    """
+    loads = {}
+    async for load in db[META_COLLECTION].find({"_id": {"$regex": f"^{re.escape(ETL_LOAD_PREFIX)}"}}):
+        loads[load["crop"]] = load
+
+    cells, rebuild, waiting = set(), False, []
+    for change in changes:
+        coverage = _etl_coverage(change, loads)
+        if coverage == "skip":
+            continue
+        if coverage == "wait":
+            waiting.append(change)
+            continue
+        doc = change.get("fullDocument")
+        if doc and "crop_name" in doc and "adm_id" in doc and "harvest_year" in doc:
+            cells.add((str(doc["crop_name"]).lower(), doc["harvest_year"], doc["adm_id"]))
+        else:
+            # Deletes only carry the _id, so we can't tell which cell moved.
+            rebuild = True
+
+    if rebuild:
+        await rebuild_aggregates(db)
+    elif cells:
+        for crop, year, adm_id in cells:
+            await refresh_cell(db, crop, year, adm_id, bump=False)
+        await bump_version(db)
+    if rebuild or cells:
+        yield_aggregates.invalidate()
+    return waiting
+
+
+async def _next_window(queue, reader, waiting):
+    """
+    The change events of one debounce window, or None once the stream has
+    ended. Re-raises the stream's error.
+    """
+    if not waiting:
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.wait({getter, reader}, return_when=asyncio.FIRST_COMPLETED)
+        if not getter.done():
+            getter.cancel()
+            reader.result()
+            return None
+    await asyncio.sleep(DEBOUNCE_SECONDS)
+    batch = [getter.result()] if not waiting else []
+    while not queue.empty():
+        batch.append(queue.get_nowait())
+    # Hand over what was read before the stream failed; the next call raises.
+    if not batch and not waiting and reader.done() and reader.exception() is not None:
+        reader.result()
+    return batch
+
+
+def _retry_delay(failures):
+    return min(MAX_RETRY_SECONDS, RETRY_SECONDS * 2 ** (failures - 1))
+
+
+async def watch_yield_changes(db):
+    """
+    Follows the yield change stream and refreshes the touched cells.
+    Needs a replica set; on a standalone server it logs and returns.
+    Any other failure is retried: a window that fails to apply is kept
+    for the next one, and a dropped stream is reopened where it left off.
+    """
+    from pymongo.errors import OperationFailure
+
+    queue = asyncio.Queue()
+    waiting = []
+    resume_token = None
+    failures = 0
+
+    async def follow(stream):
+        nonlocal resume_token
+        async for change in stream:
+            queue.put_nowait(change)
+            resume_token = change["_id"]
+
+    while True:
+        try:
+            async with db["yield"].watch(full_document="updateLookup", resume_after=resume_token) as stream:
+                reader = asyncio.create_task(follow(stream))
+                try:
+                    while True:
+                        changes = await _next_window(queue, reader, waiting)
+                        if changes is None:
+                            break
+                        try:
+                            waiting = await apply_yield_changes(db, waiting + changes)
+                            failures = 0
+                        except asyncio.CancelledError:
+                            raise
+                        except Exception as e:
+                            waiting = waiting + changes
+                            failures += 1
+                            print(f"Yield aggregates not refreshed, retrying {len(waiting)} change(s): {type(e).__name__}: {e}")
+                            await asyncio.sleep(_retry_delay(failures))
+                finally:
+                    reader.cancel()
+            # The stream was invalidated (yield dropped or renamed); its token
+            # can't be resumed, so start over from a full rebuild.
+            print("Yield change stream ended, reopening")
+            resume_token = None
+            await rebuild_aggregates(db)
+            yield_aggregates.invalidate()
+            continue
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                print(f"Yield change stream unavailable, relying on ETL refreshes: {e}")
+                return
+            if resume_token is not None and e.code in RESUME_FAILED:
+                # Events since the token are gone; a rebuild covers them.
+                print(f"Yield change stream can't resume, rebuilding aggregates: {e}")
+                resume_token = None
+                try:
+                    await rebuild_aggregates(db)
+                    yield_aggregates.invalidate()
+                except Exception as rebuild_error:
+                    print(f"Yield aggregates not rebuilt: {rebuild_error}")
+                continue
+            error = e
+        except Exception as e:
+            error = e
+        failures += 1
+        delay = _retry_delay(failures)
+        print(f"Yield change stream failed, reopening in {delay:.0f}s: {type(error).__name__}: {error}")
+        await asyncio.sleep(delay)
+
+
+def start_yield_watcher(db):
+    """
+    Runs watch_yield_changes on the current event loop; cancel the
+    returned task to stop it.
+    """
+    return asyncio.create_task(watch_yield_changes(db), name="yield-watcher")
@@ -0,0 +1,144 @@
+import threading
+import time
+import queue
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Collects single predictions from many concurrent requests and scores
+    them together. A request waits at most max_wait_ms for others to join
+    its batch; a batch is flushed early once it reaches max_batch_size.
+
+    score_fn takes a list of rows and returns one result per row. With
+    workers > 1 that many batches can be scored at the same time, which
+    only helps when score_fn releases the GIL (e.g. a process pool).
+    """
+
+    def __init__(self, score_fn, max_batch_size=64, max_wait_ms=2.0, workers=1):
+        self.score_fn = score_fn
+        self.workers = max(1, int(workers))
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+        # Batch size histogram with power-of-two upper bounds: 1, 2, 4, ...
+        self.buckets = []
+        b = 1
+        while b < self.max_batch_size:
+            self.buckets.append(b)
+            b *= 2
+        self.buckets.append(self.max_batch_size)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.batches = 0
+        self.rows = 0
+        self.max_queue_depth = 0
+
+    def _ensure_worker(self):
+        if not self._threads:
+            with self._lock:
+                if not self._threads:
+                    for i in range(self.workers):
+                        t = threading.Thread(target=self._run, name=f"micro-batcher-{i}", daemon=True)
+                        t.start()
+                        self._threads.append(t)
+
+    def submit(self, row) -> Future:
+        """
+        Queues one row and returns a Future for its result.
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((row, future))
+        depth = self._queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return future
+
+    def predict(self, row):
+        """
+        Blocking helper for sync handlers; async callers can wrap submit()
+        with asyncio.wrap_future.
+        """
+        return self.submit(row).result()
+
+    def close(self):
+        """
+        Stops the worker threads once the rows already queued are scored.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            if batch[-1] is None:
+                # close() was called; score what we have, then stop.
+                batch.pop()
+                self._queue.put(None)
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            self._record(len(batch))
+            rows = [row for row, _ in batch]
+            try:
+                results = self.score_fn(rows)
+            except Exception:
+                # One bad row shouldn't fail everybody else in the batch.
+                results = None
+
+            for i, (row, future) in enumerate(batch):
+                if results is not None:
+                    future.set_result(results[i])
+                    continue
+                try:
+                    future.set_result(self.score_fn([row])[0])
+                except Exception as e:
+                    future.set_exception(e)
+
+    def _record(self, size):
+        with self._lock:
+            self.batches += 1
+            self.rows += size
+            for i, bound in enumerate(self.buckets):
+                if size <= bound:
+                    self.bucket_counts[i] += 1
+                    break
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "workers": self.workers,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "batches": self.batches,
+            "rows": self.rows,
+            "mean_batch_size": self.rows / self.batches if self.batches else 0.0,
+            "batch_size_histogram": {
+                str(bound): count for bound, count in zip(self.buckets, self.bucket_counts)
+            },
+        }
@@ -1,2 +1,8 @@
-CROPS = ["wheat", "maize"]
+# Per-crop data config. Adding a crop means an entry here plus its CSVs
+# under final-data/<crop>/.
+CROP_CONFIG = {
+    "wheat": {"merged_file": "wheat_merged_yearly.csv"},
+    "maize": {"merged_file": "maize_mergedf_yearly.csv"},
+}
 
+CROPS = list(CROP_CONFIG)
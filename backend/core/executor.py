@@ -0,0 +1,95 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Models are registered here in the parent before the pool starts. Workers
+# are spawned by default and get a pickled copy through _init_worker: by the
+# time a pool starts the parent has usually run the booster already, and
+# forking a process whose OpenMP/BLAS thread pools are live is unsafe. The
+# fork start method (workers inherit this dict copy-on-write) is opt-in, for
+# callers that start the pool before anything has been scored.
+_MODELS = {}
+
+
+def _init_worker(models):
+    # None with fork, where the dict is inherited from the parent.
+    if models is not None:
+        _MODELS.update(models)
+    # One process per core; each worker runs single threaded.
+    for model in _MODELS.values():
+        booster = getattr(model, "booster", None)
+        if booster is not None:
+            booster.set_param({"nthread": 1})
+
+
+def _ping():
+    return os.getpid()
+
+
+def _predict(name, X):
+    return _MODELS[name].predict_matrix(X)
+
+
+class InferenceExecutor:
+    """
+    Pool of worker processes that score feature matrices.
+    Anything registered with register() must expose predict_matrix(X).
+    """
+
+    def __init__(self, workers=None, start_method=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.start_method = start_method or "spawn"
+        self.models = {}
+        self._pool = None
+
+    def register(self, name, model):
+        if self._pool is not None:
+            raise RuntimeError("Models must be registered before the pool starts")
+        _MODELS[name] = model
+        self.models[name] = model
+
+    def start(self):
+        """
+        Starts the pool and every worker right away, so the first request
+        doesn't pay for it. With start_method="fork" call this before
+        anything has been scored or any threads started in this process.
+        """
+        if self._pool is not None:
+            return
+        method = self.start_method
+        context = multiprocessing.get_context(method)
+        initargs = (None,) if method == "fork" else (dict(self.models),)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=initargs,
+        )
+        # The pool spawns a worker per submit while none is idle, so one
+        # ping per worker brings them all up now.
+        for future in [self._pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, name, X):
+        """
+        Returns a concurrent.futures.Future for the predictions of X.
+        """
+        self.start()
+        return self._pool.submit(_predict, name, X) # type: ignore
+
+    def predict(self, name, X):
+        return self.submit(name, X).result()
+
+    async def predict_async(self, name, X):
+        """
+        Awaitable form for async handlers; the event loop never blocks on predict.
+        """
+        return await asyncio.wrap_future(self.submit(name, X))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        for name in self.models:
+            _MODELS.pop(name, None)
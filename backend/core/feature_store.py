@@ -0,0 +1,366 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+
+# Local columnar store for the per-district agri features in final-data/.
+#
+# build_feature_store() compiles final-data/<crop>/*.csv into one dense
+# float64 array per crop, shaped (adm_id, year, feature), saved as .npy next
+# to an index.json. Gaps are filled at build time from the nearest year that
+# has data (or the crop-wide median when a district has none at all), and the
+# fill distance is stored alongside, so a lookup is a single memory-mapped
+# row read.
+#
+# A rebuild (from the ETL process, say) replaces each file atomically, with
+# index.json last, so processes still mapping the old arrays keep reading
+# them. Those processes reopen the store once they notice a new index.json.
+# Opening, and building a missing or stale store, is done up front
+# (open_feature_store, from main.lifespan); the request path only reads.
+
+DATA_DIR = os.getenv("FINAL_DATA_DIR", "../final-data")
+STORE_DIR = os.getenv("FEATURE_STORE_DIR", "data/feature_store")
+
+# Source file prefix -> feature columns it provides. Order matters when
+# classifying files: soil_moisture_* must be checked before soil_*.
+SOURCES = {
+    "soil_moisture": ["ssm", "rsm"],
+    "soil": ["awc", "bulk_density", "drainage_class"],
+    "ndvi": ["ndvi"],
+    "fpar": ["fpar"],
+    "meteo": ["tmin", "tmax", "prec", "rad", "tavg", "et0", "vpd", "cwb"],
+    "crop_mask": ["crop_area", "crop_area_percentage"],
+}
+STATIC_SOURCES = {"soil", "crop_mask"}
+STATIC_FEATURES = {c for s in STATIC_SOURCES for c in SOURCES[s]}
+
+# Features the prediction model takes from the store, in response order.
+MODEL_FEATURES = [
+    "awc", "bulk_density", "drainage_class", "ssm", "rsm", "ndvi",
+    "tmin", "tmax", "prec", "rad", "tavg", "et0", "vpd", "cwb", "fpar",
+]
+INT_FEATURES = {"drainage_class"}
+FEATURES = MODEL_FEATURES + ["crop_area", "crop_area_percentage"]
+
+# Bump when the on-disk layout changes so old stores get rebuilt.
+STORE_FORMAT = 1
+
+# Offset value meaning "filled with the crop-wide median".
+MEDIAN_FILL = -1
+
+# How often an open store checks whether index.json was replaced.
+CHECK_SECONDS = float(os.getenv("FEATURE_STORE_CHECK_SECONDS", 5))
+
+
+class FeatureStoreUnavailable(RuntimeError):
+    """
+    The store hasn't been opened in this process (see open_feature_store).
+    """
+
+
+def classify_source(filename):
+    """
+    Returns the SOURCES key for a final-data CSV file name, or None.
+    """
+    name = os.path.basename(filename).lower()
+    for source in SOURCES:
+        if name.startswith(source + "_"):
+            return source
+    return None
+
+
+def source_files(data_dir=DATA_DIR):
+    """
+    Maps crop -> {source: path} for every crop directory under data_dir.
+    """
+    crops = {}
+    for crop in sorted(os.listdir(data_dir)):
+        crop_dir = os.path.join(data_dir, crop)
+        if not os.path.isdir(crop_dir):
+            continue
+        files = {}
+        for name in sorted(os.listdir(crop_dir)):
+            source = classify_source(name)
+            if source and name.endswith(".csv"):
+                files[source] = os.path.join(crop_dir, name)
+        if files:
+            crops[crop] = files
+    return crops
+
+
+def _fingerprint(crops):
+    return {
+        path: [os.path.getsize(path), os.path.getmtime(path)]
+        for files in crops.values() for path in files.values()
+    }
+
+
+def _centroids(crop_dir):
+    import pandas as pd
+
+    for name in sorted(os.listdir(crop_dir)):
+        if "merged" in name and name.endswith(".csv"):
+            df = pd.read_csv(os.path.join(crop_dir, name), sep="\t", usecols=["adm_id", "latitude", "longitude"])
+            return df.groupby("adm_id")[["latitude", "longitude"]].mean()
+    return None
+
+
+def _nearest_fill(values):
+    """
+    Fills NaNs along axis 1 (years) from the nearest year with data.
+    Returns the filled array and the year distance (0 where not imputed,
+    MEDIAN_FILL where the district has no data at all).
+    """
+    n_adm, n_years = values.shape
+    idx = np.broadcast_to(np.arange(n_years), values.shape)
+    valid = ~np.isnan(values)
+
+    prev = np.where(valid, idx, -1)
+    prev = np.maximum.accumulate(prev, axis=1)
+    nxt = np.where(valid, idx, n_years)
+    nxt = np.minimum.accumulate(nxt[:, ::-1], axis=1)[:, ::-1]
+
+    prev_dist = np.where(prev >= 0, idx - prev, np.iinfo(np.int32).max)
+    next_dist = np.where(nxt < n_years, nxt - idx, np.iinfo(np.int32).max)
+    # Ties go to the earlier year.
+    source = np.where(prev_dist <= next_dist, prev, nxt)
+    distance = np.minimum(prev_dist, next_dist)
+
+    has_any = valid.any(axis=1)
+    rows = np.arange(n_adm)[:, None]
+    filled = np.where(has_any[:, None], values[rows, np.clip(source, 0, n_years - 1)], np.nan)
+    distance = np.where(has_any[:, None], distance, MEDIAN_FILL).astype(np.int16)
+
+    median = np.nanmedian(values) if valid.any() else 0.0
+    filled = np.where(np.isnan(filled), median, filled)
+    return filled, distance
+
+
+def _replace(path, write):
+    """
+    Calls write(tmp_path) and moves the result over path. Memory maps of
+    the old file stay valid: they keep the replaced inode.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write(tmp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _write_json(data):
+    def write(path):
+        with open(path, "w") as f:
+            json.dump(data, f)
+    return write
+
+
+def build_feature_store(data_dir=DATA_DIR, store_dir=STORE_DIR):
+    """
+    Compiles final-data/<crop>/*.csv into the columnar store.
+    """
+    import pandas as pd
+
+    crops = source_files(data_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    index = {"format": STORE_FORMAT, "features": FEATURES, "crops": {}, "sources": _fingerprint(crops)}
+
+    for crop, files in crops.items():
+        static, yearly = [], []
+        for source, path in files.items():
+            df = pd.read_csv(path, sep="\t")
+            cols = [c for c in SOURCES[source] if c in df.columns]
+            if source in STATIC_SOURCES:
+                static.append(df.groupby("adm_id")[cols].mean())
+            else:
+                yearly.append(df.groupby(["adm_id", "year"])[cols].mean())
+
+        adm_ids = sorted(set().union(*(f.index for f in static), *(f.index.get_level_values(0) for f in yearly)))
+        years = sorted(set().union(*(f.index.get_level_values(1) for f in yearly))) if yearly else [0]
+        first_year, last_year = int(years[0]), int(years[-1])
+        year_axis = np.arange(first_year, last_year + 1)
+
+        values = np.full((len(adm_ids), len(year_axis), len(FEATURES)), np.nan, dtype=np.float64)
+        adm_pos = {a: i for i, a in enumerate(adm_ids)}
+
+        for frame in static:
+            rows = np.array([adm_pos[a] for a in frame.index])
+            for col in frame.columns:
+                values[rows, :, FEATURES.index(col)] = frame[col].to_numpy()[:, None]
+        for frame in yearly:
+            rows = np.array([adm_pos[a] for a in frame.index.get_level_values(0)])
+            cols = frame.index.get_level_values(1).to_numpy() - first_year
+            for col in frame.columns:
+                values[rows, cols, FEATURES.index(col)] = frame[col].to_numpy()
+
+        offsets = np.zeros(values.shape, dtype=np.int16)
+        for f in range(len(FEATURES)):
+            values[:, :, f], offsets[:, :, f] = _nearest_fill(values[:, :, f])
+
+        _replace(os.path.join(store_dir, f"{crop}.values.npy"), lambda path: np.save(path, values))
+        _replace(os.path.join(store_dir, f"{crop}.offsets.npy"), lambda path: np.save(path, offsets))
+
+        entry = {"adm_ids": adm_ids, "first_year": first_year, "last_year": last_year}
+        centroids = _centroids(os.path.dirname(next(iter(files.values()))))
+        if centroids is not None:
+            centroids = centroids.reindex(adm_ids)
+            entry["latitude"] = centroids["latitude"].tolist()
+            entry["longitude"] = centroids["longitude"].tolist()
+        index["crops"][crop] = entry
+        print(f"Feature store: {crop} {len(adm_ids)} districts x {len(year_axis)} years")
+
+    # Last, so a reader never sees an index for arrays that aren't there yet.
+    _replace(os.path.join(store_dir, "index.json"), _write_json(index))
+    return index
+
+
+class FeatureStore:
+    """
+    Read side of the store. Arrays are memory-mapped, so every process
+    that opens the store shares the same pages.
+    """
+
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        path = os.path.join(store_dir, "index.json")
+        self.index_mtime = os.stat(path).st_mtime_ns
+        self.checked_at = time.monotonic()
+        with open(path) as f:
+            self.index = json.load(f)
+        self.features = self.index["features"]
+        self.crops = {}
+        for crop, entry in self.index["crops"].items():
+            lat = np.array(entry.get("latitude", []), dtype=np.float64)
+            lon = np.array(entry.get("longitude", []), dtype=np.float64)
+            self.crops[crop] = {
+                "adm_pos": {a: i for i, a in enumerate(entry["adm_ids"])},
+                "adm_ids": entry["adm_ids"],
+                "first_year": entry["first_year"],
+                "last_year": entry["last_year"],
+                "latitude": lat,
+                "longitude": lon,
+                "values": np.load(os.path.join(store_dir, f"{crop}.values.npy"), mmap_mode="r"),
+                "offsets": np.load(os.path.join(store_dir, f"{crop}.offsets.npy"), mmap_mode="r"),
+            }
+
+    def _crop(self, crop_name):
+        crop = self.crops.get((crop_name or "").lower())
+        if crop is None:
+            raise KeyError(f"Unknown crop {crop_name!r}")
+        return crop
+
+    def nearest_adm_id(self, crop_name, lat, lon):
+        """
+        District whose centroid is closest to (lat, lon), or None.
+        """
+        crop = self._crop(crop_name)
+        if not len(crop["latitude"]):
+            return None
+        # Equirectangular distance is plenty to pick the nearest centroid.
+        dx = (crop["longitude"] - lon) * np.cos(np.radians(lat))
+        dy = crop["latitude"] - lat
+        d = dx * dx + dy * dy
+        i = int(np.nanargmin(d))
+        return crop["adm_ids"][i]
+
+    def lookup(self, crop_name, adm_id, year):
+        """
+        Returns (features, quality) for one district and year.
+        Years outside the stored range use the closest stored year.
+        quality reports which features were imputed and from how many
+        years away ("median" when the crop-wide median was used).
+        """
+        crop = self._crop(crop_name)
+        pos = crop["adm_pos"].get(adm_id)
+        if pos is None:
+            raise KeyError(f"No features for {adm_id!r} ({crop_name})")
+
+        clamped = min(max(int(year), crop["first_year"]), crop["last_year"])
+        extra = abs(int(year) - clamped)
+        y = clamped - crop["first_year"]
+        row = crop["values"][pos, y].tolist()
+        offsets = crop["offsets"][pos, y].tolist()
+
+        features = {}
+        imputed = {}
+        for name, value, offset in zip(self.features, row, offsets):
+            features[name] = int(round(value)) if name in INT_FEATURES else value
+            if offset == MEDIAN_FILL:
+                imputed[name] = "median"
+            elif name in STATIC_FEATURES:
+                continue
+            elif offset + extra:
+                imputed[name] = offset + extra
+
+        model_imputed = [f for f in imputed if f in MODEL_FEATURES]
+        quality = {
+            "year": int(year),
+            "imputed": imputed,
+            "imputed_fraction": len(model_imputed) / len(MODEL_FEATURES),
+        }
+        return features, quality
+
+
+_store = None
+_open_lock = threading.Lock()
+
+
+def is_stale(store_dir=STORE_DIR, data_dir=DATA_DIR):
+    path = os.path.join(store_dir, "index.json")
+    if not os.path.exists(path):
+        return True
+    with open(path) as f:
+        index = json.load(f)
+    if index.get("format") != STORE_FORMAT:
+        return True
+    return index.get("sources") != json.loads(json.dumps(_fingerprint(source_files(data_dir))))
+
+
+def open_feature_store():
+    """
+    Opens the store for this process, rebuilding it first if any source
+    CSV changed. Blocking; call it at startup or from a worker thread.
+    """
+    global _store
+    with _open_lock:
+        if is_stale():
+            build_feature_store()
+        _store = FeatureStore()
+    return _store
+
+
+def get_feature_store():
+    """
+    The open store, reopened when index.json has been replaced by a
+    rebuild. Never builds: raises FeatureStoreUnavailable until
+    open_feature_store() has run.
+    """
+    global _store
+    store = _store
+    if store is None:
+        raise FeatureStoreUnavailable("Feature store is not loaded. Check server logs.")
+    now = time.monotonic()
+    if now - store.checked_at < CHECK_SECONDS:
+        return store
+    store.checked_at = now
+    try:
+        mtime = os.stat(os.path.join(store.store_dir, "index.json")).st_mtime_ns
+    except OSError:
+        return store
+    if mtime != store.index_mtime:
+        try:
+            _store = store = FeatureStore(store.store_dir)
+        except (OSError, ValueError, KeyError) as e:
+            # Keep serving the open store; the next check tries again.
+            print(f"Feature store not reopened: {e}")
+    return store
+
+
+if __name__ == "__main__":
+    build_feature_store()
@@ -0,0 +1,31 @@
+from datetime import datetime
+from core.feature_store import get_feature_store, MODEL_FEATURES
+from core.constant import CROPS
+
+
+def lookup_agri_data(lat: float, lon: float, crop_name: str | None = None, harvest_year: int | None = None, adm_id: str | None = None):
+    """
+    Returns (data, quality) for a location: the soil, moisture, NDVI, FPAR and
+    meteo features the model needs, plus a report of which of them were
+    imputed from another year. When adm_id is not given the district with
+    the nearest centroid is used.
+    """
+    store = get_feature_store()
+    crop = (crop_name or CROPS[0]).lower()
+    year = harvest_year or datetime.now().year
+    if adm_id is None:
+        adm_id = store.nearest_adm_id(crop, lat, lon)
+
+    features, quality = store.lookup(crop, adm_id, year)
+    data = {name: features[name] for name in MODEL_FEATURES}
+    quality["adm_id"] = adm_id
+    quality["crop_area_percentage"] = features["crop_area_percentage"]
+    return data, quality
+
+
+def get_agri_data(lat: float, lon: float, crop_name: str | None = None, harvest_year: int | None = None, adm_id: str | None = None):
+    """
+    Returns the model input features for a location.
+    """
+    data, _ = lookup_agri_data(lat, lon, crop_name, harvest_year, adm_id)
+    return data
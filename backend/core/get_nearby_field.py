@@ -0,0 +1,14 @@
+from database import get_db
+from core.spatial_index import district_index, NoDistrictNearby
+
+
+async def get_nearby_field(lat, lon, max_distance, crop_name=None):
+    """
+    Closest district within max_distance metres of (lat, lon), or None.
+    Served from the in-memory district index.
+    """
+    index = await district_index.get(get_db())
+    try:
+        return index.locate(lat, lon, max_distance / 1000, crop_name)
+    except NoDistrictNearby:
+        return None
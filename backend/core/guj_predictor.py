@@ -0,0 +1,72 @@
+import numpy as np
+
+# Native inference for the Gujarat field-level XGBoost model.
+#
+# The booster was trained on model/dataset.csv with crop_name and
+# harvest_year label-encoded (codes follow the sorted classes). Those codes
+# are rebuilt here as lookup tables from the same file, rows are packed
+# straight into a C-contiguous float32 matrix in the booster's feature
+# order, and scored with Booster.inplace_predict, skipping DataFrames and
+# DMatrix construction.
+
+
+class UnknownCrop(ValueError):
+    pass
+
+
+class GujaratPredictor:
+    def __init__(self, model_path, dataset_path):
+        import pandas as pd
+        from xgboost import Booster
+
+        self.booster = Booster()
+        self.booster.load_model(model_path)
+        self.features = list(self.booster.feature_names or [])
+
+        data = pd.read_csv(dataset_path, sep="\t", usecols=["crop_name", "harvest_year"])
+        self.crops = {name: i for i, name in enumerate(sorted(data["crop_name"].str.lower().unique()))}
+        self.years = np.array(sorted(data["harvest_year"].unique()), dtype=np.int64)
+
+        # Raw input columns, in booster order, and where the encoded ones go.
+        self.raw_columns = [f for f in self.features if not f.endswith("_enc")]
+        self.raw_positions = [self.features.index(f) for f in self.raw_columns]
+        self.crop_position = self.features.index("crop_name_enc")
+        self.year_position = self.features.index("harvest_year_enc")
+
+    def crop_code(self, crop_name):
+        code = self.crops.get(crop_name.strip().lower())
+        if code is None:
+            raise UnknownCrop(f"Unknown crop {crop_name!r}; expected one of {sorted(self.crops)}")
+        return code
+
+    def year_codes(self, years):
+        """
+        Label codes for harvest years; years outside the training range
+        take the code of the closest trained year.
+        """
+        years = np.asarray(years, dtype=np.int64)
+        idx = np.searchsorted(self.years, years)
+        idx = np.clip(idx, 0, len(self.years) - 1)
+        below = np.clip(idx - 1, 0, len(self.years) - 1)
+        closer_below = np.abs(self.years[below] - years) < np.abs(self.years[idx] - years)
+        return np.where(closer_below, below, idx)
+
+    def vectorize(self, fields):
+        """
+        fields: objects or dicts with the dataset.csv columns. Returns an
+        (n, n_features) C-contiguous float32 matrix.
+        """
+        get = (lambda f, c: f[c]) if fields and isinstance(fields[0], dict) else getattr
+        X = np.empty((len(fields), len(self.features)), dtype=np.float32)
+        X[:, self.raw_positions] = [[get(f, c) for c in self.raw_columns] for f in fields]
+        X[:, self.crop_position] = [self.crop_code(get(f, "crop_name")) for f in fields]
+        X[:, self.year_position] = self.year_codes([get(f, "harvest_year") for f in fields])
+        return X
+
+    def predict(self, fields):
+        """
+        Predicted production per field.
+        """
+        if not fields:
+            return np.empty(0, dtype=np.float32)
+        return self.booster.inplace_predict(self.vectorize(fields))
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+from core.feature_store import DATA_DIR
+from core.spatial_index import MAX_DISTANCE_KM, _xyz, _chord
+from core.vector_tiles import MERCATOR_RADIUS, lonlat_to_mercator
+
+# Precomputed raster heatmaps for the map page.
+#
+# build_heatmaps() rasterizes the per-district values in final-data/<crop>/
+# *_merged_yearly.csv onto a web mercator grid and writes one
+# Cloud-Optimized GeoTIFF per crop and year under HEATMAP_DIR, with one
+# band per layer and internal overviews. Each pixel takes the value of the
+# nearest district centroid within HEATMAP_MAX_KM, i.e. district cells.
+# routes/heatmaps.py serves PNG tiles from these files with windowed reads
+# through rio-tiler, so panning never touches Mongo.
+#
+#   python -m core.heatmaps [--crops wheat maize]
+
+HEATMAP_DIR = os.getenv("HEATMAP_DIR", "data/heatmaps")
+RESOLUTION_M = float(os.getenv("HEATMAP_RESOLUTION_M", 2500))
+HEATMAP_MAX_KM = float(os.getenv("HEATMAP_MAX_KM", MAX_DISTANCE_KM))
+
+# Band order in every COG; "predicted_yield" is left empty when the model
+# isn't available at build time.
+LAYERS = ["yield", "predicted_yield", "ndvi", "fpar"]
+# Colour ramp range per layer, as percentiles over all years of a crop.
+RANGE_PERCENTILES = (2, 98)
+
+MODEL_COLUMNS = [
+    "adm_id", "crop_name", "awc", "bulk_density", "drainage_class", "ssm", "rsm", "ndvi",
+    "tmin", "tmax", "prec", "rad", "tavg", "et0", "vpd", "cwb", "fpar",
+    "harvest_area", "harvest_year", "crop_area_percentage",
+]
+
+
+def merged_file(crop, data_dir=DATA_DIR):
+    crop_dir = os.path.join(data_dir, crop)
+    for name in sorted(os.listdir(crop_dir)):
+        if "merged" in name and name.endswith(".csv"):
+            return os.path.join(crop_dir, name)
+    return None
+
+
+def predicted_yield(df):
+    """
+    Model yield (predicted production / harvest area) for each merged row
+    from the active model version, or None when it can't be loaded.
+    """
+    from core.model_registry import load_production, resolve
+
+    try:
+        active = resolve("production")
+        if active is None:
+            raise FileNotFoundError("no production model version")
+        pipeline, encoder = load_production(active[1])
+    except Exception as e:
+        print(f"Heatmaps: no predicted_yield layer, model not loaded: {e}")
+        return None
+
+    rows = df.dropna(subset=MODEL_COLUMNS).copy()
+    # Same spelling as the API's sample input.
+    rows["crop_name"] = rows["crop_name"].str.title()
+    production = pipeline.predict(encoder.transform(rows[MODEL_COLUMNS]))
+    out = np.full(len(df), np.nan)
+    area = rows["harvest_area"].to_numpy(dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out[df.index.get_indexer(rows.index)] = np.where(area > 0, production / area, np.nan)
+    return out
+
+
+def _grid(lat, lon):
+    """
+    Web mercator grid covering the districts plus HEATMAP_MAX_KM.
+    Returns (transform, width, height, pixel lat, pixel lon).
+    """
+    from rasterio.transform import from_origin
+
+    x, y = lonlat_to_mercator(lon, lat)
+    # Mercator metres stretch by 1/cos(lat); pad by the worst case.
+    pad = HEATMAP_MAX_KM * 1000 / np.cos(np.radians(np.abs(lat).max()))
+    left = np.floor((x.min() - pad) / RESOLUTION_M) * RESOLUTION_M
+    top = np.ceil((y.max() + pad) / RESOLUTION_M) * RESOLUTION_M
+    width = int(np.ceil((x.max() + pad - left) / RESOLUTION_M))
+    height = int(np.ceil((top - (y.min() - pad)) / RESOLUTION_M))
+
+    px = left + (np.arange(width) + 0.5) * RESOLUTION_M
+    py = top - (np.arange(height) + 0.5) * RESOLUTION_M
+    plon = np.degrees(px / MERCATOR_RADIUS)
+    plat = np.degrees(2 * np.arctan(np.exp(py / MERCATOR_RADIUS)) - np.pi / 2)
+    return from_origin(left, top, RESOLUTION_M, RESOLUTION_M), width, height, plat, plon
+
+
+def _write_cog(path, bands, transform):
+    import rasterio
+    from rasterio.io import MemoryFile
+    from rasterio.shutil import copy as rio_copy
+
+    count, height, width = bands.shape
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": count,
+        "dtype": "float32", "crs": "EPSG:3857", "transform": transform, "nodata": np.nan,
+    }
+    tmp = f"{path}.tmp"
+    with MemoryFile() as mem:
+        with mem.open(**profile) as dst:
+            dst.write(bands)
+            for i, name in enumerate(LAYERS, start=1):
+                dst.set_band_description(i, name)
+        with mem.open() as src:
+            rio_copy(src, tmp, driver="COG", COMPRESS="DEFLATE", PREDICTOR="YES",
+                     BLOCKSIZE=512, OVERVIEWS="AUTO", RESAMPLING="AVERAGE")
+    os.replace(tmp, path)
+    with rasterio.open(path) as check:
+        return len(check.overviews(1))
+
+
+def build_crop(crop, data_dir=DATA_DIR, out_dir=HEATMAP_DIR):
+    """
+    Writes <out_dir>/<crop>/<year>.tif for every harvest year of one crop.
+    Returns the crop's index entry.
+    """
+    import pandas as pd
+
+    path = merged_file(crop, data_dir)
+    if path is None:
+        print(f"Heatmaps: no merged file for {crop}")
+        return None
+    df = pd.read_csv(path, sep="\t").dropna(subset=["adm_id", "latitude", "longitude", "harvest_year"])
+    df = df.reset_index(drop=True)
+    predicted = predicted_yield(df)
+    df["predicted_yield"] = predicted if predicted is not None else np.nan
+
+    centroids = df.groupby("adm_id")[["latitude", "longitude"]].mean()
+    lat = centroids["latitude"].to_numpy(dtype=np.float64)
+    lon = centroids["longitude"].to_numpy(dtype=np.float64)
+    transform, width, height, plat, plon = _grid(lat, lon)
+
+    # Pixel -> district cell, computed once and reused for every year and layer.
+    tree = cKDTree(_xyz(lat, lon))
+    grid_lat, grid_lon = np.meshgrid(plat, plon, indexing="ij")
+    _, cell = tree.query(_xyz(grid_lat.ravel(), grid_lon.ravel()), distance_upper_bound=float(_chord(HEATMAP_MAX_KM)))
+    cell = cell.reshape(height, width)
+    covered = cell < len(centroids)
+    cell = np.where(covered, cell, 0)
+
+    crop_dir = os.path.join(out_dir, crop)
+    os.makedirs(crop_dir, exist_ok=True)
+    ranges = {}
+    for layer in LAYERS:
+        values = df[layer].to_numpy(dtype=np.float64) if layer in df else np.array([np.nan])
+        finite = values[np.isfinite(values)]
+        ranges[layer] = [float(v) for v in np.percentile(finite, RANGE_PERCENTILES)] if len(finite) else None
+
+    years = []
+    overviews = 0
+    for year, frame in df.groupby("harvest_year"):
+        per_district = frame.groupby("adm_id")[LAYERS].mean().reindex(centroids.index)
+        bands = np.empty((len(LAYERS), height, width), dtype=np.float32)
+        for b, layer in enumerate(LAYERS):
+            district_values = per_district[layer].to_numpy(dtype=np.float32)
+            bands[b] = np.where(covered, district_values[cell], np.nan)
+        overviews = _write_cog(os.path.join(crop_dir, f"{int(year)}.tif"), bands, transform)
+        years.append(int(year))
+    print(f"Heatmaps: {crop} {len(years)} years, {width}x{height} px, {overviews} overviews")
+    return {"years": years, "layers": ranges, "width": width, "height": height, "source": os.path.basename(path)}
+
+
+def build_heatmaps(crops=None, data_dir=DATA_DIR, out_dir=HEATMAP_DIR):
+    """
+    Builds the COGs for the given crops (all by default) and updates index.json.
+    """
+    index = read_index(out_dir)
+    crops = crops or sorted(c for c in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, c)))
+    for crop in crops:
+        entry = build_crop(crop, data_dir, out_dir)
+        if entry:
+            index["crops"][crop] = entry
+    index["version"] = index.get("version", 0) + 1
+    index["layers"] = LAYERS
+    os.makedirs(out_dir, exist_ok=True)
+    tmp = os.path.join(out_dir, "index.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(out_dir, "index.json"))
+    return index
+
+
+def read_index(out_dir=HEATMAP_DIR):
+    try:
+        with open(os.path.join(out_dir, "index.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"version": 0, "layers": LAYERS, "crops": {}}
+
+
+def cog_path(crop, year, out_dir=HEATMAP_DIR):
+    return os.path.join(out_dir, crop, f"{int(year)}.tif")
+
+
+async def etl_hook(db, crop, result):
+    """
+    etl.POST_LOAD_HOOKS entry: rebuild the crop's heatmaps after a load.
+    """
+    await asyncio.get_running_loop().run_in_executor(None, build_heatmaps, [crop])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build heatmap COGs from final-data.")
+    parser.add_argument("--crops", nargs="*")
+    args = parser.parse_args()
+    build_heatmaps(args.crops)
@@ -0,0 +1,454 @@
+import json
+import warnings
+import numpy as np
+
+# Pandas-free inference for the production pipeline.
+#
+# The production model is TargetEncoder -> (optional ColumnTransformer) ->
+# XGBoost. Instead of building a one-row DataFrame per request we compile the
+# fitted encoder and preprocessor into a fixed list of "slots", each of which
+# writes one or more columns of a float32 feature vector, and then call the
+# booster directly. For single rows even inplace_predict costs ~100us of
+# Python-side overhead, so the trees themselves are also compiled into flat
+# NumPy arrays (TreeEnsemble) and used whenever they match the booster exactly.
+
+
+class NotCompilable(Exception):
+    pass
+
+
+def _unwrap_xgb(estimator):
+    """
+    Returns (booster, iteration_range) for an XGBRegressor or a raw Booster.
+    """
+    if hasattr(estimator, "get_booster"):
+        booster = estimator.get_booster()
+        try:
+            # Same rule XGBRegressor.predict uses: honour early stopping.
+            best = estimator.best_iteration
+            iteration_range = (0, best + 1)
+        except AttributeError:
+            iteration_range = (0, 0)
+        return booster, iteration_range
+    if hasattr(estimator, "inplace_predict"):
+        return estimator, (0, 0)
+    raise NotCompilable(f"Final step {type(estimator).__name__} is not an XGBoost model")
+
+
+# Objectives whose prediction is the raw margin, so no link function is needed.
+IDENTITY_OBJECTIVES = {"reg:squarederror", "reg:absoluteerror", "reg:pseudohubererror", "reg:quantileerror"}
+
+
+class TreeEnsemble:
+    """
+    Flat array form of an XGBoost tree ensemble.
+    Every node of every tree lives at a global index; leaves point to
+    themselves so a fixed number of steps walks every tree to its leaf.
+    """
+
+    def __init__(self, booster, iteration_range=(0, 0)):
+        model = json.loads(booster.save_raw("json"))
+        learner = model["learner"]
+        objective = learner["objective"]["name"]
+        if objective not in IDENTITY_OBJECTIVES:
+            raise NotCompilable(f"Objective {objective} is not supported")
+        gbm = learner["gradient_booster"]
+        if gbm.get("name") != "gbtree":
+            raise NotCompilable(f"Booster {gbm.get('name')} is not supported")
+        params = learner["learner_model_param"]
+        if int(params.get("num_target", 1)) != 1 or int(params.get("num_class", 0)) != 0:
+            raise NotCompilable("Only single-target regression is supported")
+
+        trees = gbm["model"]["trees"]
+        per_iter = int(gbm["model"]["gbtree_model_param"].get("num_parallel_tree", 1))
+        begin, end = iteration_range
+        if end:
+            trees = trees[begin * per_iter:end * per_iter]
+
+        left, right, feature, cond, default_left, value = [], [], [], [], [], []
+        roots = []
+        depth = 0
+        offset = 0
+        for tree in trees:
+            if any(tree.get("split_type", [])):
+                raise NotCompilable("Categorical splits are not supported")
+            lc = np.asarray(tree["left_children"], dtype=np.int64)
+            rc = np.asarray(tree["right_children"], dtype=np.int64)
+            n = len(lc)
+            is_leaf = lc == -1
+            idx = np.arange(n)
+            left.append(np.where(is_leaf, idx, lc) + offset)
+            right.append(np.where(is_leaf, idx, rc) + offset)
+            feature.append(np.where(is_leaf, 0, tree["split_indices"]))
+            # Leaves store their value in split_conditions.
+            cond.append(np.asarray(tree["split_conditions"], dtype=np.float32))
+            default_left.append(np.asarray(tree["default_left"], dtype=bool))
+            value.append(np.where(is_leaf, np.asarray(tree["split_conditions"], dtype=np.float32), 0))
+            roots.append(offset)
+            depth = max(depth, int(tree["tree_param"].get("max_depth", 0)) or _tree_depth(lc, rc))
+            offset += n
+
+        # children[2 * node] is the left child, children[2 * node + 1] the right.
+        self.children = np.stack([np.concatenate(left), np.concatenate(right)], axis=1).ravel()
+        self.feature = np.concatenate(feature)
+        self.cond = np.concatenate(cond)
+        self.default_left = np.concatenate(default_left)
+        self.value = np.concatenate(value).astype(np.float32)
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.depth = depth
+        self.base_score = np.float32(str(params["base_score"]).strip("[]"))
+
+    def predict(self, X):
+        n, n_features = X.shape
+        n_trees = len(self.roots)
+        flat = np.ascontiguousarray(X).ravel()
+        row_base = np.repeat(np.arange(n) * n_features, n_trees)
+        node = np.tile(self.roots, n)
+        for _ in range(self.depth):
+            x = flat[row_base + self.feature[node]]
+            # NaN compares False, so missing values only go left by default.
+            go_right = ~((x < self.cond[node]) | (np.isnan(x) & self.default_left[node]))
+            node = self.children[2 * node + go_right]
+        # XGBoost adds trees to the base margin one at a time in float32;
+        # cumsum keeps that order, a plain sum would not.
+        leaves = np.empty((n, n_trees + 1), dtype=np.float32)
+        leaves[:, 0] = self.base_score
+        leaves[:, 1:] = self.value[node].reshape(n, n_trees)
+        return np.cumsum(leaves, axis=1, dtype=np.float32)[:, -1]
+
+
+def _tree_depth(left, right):
+    depth = 0
+    stack = [(0, 0)]
+    while stack:
+        nid, d = stack.pop()
+        if left[nid] == -1:
+            depth = max(depth, d)
+        else:
+            stack.append((left[nid], d + 1))
+            stack.append((right[nid], d + 1))
+    return depth
+
+
+def _column_names(columns, feature_names):
+    if isinstance(columns, str):
+        return [columns]
+    out = []
+    for c in columns:
+        if isinstance(c, (int, np.integer)):
+            out.append(feature_names[c])
+        elif isinstance(c, (bool, np.bool_)):
+            raise NotCompilable("Boolean column masks are not supported")
+        else:
+            out.append(c)
+    return out
+
+
+def _compile_transformer(trans, cols):
+    """
+    Turns one fitted ColumnTransformer entry into slots.
+    A slot is (kind, column, payload, width).
+    """
+    name = type(trans).__name__ if not isinstance(trans, str) else trans
+
+    # A fitted ColumnTransformer stores "passthrough" as an identity FunctionTransformer.
+    if trans == "passthrough" or (name == "FunctionTransformer" and trans.func is None):
+        return [("num", c, (0.0, 1.0), 1) for c in cols]
+    if trans == "drop":
+        return []
+
+    if name == "StandardScaler":
+        mean = trans.mean_ if trans.with_mean else np.zeros(len(cols))
+        scale = trans.scale_ if trans.with_std else np.ones(len(cols))
+        return [("num", c, (float(m), float(s)), 1) for c, m, s in zip(cols, mean, scale)]
+
+    if name == "OneHotEncoder":
+        if getattr(trans, "drop_idx_", None) is not None:
+            raise NotCompilable("OneHotEncoder with drop is not supported")
+        if getattr(trans, "_infrequent_enabled", False):
+            raise NotCompilable("OneHotEncoder with infrequent categories is not supported")
+        unknown_ok = trans.handle_unknown != "error"
+        slots = []
+        for c, cats in zip(cols, trans.categories_):
+            lookup = {cat: i for i, cat in enumerate(cats.tolist())}
+            slots.append(("onehot", c, (lookup, unknown_ok), len(cats)))
+        return slots
+
+    if name == "OrdinalEncoder":
+        if getattr(trans, "_infrequent_enabled", False):
+            raise NotCompilable("OrdinalEncoder with infrequent categories is not supported")
+        unknown = trans.unknown_value if trans.handle_unknown == "use_encoded_value" else None
+        return [
+            ("ordinal", c, ({cat: float(i) for i, cat in enumerate(cats.tolist())}, unknown), 1)
+            for c, cats in zip(cols, trans.categories_)
+        ]
+
+    raise NotCompilable(f"Unsupported transformer {name}")
+
+
+TREE_WALK_MAX_ROWS = 32
+
+
+class CompiledPredictor:
+    """
+    Scores validated input dicts straight from Python values to the booster.
+    Produces the same numbers as encoder.transform + pipeline.predict.
+    """
+
+    def __init__(self, pipeline, encoder):
+        steps = pipeline.steps if hasattr(pipeline, "steps") else [("model", pipeline)]
+        *pre_steps, (_, final) = steps
+        self.booster, self.iteration_range = _unwrap_xgb(final)
+
+        self.target_col = encoder.target_col
+        self.encoded_col = encoder.target_col + "_encoded"
+        self.encodings = dict(encoder.encodings)
+        self.global_mean = float(encoder.global_mean)
+
+        feature_names = getattr(pipeline, "feature_names_in_", None)
+        if feature_names is None:
+            feature_names = getattr(final, "feature_names_in_", None)
+        if feature_names is None:
+            raise NotCompilable("Pipeline was not fitted on named columns")
+        self.input_columns = list(feature_names)
+
+        if len(pre_steps) > 1:
+            raise NotCompilable("Only a single preprocessing step is supported")
+        if pre_steps:
+            pre = pre_steps[0][1]
+            if not hasattr(pre, "transformers_"):
+                raise NotCompilable(f"Unsupported preprocessing step {type(pre).__name__}")
+            # A sparse ColumnTransformer output makes XGBoost treat every zero as missing.
+            self.zero_is_missing = bool(getattr(pre, "sparse_output_", False))
+            with warnings.catch_warnings():
+                # sklearn warns about the remainder column format changing; we handle both.
+                warnings.simplefilter("ignore", FutureWarning)
+                transformers = list(pre.transformers_)
+            slots = []
+            for _, trans, cols in transformers:
+                slots.extend(_compile_transformer(trans, _column_names(cols, self.input_columns)))
+        else:
+            self.zero_is_missing = False
+            types = self.booster.feature_types or []
+            if "c" in types:
+                raise NotCompilable("Native categorical features are not supported")
+            slots = [("num", c, (0.0, 1.0), 1) for c in self.input_columns]
+
+        self.slots = []
+        offset = 0
+        for kind, col, payload, width in slots:
+            self.slots.append((kind, col, payload, offset))
+            offset += width
+        self.n_features = offset
+        if self.n_features != self.booster.num_features():
+            raise NotCompilable(
+                f"Compiled {self.n_features} features but the booster expects {self.booster.num_features()}"
+            )
+
+        self._groups = None
+        self.trees = None
+        try:
+            trees = TreeEnsemble(self.booster, self.iteration_range)
+        except NotCompilable as e:
+            print(f"Compiled trees disabled, using the booster: {e}")
+        else:
+            probe = np.random.default_rng(0).normal(size=(256, self.n_features)).astype(np.float32)
+            probe[::7, ::3] = np.nan
+            expected = self.booster.inplace_predict(probe, iteration_range=self.iteration_range)
+            if np.array_equal(trees.predict(probe), expected):
+                self.trees = trees
+            else:
+                print("Compiled trees disabled, using the booster: results differ")
+
+    def _value(self, row, col):
+        if col == self.encoded_col:
+            return self.encodings.get(row[self.target_col], self.global_mean)
+        return row[col]
+
+    def fill(self, out, row):
+        """
+        Writes the feature vector for one input dict into out (a float32 row).
+        """
+        for kind, col, payload, offset in self.slots:
+            value = self._value(row, col)
+            if kind == "num":
+                mean, scale = payload
+                out[offset] = (float(value) - mean) / scale
+            elif kind == "onehot":
+                lookup, unknown_ok = payload
+                idx = lookup.get(value)
+                if idx is not None:
+                    out[offset + idx] = 1.0
+                elif not unknown_ok:
+                    raise ValueError(f"Found unknown category {value!r} in column {col!r}")
+            else:
+                lookup, unknown = payload
+                code = lookup.get(value, unknown)
+                if code is None:
+                    raise ValueError(f"Found unknown category {value!r} in column {col!r}")
+                out[offset] = code
+
+    def vectorize(self, rows):
+        X = np.zeros((len(rows), self.n_features), dtype=np.float32)
+        for i, row in enumerate(rows):
+            self.fill(X[i], row)
+        if self.zero_is_missing:
+            X[X == 0] = np.nan
+        return X
+
+    def columns_for(self, col):
+        """
+        Feature matrix columns written from input column col.
+        """
+        cols = []
+        ends = [offset for *_, offset in self.slots[1:]] + [self.n_features]
+        for (kind, slot_col, payload, offset), end in zip(self.slots, ends):
+            if slot_col == col or (col == self.target_col and slot_col == self.encoded_col):
+                cols.extend(range(offset, end))
+        return cols
+
+    def vectorize_grid(self, base, axes):
+        """
+        Feature matrix for the Cartesian product of axes over a base input.
+        axes is a list of (column, values); the last axis varies fastest,
+        as in np.indices. Only the base row and one row per axis value go
+        through fill(); the grid is assembled with array indexing.
+        """
+        shape = tuple(len(values) for _, values in axes)
+        n = int(np.prod(shape)) if shape else 1
+        X = np.repeat(self.vectorize([base]), n, axis=0)
+        index = np.indices(shape).reshape(len(shape), -1) if shape else []
+        for (col, values), idx in zip(axes, index):
+            cols = self.columns_for(col)
+            if not cols:
+                continue
+            block = self.vectorize([{**base, col: v} for v in values])[:, cols]
+            X[:, cols] = block[idx]
+        return X
+
+    def predict_matrix(self, X):
+        # The array walk wins for small batches, the booster's C++ predictor for large ones.
+        if self.trees is not None and X.shape[0] <= TREE_WALK_MAX_ROWS:
+            return self.trees.predict(X)
+        return self.booster.inplace_predict(X, iteration_range=self.iteration_range)
+
+    def input_names(self):
+        """
+        Input columns the feature matrix is built from, in slot order,
+        with the target-encoded column reported under its source column.
+        """
+        names = []
+        for _, col, _, _ in self.slots:
+            name = self.target_col if col == self.encoded_col else col
+            if name not in names:
+                names.append(name)
+        return names
+
+    def explain_matrix(self, X):
+        """
+        Exact per-input contributions (TreeSHAP, the booster's native
+        pred_contribs) for each row of X. Returns (names, contributions,
+        bias): contributions is (n, len(names)), one-hot columns summed back
+        into their input. Each row's contributions plus its bias equal
+        predict_matrix(X) up to float32 rounding: the booster computes both
+        in float32, so the sum can be off by a few units in the last place.
+        """
+        from xgboost import DMatrix
+
+        names = self.input_names()
+        if self._groups is None:
+            ends = [offset for *_, offset in self.slots[1:]] + [self.n_features]
+            groups = np.zeros((self.n_features, len(names)), dtype=np.float64)
+            for (_, col, _, offset), end in zip(self.slots, ends):
+                groups[offset:end, names.index(self.target_col if col == self.encoded_col else col)] = 1.0
+            self._groups = groups
+        dmatrix = DMatrix(X, missing=np.nan, feature_names=self.booster.feature_names, feature_types=self.booster.feature_types)
+        raw = self.booster.predict(dmatrix, pred_contribs=True, iteration_range=self.iteration_range)
+        return names, raw[:, :-1].astype(np.float64) @ self._groups, raw[:, -1].astype(np.float64)
+
+    def predict_one(self, row):
+        return float(self.predict_matrix(self.vectorize([row]))[0])
+
+    def predict_many(self, rows):
+        return self.predict_matrix(self.vectorize(rows))
+
+
+def check_parity(predictor, pipeline, encoder, rows):
+    """
+    Scores rows through both the compiled path and the pandas pipeline.
+    Returns the largest absolute difference between the two.
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame(rows)
+    expected = np.asarray(pipeline.predict(encoder.transform(frame)), dtype=np.float64)
+    actual = np.asarray(predictor.predict_many(rows), dtype=np.float64)
+    return float(np.max(np.abs(expected - actual))) if len(rows) else 0.0
+
+
+def probe_rows(predictor, template):
+    """
+    Builds a small set of inputs that touches every compiled category,
+    a known and an unknown adm_id.
+    """
+    rows = [dict(template)]
+    for kind, col, payload, _ in predictor.slots:
+        if kind in ("onehot", "ordinal"):
+            for cat in payload[0]:
+                rows.append({**template, col: cat})
+    known = next(iter(predictor.encodings), None)
+    if known is not None:
+        rows.append({**template, predictor.target_col: known})
+    rows.append({**template, predictor.target_col: "__unknown__"})
+    return rows
+
+
+def compile_predictor(pipeline, encoder, template):
+    """
+    Compiles the pipeline and verifies it against the pandas path on probe
+    rows built from template. Returns None if the pipeline can't be compiled
+    or the results differ, so callers can fall back to the pandas path.
+    """
+    try:
+        predictor = CompiledPredictor(pipeline, encoder)
+        diff = check_parity(predictor, pipeline, encoder, probe_rows(predictor, template))
+    except Exception as e:
+        print(f"Compiled inference disabled: {e}")
+        return None
+    if diff != 0.0:
+        print(f"Compiled inference disabled: differs from pipeline by {diff}")
+        return None
+    return predictor
+
+
+if __name__ == "__main__":
+    # Parity check against the pandas pipeline on the historical data:
+    # python -m core.inference [path/to/merged_yearly.csv ...]
+    import sys
+    import glob
+    import time
+    import joblib
+    import pandas as pd
+    from core.predict import TargetEncoder
+
+    sys.modules['__main__'].TargetEncoder = TargetEncoder # type: ignore
+
+    pipeline = joblib.load('model/final_production_pipeline.pkl')
+    encoder = joblib.load('model/target_encoder.pkl')
+    predictor = CompiledPredictor(pipeline, encoder)
+
+    paths = sys.argv[1:] or sorted(glob.glob("../final-data/*/*_merged*_yearly.csv"))
+    frame = pd.concat([pd.read_csv(p, sep="\t") for p in paths])
+    frame["crop_name"] = frame["crop_name"].str.capitalize()
+    columns = [c for c in predictor.input_columns if c != predictor.encoded_col] + [predictor.target_col]
+    rows = frame[columns].to_dict("records")
+
+    diff = check_parity(predictor, pipeline, encoder, rows)
+    print(f"{len(rows)} rows, max abs difference {diff}")
+
+    start = time.perf_counter()
+    for row in rows[:2000]:
+        predictor.predict_one(row)
+    per_row = (time.perf_counter() - start) / min(len(rows), 2000)
+    print(f"compiled single-row latency: {per_row * 1e6:.1f} us")
+    sys.exit(0 if diff == 0.0 else 1)
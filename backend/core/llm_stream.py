@@ -0,0 +1,175 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# Shared, cached LLM generations.
+#
+# StreamCache.open(key, produce) hands back an async iterator of text
+# chunks. A finished answer for key is replayed from memory; a generation
+# already running for key is followed from its first chunk; otherwise
+# produce() is started as its own task, so viewers that disconnect don't
+# cancel it for the others. A semaphore caps how many upstream
+# generations run at once, and open() raises LLMBusy when no slot frees up
+# within queue_timeout. A generation that fails or is cancelled upstream
+# raises GenerationFailed in every viewer after the chunks it did produce,
+# so none of them mistakes a truncated answer for a whole one.
+
+
+class LLMBusy(Exception):
+    pass
+
+
+class GenerationFailed(Exception):
+    pass
+
+
+class Generation:
+    """
+    One upstream completion, fanned out to every viewer.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = asyncio.Condition()
+
+    async def append(self, chunk):
+        async with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    async def finish(self, error=None):
+        async with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    async def follow(self):
+        i = 0
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: len(self.chunks) > i or self.done)
+                chunks = self.chunks[i:]
+                done = self.done
+            for chunk in chunks:
+                yield chunk
+            i += len(chunks)
+            if done and i == len(self.chunks):
+                if self.error is not None:
+                    raise GenerationFailed(f"LLM generation failed: {self.error}") from self.error
+                return
+
+
+async def replay(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class StreamCache:
+    def __init__(self, max_entries=1000, ttl=86400.0, max_concurrency=8, queue_timeout=10.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, chunks = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return chunks
+
+    def put(self, key, chunks):
+        self.entries[key] = (time.monotonic() + self.ttl, chunks)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def open(self, key, produce):
+        """
+        Chunks of the answer for key; produce() is an async iterator of
+        text chunks from the upstream model.
+        """
+        chunks = self.get(key)
+        if chunks is not None:
+            self.hits += 1
+            return replay(chunks)
+
+        generation = self.inflight.get(key)
+        if generation is not None:
+            self.coalesced += 1
+            return generation.follow()
+
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise LLMBusy(f"{self.max_concurrency} generations already running")
+
+        # Another request may have produced or started this answer while we queued.
+        chunks = self.get(key)
+        if chunks is not None:
+            self.slots.release()
+            self.hits += 1
+            return replay(chunks)
+        generation = self.inflight.get(key)
+        if generation is not None:
+            self.slots.release()
+            self.coalesced += 1
+            return generation.follow()
+
+        self.misses += 1
+        generation = self.inflight[key] = Generation()
+        task = asyncio.create_task(self._run(key, generation, produce))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return generation.follow()
+
+    async def _run(self, key, generation, produce):
+        error = None
+        complete = False
+        try:
+            async for chunk in produce():
+                if chunk:
+                    await generation.append(chunk)
+            complete = True
+        except Exception as e:
+            error = e
+            self.failures += 1
+            print(f"LLM generation failed: {e}")
+        finally:
+            self.slots.release()
+            self.inflight.pop(key, None)
+            # Only whole answers are cached; failed or cancelled ones are retried next time.
+            if complete:
+                self.put(key, generation.chunks)
+            elif error is None:
+                error = asyncio.CancelledError("generation was cancelled")
+            await generation.finish(error)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "active": len(self.inflight),
+            "max_concurrency": self.max_concurrency,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "failures": self.failures,
+        }
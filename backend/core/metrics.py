@@ -0,0 +1,247 @@
+import bisect
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+# Latency histograms and counters exported in Prometheus text format.
+#
+# stage(name) times a block of the hot path into stage_seconds{stage=name}
+# and, when the current request asked for it, into its Server-Timing
+# header. With METRICS=0 stage() hands back a shared no-op and nothing is
+# recorded.
+
+ENABLED = os.getenv("METRICS", "1") == "1"
+# Send Server-Timing on every response instead of only when the request
+# has an "X-Server-Timing: 1" header.
+SERVER_TIMING_ALWAYS = os.getenv("SERVER_TIMING", "0") == "1"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Per-request list of (stage, seconds), set by TimingMiddleware when the
+# request wants a Server-Timing header.
+_request_stages = ContextVar("request_stages", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [bucket counts..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [0] * (len(self.buckets) + 2)
+            s[i] += 1
+            s[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {k: list(v) for k, v in self.series.items()}
+        for labels, s in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), s[:-1]):
+                cumulative += count
+                le = _labels(self.labelnames + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            base = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{base} {s[-1]}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = dict(self.series)
+        for labels, value in sorted(series.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+_metrics = []
+_collectors = []
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    h = Histogram(name, help, labelnames, buckets)
+    _metrics.append(h)
+    return h
+
+
+def counter(name, help, labelnames=()):
+    c = Counter(name, help, labelnames)
+    _metrics.append(c)
+    return c
+
+
+def register_collector(prefix, fn):
+    """
+    Exports the numeric values of the dict fn() returns as gauges named
+    <prefix>_<key>, e.g. the prediction cache and micro-batcher stats.
+    """
+    _collectors.append((prefix, fn))
+
+
+def render():
+    lines = []
+    for m in _metrics:
+        lines.extend(m.render())
+    for prefix, fn in _collectors:
+        try:
+            values = fn()
+        except Exception as e:
+            print(f"Metrics collector {prefix} failed: {e}")
+            continue
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"{prefix}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = histogram("http_request_duration_seconds", "HTTP request latency.", ("method", "route", "status"))
+STAGE_SECONDS = histogram("stage_seconds", "Latency of instrumented hot-path stages.", ("stage",))
+MONGO_SECONDS = histogram("mongo_command_duration_seconds", "MongoDB command latency.", ("command",))
+MONGO_FAILURES = counter("mongo_command_failures_total", "Failed MongoDB commands.", ("command",))
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(elapsed, self.name)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages.append((self.name, elapsed))
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """
+    Context manager timing one stage; works around sync and awaited code.
+    """
+    return _Stage(name) if ENABLED else _NO_STAGE
+
+
+def observe_stage(name, seconds):
+    if ENABLED:
+        STAGE_SECONDS.observe(seconds, name)
+
+
+def _server_timing(stages, total):
+    merged = {}
+    for name, seconds in stages:
+        merged[name] = merged.get(name, 0.0) + seconds
+    parts = [f"{name.replace('.', '-')};dur={seconds * 1000:.2f}" for name, seconds in merged.items()]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware recording request latency per route template and
+    adding the Server-Timing header when asked to.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        wants_timing = SERVER_TIMING_ALWAYS or (b"x-server-timing", b"1") in scope.get("headers", ())
+        stages = [] if wants_timing else None
+        token = _request_stages.set(stages)
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if wants_timing:
+                    header = _server_timing(stages, time.perf_counter() - start)
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_stages.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], path, status[0])
+
+
+def mongo_listener():
+    """
+    pymongo CommandListener feeding mongo_command_duration_seconds.
+    """
+    from pymongo import monitoring
+
+    class MongoTimer(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+
+        def failed(self, event):
+            MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+            MONGO_FAILURES.inc(event.command_name)
+
+    return MongoTimer()
@@ -0,0 +1,470 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+from core.metrics import histogram
+from core.prediction_cache import model_fingerprint
+
+# Versioned models with hot reload.
+#
+# A version is a directory model/versions/<name>/ holding a kind's
+# artifacts (see KIND_FILES); the files directly in model/ are the "base"
+# version. model/registry.json can pin versions per kind:
+#
+#   {"production": {"active": "2026-10-01", "shadow": "2026-10-15"}}
+#
+# Without a pin the newest version (by name) that has all of the kind's
+# files is active. train.py --version <name> writes a new version.
+#
+# ModelRegistry.refresh(), polled every MODEL_WATCH_SECONDS by
+# watch_models(), loads a version that became active in a worker thread,
+# warms it up, and swaps it in with a single reference assignment.
+# Requests hold the version they started on (acquire/release), so the old
+# version finishes its in-flight requests before it's closed. A shadow
+# version scores a sample of live rows off the request path and records how
+# far it lands from the active one.
+
+MODEL_DIR = os.getenv("MODEL_DIR", "model")
+VERSIONS_DIR = os.path.join(MODEL_DIR, "versions")
+REGISTRY_FILE = os.path.join(MODEL_DIR, "registry.json")
+BASE_VERSION = "base"
+WATCH_SECONDS = float(os.getenv("MODEL_WATCH_SECONDS", 5))
+DRAIN_TIMEOUT = float(os.getenv("MODEL_DRAIN_TIMEOUT", 30))
+SHADOW_SAMPLE = float(os.getenv("MODEL_SHADOW_SAMPLE", 1.0))
+# Shadow batches waiting beyond this are dropped rather than queued.
+SHADOW_MAX_PENDING = int(os.getenv("MODEL_SHADOW_MAX_PENDING", 64))
+
+KIND_FILES = {
+    "production": ["final_production_pipeline.pkl", "target_encoder.pkl"],
+    "gujarat": ["xgb_crop_yield_model.json"],
+}
+
+MODEL_SECONDS = histogram("model_inference_seconds", "Model scoring latency per model version.", ("model", "version"))
+
+
+def version_dir(name):
+    return MODEL_DIR if name == BASE_VERSION else os.path.join(VERSIONS_DIR, name)
+
+
+def available_versions(kind):
+    """
+    {name: artifact paths} of every version that has all of kind's files.
+    """
+    files = KIND_FILES[kind]
+    found = {}
+    if all(os.path.exists(os.path.join(MODEL_DIR, f)) for f in files):
+        found[BASE_VERSION] = [os.path.join(MODEL_DIR, f) for f in files]
+    if os.path.isdir(VERSIONS_DIR):
+        for name in sorted(os.listdir(VERSIONS_DIR)):
+            paths = [os.path.join(VERSIONS_DIR, name, f) for f in files]
+            if all(os.path.exists(p) for p in paths):
+                found[name] = paths
+    return found
+
+
+def in_worker_process():
+    """
+    True in a spawned inference worker. Those import the app's main module
+    but get their model from the parent, so they must not load their own.
+    """
+    return multiprocessing.current_process().name != "MainProcess"
+
+
+def load_production(paths):
+    """
+    (pipeline, target encoder) from a production version's artifacts.
+    """
+    import joblib
+    from core.predict import TargetEncoder
+
+    # The encoder was pickled from a __main__ that defined TargetEncoder, so
+    # unpickling looks it up there.
+    sys.modules['__main__'].TargetEncoder = TargetEncoder # type: ignore
+    return joblib.load(paths[0]), joblib.load(paths[1])
+
+
+def pinned(kind):
+    try:
+        with open(REGISTRY_FILE) as f:
+            return json.load(f).get(kind, {})
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def fingerprint(name, paths):
+    return f"{name}|{model_fingerprint(*paths)}"
+
+
+def resolve(kind, role="active"):
+    """
+    (name, paths, fingerprint) of the version that should be serving as
+    role ("active" or "shadow"), or None.
+    """
+    versions = available_versions(kind)
+    name = pinned(kind).get(role)
+    if name is None and role == "active":
+        newest = [n for n in versions if n != BASE_VERSION]
+        name = newest[-1] if newest else (BASE_VERSION if BASE_VERSION in versions else None)
+    if name is None or name not in versions:
+        if name is not None:
+            print(f"Model registry: {kind} {role} version {name!r} not found")
+        return None
+    return name, versions[name], fingerprint(name, versions[name])
+
+
+def close_model(model):
+    close = getattr(model, "close", None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception as e:
+        print(f"Model registry: closing model failed: {e}")
+
+
+class ModelVersion:
+    """
+    One loaded version. model is whatever the kind's loader returned; its
+    close(), if any, is called once the version has drained.
+    """
+
+    def __init__(self, kind, name, paths, fingerprint, model):
+        self.kind = kind
+        self.name = name
+        self.paths = paths
+        self.fingerprint = fingerprint
+        self.model = model
+        self.loaded_at = time.time()
+        self.warmup_seconds = 0.0
+        self.inflight = 0
+        self.requests = 0
+        self.retired = False
+        self.closed = False
+        self._lock = threading.Lock()
+        self._drained = threading.Event()
+
+    def acquire(self):
+        with self._lock:
+            self.inflight += 1
+            self.requests += 1
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+            if self.retired and self.inflight == 0:
+                self._drained.set()
+
+    def retire(self):
+        with self._lock:
+            self.retired = True
+            if self.inflight == 0:
+                self._drained.set()
+
+    def drain_and_close(self, timeout=DRAIN_TIMEOUT):
+        drained = self._drained.wait(timeout)
+        if not drained:
+            print(f"Model registry: {self.kind} {self.name} still has {self.inflight} requests after {timeout}s, closing anyway")
+        self.closed = True
+        close_model(self.model)
+
+    @contextmanager
+    def timed(self):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            MODEL_SECONDS.observe(time.perf_counter() - start, self.kind, self.name)
+
+    def stats(self):
+        return {
+            "version": self.name,
+            "fingerprint": self.fingerprint,
+            "loaded_at": self.loaded_at,
+            "warmup_seconds": self.warmup_seconds,
+            "inflight": self.inflight,
+            "requests": self.requests,
+        }
+
+
+class ShadowStats:
+    def __init__(self, version):
+        self.version = version
+        self.batches = 0
+        self.rows = 0
+        self.dropped = 0
+        self.failures = 0
+        self.abs_diff_sum = 0.0
+        self.rel_diff_sum = 0.0
+        self.max_abs_diff = 0.0
+
+    def record(self, live, shadow):
+        live = np.asarray(live, dtype=np.float64)
+        shadow = np.asarray(shadow, dtype=np.float64)
+        diff = np.abs(shadow - live)
+        self.batches += 1
+        self.rows += len(diff)
+        self.abs_diff_sum += float(diff.sum())
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.rel_diff_sum += float(np.nansum(np.where(live != 0, diff / np.abs(live), np.nan)))
+        self.max_abs_diff = max(self.max_abs_diff, float(diff.max()) if len(diff) else 0.0)
+
+    def summary(self):
+        return {
+            "version": self.version,
+            "batches": self.batches,
+            "rows": self.rows,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "mean_abs_diff": self.abs_diff_sum / self.rows if self.rows else 0.0,
+            "mean_rel_diff": self.rel_diff_sum / self.rows if self.rows else 0.0,
+            "max_abs_diff": self.max_abs_diff,
+        }
+
+
+class ModelRegistry:
+    """
+    The serving and shadow versions of one kind of model.
+
+    loader(name, paths) builds the model object; warm_up(model) runs it on
+    a synthetic batch and raises if the version isn't fit to serve;
+    scorer(model, rows) returns one prediction per row and is used for
+    shadow scoring. on_swap callbacks get each newly active ModelVersion.
+    """
+
+    def __init__(self, kind, loader, warm_up=None, scorer=None):
+        self.kind = kind
+        self.loader = loader
+        self.warm_up = warm_up
+        self.scorer = scorer or (lambda model, rows: model.score(rows))
+        self.on_swap = []
+        self.active = None
+        self.shadow = None
+        self.shadow_stats = None
+        self.swaps = 0
+        self.load_failures = 0
+        self._failed = set()
+        self._swap_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._shadow_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{kind}-shadow")
+        self._shadow_pending = 0
+
+    def _load(self, name, paths, fp):
+        start = time.perf_counter()
+        model = self.loader(name, paths)
+        version = ModelVersion(self.kind, name, paths, fp, model)
+        if self.warm_up is not None:
+            try:
+                self.warm_up(model)
+            except Exception:
+                close_model(model)
+                raise
+        version.warmup_seconds = time.perf_counter() - start
+        return version
+
+    def _wanted(self, role, current):
+        """
+        The version to load for role, or None when current is already it
+        (or it failed to load before).
+        """
+        target = resolve(self.kind, role)
+        if target is None:
+            return None
+        name, paths, fp = target
+        if (current is not None and current.fingerprint == fp) or fp in self._failed:
+            return None
+        return name, paths, fp
+
+    def prepare(self):
+        """
+        Loads and warms whatever the model directory now says should be
+        active and shadow. Blocking; run it off the event loop. Returns the
+        changes for install(), as (role, version) pairs.
+        """
+        changes = []
+        with self._load_lock:
+            target = self._wanted("active", self.active)
+            if target is not None:
+                try:
+                    changes.append(("active", self._load(*target)))
+                except Exception as e:
+                    self._failed.add(target[2])
+                    self.load_failures += 1
+                    print(f"Model registry: {self.kind} {target[0]} not loaded, keeping {self.active.name if self.active else 'none'}: {type(e).__name__}: {e}")
+
+            shadow_target = resolve(self.kind, "shadow")
+            active_fp = changes[0][1].fingerprint if changes else (self.active.fingerprint if self.active else None)
+            if shadow_target is None or shadow_target[2] == active_fp:
+                if self.shadow is not None:
+                    changes.append(("shadow", None))
+            else:
+                target = self._wanted("shadow", self.shadow)
+                if target is not None:
+                    try:
+                        changes.append(("shadow", self._load(*target)))
+                    except Exception as e:
+                        self._failed.add(target[2])
+                        self.load_failures += 1
+                        print(f"Model registry: {self.kind} shadow {target[0]} not loaded: {type(e).__name__}: {e}")
+        return changes
+
+    def install(self, changes):
+        for role, version in changes:
+            if role == "active":
+                self.swap(version)
+            else:
+                self._set_shadow(version)
+
+    def refresh(self):
+        """
+        prepare() and install() in one blocking call, for startup.
+        """
+        self.install(self.prepare())
+        return self.active
+
+    def swap(self, version):
+        with self._swap_lock:
+            old, self.active = self.active, version
+            self.swaps += 1
+        print(f"Model registry: {self.kind} now serving {version.name} (warm-up {version.warmup_seconds:.2f}s)")
+        for callback in self.on_swap:
+            callback(version)
+        if old is not None:
+            self._retire(old)
+
+    def _set_shadow(self, version):
+        with self._swap_lock:
+            old, self.shadow = self.shadow, version
+            self.shadow_stats = ShadowStats(version.name) if version else None
+        if version is not None:
+            print(f"Model registry: {self.kind} shadow scoring with {version.name}")
+        if old is not None:
+            self._retire(old)
+
+    def _retire(self, version):
+        version.retire()
+        threading.Thread(target=version.drain_and_close, name=f"{self.kind}-drain-{version.name}", daemon=True).start()
+
+    def acquire(self):
+        """
+        The active version, held until release(); None when nothing loaded.
+        """
+        with self._swap_lock:
+            version = self.active
+            if version is not None:
+                version.acquire()
+        return version
+
+    def shadow_score(self, rows, live):
+        """
+        Scores rows with the shadow version in the background and compares
+        against live, the active version's results for the same rows.
+        """
+        with self._swap_lock:
+            shadow, stats = self.shadow, self.shadow_stats
+            if shadow is None or not rows or random.random() >= SHADOW_SAMPLE:
+                return
+            if self._shadow_pending >= SHADOW_MAX_PENDING:
+                stats.dropped += 1
+                return
+            shadow.acquire()
+            self._shadow_pending += 1
+
+        def run():
+            try:
+                with shadow.timed():
+                    predicted = self.scorer(shadow.model, rows)
+                stats.record(live, predicted)
+            except Exception as e:
+                stats.failures += 1
+                print(f"Model registry: {self.kind} shadow {shadow.name} failed: {e}")
+            finally:
+                shadow.release()
+                with self._swap_lock:
+                    self._shadow_pending -= 1
+
+        self._shadow_pool.submit(run)
+
+    def close(self):
+        """
+        Closes every loaded version, e.g. their worker pools, on shutdown.
+        """
+        with self._swap_lock:
+            versions = [v for v in (self.active, self.shadow) if v is not None]
+            self.active = self.shadow = self.shadow_stats = None
+        self._shadow_pool.shutdown(wait=False, cancel_futures=True)
+        for version in versions:
+            version.retire()
+            version.drain_and_close(DRAIN_TIMEOUT)
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "active": self.active.stats() if self.active else None,
+            "shadow": self.shadow.stats() if self.shadow else None,
+            "shadow_comparison": self.shadow_stats.summary() if self.shadow_stats else None,
+            "available": sorted(available_versions(self.kind)),
+            "swaps": self.swaps,
+            "load_failures": self.load_failures,
+        }
+
+    def gauges(self):
+        """
+        Numeric stats for metrics.register_collector.
+        """
+        out = {"swaps": self.swaps, "load_failures": self.load_failures}
+        if self.active:
+            out["active_inflight"] = self.active.inflight
+            out["active_loaded_at"] = self.active.loaded_at
+        if self.shadow_stats:
+            out.update({f"shadow_{k}": v for k, v in self.shadow_stats.summary().items() if k != "version"})
+        return out
+
+
+def model_dependency(registry):
+    """
+    FastAPI dependency that holds the registry's active version for the
+    request and reports it in the X-Model-Version response header.
+    """
+    from fastapi import Response
+
+    async def dependency(response: Response):
+        version = registry.acquire()
+        if version is None:
+            yield None
+            return
+        response.headers["X-Model-Version"] = version.name
+        try:
+            yield version
+        finally:
+            version.release()
+
+    return dependency
+
+
+async def watch_models(registries):
+    """
+    Picks up new model versions every WATCH_SECONDS.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(WATCH_SECONDS)
+        for registry in registries:
+            try:
+                # Loading and warm-up happen in a thread; the swap itself,
+                # and so the on_swap callbacks, on the event loop.
+                registry.install(await loop.run_in_executor(None, registry.prepare))
+            except Exception as e:
+                print(f"Model registry: {registry.kind} refresh failed: {e}")
+
+
+def start_model_watcher(registries):
+    if WATCH_SECONDS <= 0:
+        return None
+    return asyncio.create_task(watch_models(registries))
@@ -0,0 +1,361 @@
+import asyncio
+import os
+import random
+import smtplib
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from core.metrics import stage, register_collector
+
+# Transactional outbox for outgoing e-mail.
+#
+# Routes write a message into the outbox collection together with the
+# document it is about (insert_with_outbox). OutboxDispatcher runs in the
+# background, claims due messages in batches and sends them over one reused,
+# authenticated SMTP connection. Failures are retried with exponential
+# backoff; after OUTBOX_MAX_ATTEMPTS (or on a permanent 5xx reply) a message
+# is parked with status "dead" and its last error.
+#
+# Message status: pending -> sending -> sent | pending (retry) | dead | orphaned
+#
+# The body can carry a complainant's personal details, so it is dropped as
+# soon as a message is sent. Sent messages expire OUTBOX_SENT_RETENTION_SECONDS
+# after sent_at, dead and orphaned ones OUTBOX_FAILED_RETENTION_SECONDS after
+# closed_at (TTL indexes created by OutboxDispatcher.run).
+
+OUTBOX_COLLECTION = "outbox"
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", 2))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", 5))
+MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", 3600))
+# A claimed message becomes due again if its sender dies before finishing.
+LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", 120))
+# Messages whose source document still doesn't exist after this long are dropped.
+ORPHAN_SECONDS = 60
+SMTP_IDLE_SECONDS = float(os.getenv("SMTP_IDLE_SECONDS", 60))
+SENT_RETENTION_SECONDS = int(os.getenv("OUTBOX_SENT_RETENTION_SECONDS", 7 * 86400))
+FAILED_RETENTION_SECONDS = int(os.getenv("OUTBOX_FAILED_RETENTION_SECONDS", 30 * 86400))
+
+
+def mail_config():
+    """
+    SMTP settings from the environment, or None when incomplete.
+    """
+    config = {
+        "username": os.getenv("MAIL_USERNAME"),
+        "password": os.getenv("MAIL_PASSWORD"),
+        "mail_from": os.getenv("MAIL_FROM"),
+        "mail_to": os.getenv("MAIL_TO"), # The recipient address
+        "server": os.getenv("MAIL_SERVER"),
+        "port": int(os.getenv("MAIL_PORT", 587)),
+        "starttls": os.getenv("MAIL_STARTTLS", "1") == "1",
+    }
+    if not all([config["mail_from"], config["mail_to"], config["server"]]):
+        return None
+    if config["starttls"] and not (config["username"] and config["password"]):
+        return None
+    return config
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def outbox_message(kind, subject, body, source_collection, source_id):
+    now = utcnow()
+    return {
+        "kind": kind,
+        "subject": subject,
+        "body": body,
+        "source_collection": source_collection,
+        "source_id": source_id,
+        "status": "pending",
+        "attempts": 0,
+        "created_at": now,
+        "next_attempt_at": now,
+        "last_error": None,
+    }
+
+
+_transactions = {}
+
+
+async def supports_transactions(db):
+    """
+    Transactions need a replica set or a sharded cluster.
+    """
+    client = db.client
+    if client not in _transactions:
+        hello = await client.admin.command("hello")
+        _transactions[client] = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _transactions[client]
+
+
+async def insert_with_outbox(db, collection, doc, message):
+    """
+    Inserts doc and its outbox message atomically when the server supports
+    transactions. On a standalone server the message is written first; the
+    dispatcher skips messages whose document never made it.
+    """
+    if await supports_transactions(db):
+        async with await db.client.start_session() as session:
+            async with session.start_transaction():
+                await db[collection].insert_one(doc, session=session)
+                await db[OUTBOX_COLLECTION].insert_one(message, session=session)
+    else:
+        await db[OUTBOX_COLLECTION].insert_one(message)
+        await db[collection].insert_one(doc)
+
+
+def backoff(attempts):
+    delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return delay * (0.5 + random.random())
+
+
+class SmtpSender:
+    """
+    Keeps one authenticated SMTP connection open between batches.
+    Blocking; the dispatcher calls it from a worker thread.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.conn = None
+        self.last_used = 0.0
+
+    def _connect(self):
+        c = self.config
+        conn = smtplib.SMTP(c["server"], c["port"], timeout=30)
+        if c["starttls"]:
+            conn.starttls()
+        if c["username"] and c["password"]:
+            conn.login(c["username"], c["password"])
+        self.conn = conn
+
+    def _alive(self):
+        if self.conn is None:
+            return False
+        try:
+            return self.conn.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.conn = None
+
+    def close_if_idle(self):
+        if self.conn is not None and time.monotonic() - self.last_used > SMTP_IDLE_SECONDS:
+            self.close()
+
+    def _send(self, message):
+        c = self.config
+        mime = MIMEMultipart()
+        mime['From'] = c["mail_from"]
+        mime['To'] = c["mail_to"]
+        mime['Subject'] = message["subject"]
+        mime.attach(MIMEText(message["body"], 'plain'))
+        self.conn.sendmail(c["mail_from"], c["mail_to"], mime.as_string()) # type: ignore
+
+    def send_many(self, messages):
+        """
+        Sends each message; returns one (ok, permanent, error) per message.
+        """
+        results = []
+        with stage("smtp"):
+            if not self._alive():
+                self.close()
+                try:
+                    self._connect()
+                except (smtplib.SMTPException, OSError) as e:
+                    self.close()
+                    return [(False, False, f"connect: {e}")] * len(messages)
+            for message in messages:
+                try:
+                    try:
+                        self._send(message)
+                    except smtplib.SMTPServerDisconnected:
+                        self._connect()
+                        self._send(message)
+                    results.append((True, False, None))
+                except smtplib.SMTPResponseException as e:
+                    results.append((False, e.smtp_code >= 500, f"{e.smtp_code} {e.smtp_error!r}"))
+                except smtplib.SMTPRecipientsRefused as e:
+                    results.append((False, True, f"recipients refused: {e.recipients}"))
+                except (smtplib.SMTPException, OSError) as e:
+                    self.close()
+                    results.append((False, False, str(e)))
+                    try:
+                        self._connect()
+                    except (smtplib.SMTPException, OSError):
+                        # Server is down; fail the rest of the batch without waiting on it.
+                        results.extend([(False, False, str(e))] * (len(messages) - len(results)))
+                        break
+        self.last_used = time.monotonic()
+        return results
+
+
+class OutboxDispatcher:
+    def __init__(self, db, sender):
+        self.db = db
+        self.sender = sender
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.counts = {"sent": 0, "retried": 0, "dead": 0, "orphaned": 0, "batches": 0}
+
+    def notify(self):
+        """
+        Wakes the dispatcher now instead of at the next poll.
+        """
+        self.wakeup.set()
+
+    async def claim(self):
+        """
+        Claims up to BATCH_SIZE due messages in a fixed number of round
+        trips: pick the ids, tag the ones still due with a claim token in
+        one update_many, then read back what carries the token. A message
+        another dispatcher took in between fails the due filter and is
+        left out.
+        """
+        now = utcnow()
+        due = {"status": {"$in": ["pending", "sending"]}, "next_attempt_at": {"$lte": now}}
+        outbox = self.db[OUTBOX_COLLECTION]
+        picked = await outbox.find(due, {"_id": 1}).sort("next_attempt_at", 1).limit(BATCH_SIZE).to_list(None)
+        ids = [d["_id"] for d in picked]
+        if not ids:
+            return []
+        token = uuid.uuid4().hex
+        lease = now + timedelta(seconds=LEASE_SECONDS)
+        await outbox.update_many(
+            {"_id": {"$in": ids}, **due},
+            {"$set": {"status": "sending", "next_attempt_at": lease, "claim": token}},
+        )
+        return await outbox.find({"claim": token}).sort("next_attempt_at", 1).to_list(None)
+
+    async def dispatch(self, messages):
+        from pymongo import UpdateOne
+
+        now = utcnow()
+        by_collection = {}
+        for m in messages:
+            by_collection.setdefault(m["source_collection"], []).append(m["source_id"])
+        existing = set()
+        for collection, ids in by_collection.items():
+            existing.update(await self.db[collection].distinct("_id", {"_id": {"$in": ids}}))
+
+        ops = []
+        ready = []
+        for m in messages:
+            if m["source_id"] in existing:
+                ready.append(m)
+                continue
+            created = m["created_at"].replace(tzinfo=timezone.utc) if m["created_at"].tzinfo is None else m["created_at"]
+            if (now - created).total_seconds() > ORPHAN_SECONDS:
+                ops.append(UpdateOne({"_id": m["_id"]}, {"$set": {"status": "orphaned", "closed_at": now}}))
+                self.counts["orphaned"] += 1
+            else:
+                # The document insert may still be in flight.
+                ops.append(UpdateOne({"_id": m["_id"]}, {"$set": {"status": "pending", "next_attempt_at": now + timedelta(seconds=1)}}))
+
+        results = await asyncio.get_running_loop().run_in_executor(None, self.sender.send_many, ready) if ready else []
+        for m, (ok, permanent, error) in zip(ready, results):
+            attempts = m["attempts"] + 1
+            if ok:
+                ops.append(UpdateOne({"_id": m["_id"]}, {
+                    "$set": {"status": "sent", "sent_at": utcnow(), "attempts": attempts, "last_error": None},
+                    "$unset": {"body": ""},
+                }))
+                self.counts["sent"] += 1
+            elif permanent or attempts >= MAX_ATTEMPTS:
+                ops.append(UpdateOne({"_id": m["_id"]}, {"$set": {"status": "dead", "attempts": attempts, "last_error": error, "closed_at": utcnow()}}))
+                self.counts["dead"] += 1
+                print(f"Outbox message {m['_id']} dead after {attempts} attempt(s): {error}")
+            else:
+                retry_at = utcnow() + timedelta(seconds=backoff(attempts))
+                ops.append(UpdateOne({"_id": m["_id"]}, {"$set": {"status": "pending", "attempts": attempts, "last_error": error, "next_attempt_at": retry_at}}))
+                self.counts["retried"] += 1
+
+        if ops:
+            await self.db[OUTBOX_COLLECTION].bulk_write(ops, ordered=False)
+        self.counts["batches"] += 1
+
+    async def run(self):
+        from pymongo import ASCENDING
+        from pymongo.errors import PyMongoError
+
+        indexes = [
+            ([("status", ASCENDING), ("next_attempt_at", ASCENDING)], {}),
+            ([("sent_at", ASCENDING)], {"expireAfterSeconds": SENT_RETENTION_SECONDS}),
+            ([("closed_at", ASCENDING)], {"expireAfterSeconds": FAILED_RETENTION_SECONDS}),
+        ]
+        for keys, options in indexes:
+            try:
+                await self.db[OUTBOX_COLLECTION].create_index(keys, **options)
+            except PyMongoError as e:
+                print(f"Outbox index not created: {e}")
+
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while True:
+            delay = POLL_SECONDS
+            try:
+                batch = await self.claim()
+                if batch:
+                    await self.dispatch(batch)
+                    failures = 0
+                    continue
+                await loop.run_in_executor(None, self.sender.close_if_idle)
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Keep the dispatcher alive through any failure of one
+                # iteration; claimed messages come back when their lease ends.
+                failures += 1
+                delay = min(MAX_BACKOFF_SECONDS, POLL_SECONDS * 2 ** failures)
+                print(f"Outbox dispatcher: {type(e).__name__}: {e} (retrying in {delay:.0f}s)")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name="outbox-dispatcher")
+        return self
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.get_running_loop().run_in_executor(None, self.sender.close)
+
+    def stats(self):
+        return {**self.counts, "connected": self.sender.conn is not None}
+
+
+dispatcher = None
+register_collector("complaint_outbox", lambda: dispatcher.stats() if dispatcher else {})
+
+
+def start_outbox_dispatcher(db):
+    """
+    Starts the e-mail dispatcher when mail is configured; returns it or None.
+    """
+    global dispatcher
+    config = mail_config()
+    if config is None:
+        print("Email configuration is incomplete. Complaint notifications are disabled.")
+        return None
+    dispatcher = OutboxDispatcher(db, SmtpSender(config)).start()
+    return dispatcher
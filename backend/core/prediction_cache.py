@@ -0,0 +1,126 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+# Result cache for the prediction routes.
+#
+# Entries are keyed on canonicalized inputs (resolved adm_id, crop, year,
+# area, ...) plus the model version, live for at most ttl seconds and are
+# evicted least-recently-used beyond max_entries. Concurrent requests for
+# a key that is already being computed wait for that computation instead
+# of starting their own.
+
+
+def model_fingerprint(*paths):
+    """
+    Version string for a set of model files, from their size and mtime.
+    """
+    parts = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            parts.append(f"{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}")
+        except OSError:
+            parts.append(f"{os.path.basename(path)}:missing")
+    return "|".join(parts)
+
+
+class PredictionCache:
+    def __init__(self, max_entries=10000, ttl=3600.0, model_version=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.model_version = model_version
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def set_model_version(self, version):
+        """
+        Drops every entry when the model changes.
+        """
+        if version != self.model_version:
+            self.model_version = version
+            self.clear()
+
+    def clear(self):
+        self.entries.clear()
+        self.invalidations += 1
+
+    def get(self, key):
+        key = (self.model_version, key)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, version=None):
+        # A result computed against an older model must not land under the new one.
+        if version is not None and version != self.model_version:
+            return
+        key = (self.model_version, key)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_compute(self, key, compute, cacheable=None):
+        """
+        Returns the cached value for key, or awaits compute() once and
+        shares the result with every caller that asked meanwhile.
+        Results for which cacheable(result) is false are returned but
+        not stored.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        flight_key = (self.model_version, key)
+        task = self.inflight.get(flight_key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # Its own task, so a caller disconnecting doesn't cancel it for the others.
+            task = asyncio.ensure_future(compute())
+            self.inflight[flight_key] = task
+            task.add_done_callback(lambda t: self._settle(flight_key, key, t, cacheable))
+        return await asyncio.shield(task)
+
+    def _settle(self, flight_key, key, task, cacheable):
+        self.inflight.pop(flight_key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        value = task.result()
+        if cacheable is None or cacheable(value):
+            self.put(key, value, flight_key[0])
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "model_version": self.model_version,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,334 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+from core.aggregates import CHECK_SECONDS, bump_version, get_version
+from core.constant import CROPS
+from core.feature_store import DATA_DIR, MODEL_FEATURES, get_feature_store, open_feature_store
+from core.model_registry import load_production, resolve
+
+# Offline model predictions for every district, crop and year.
+#
+# score_grid() scores each (adm_id, crop, year) in the feature store, from
+# the first stored year through the current season, with the production
+# pipeline. Rows are scored in chunks across a process pool and written to
+# the predictions collection with unordered bulk_write batches, each
+# document tagged with the fingerprint of the model version it came from
+# (the registry's active version, see core/model_registry.py). Harvest area is the
+# district's reported area for that year, or its median reported area for
+# years without one; districts that never reported an area are skipped.
+#
+# With the compiled model each document also carries the booster's TreeSHAP
+# attributions (contributions per feature plus base_value, in yield units),
+# which /predict/year?explain=true serves for matching requests.
+#
+# PredictionGridCache keeps the collection in memory for the map and
+# dashboard, so they serve predicted yield without running the model.
+#
+#   python -m core.prediction_grid [--crops wheat maize] [--workers N]
+
+PREDICTIONS_COLLECTION = "predictions"
+CHUNK_ROWS = int(os.getenv("PREDICTION_GRID_CHUNK_ROWS", 5000))
+BATCH_SIZE = 1000
+
+# Loaded in each worker process by _init_worker().
+_predictor = None
+
+
+def yield_file(crop, data_dir=DATA_DIR):
+    crop_dir = os.path.join(data_dir, crop)
+    for name in sorted(os.listdir(crop_dir)):
+        if name.lower().startswith("yield_") and name.lower().endswith(".csv"):
+            return os.path.join(crop_dir, name)
+    return None
+
+
+def harvest_areas(crop, data_dir=DATA_DIR):
+    """
+    Returns ({(adm_id, year): area}, {adm_id: median area}) from the
+    crop's reported yields.
+    """
+    import pandas as pd
+
+    path = yield_file(crop, data_dir)
+    if path is None:
+        return {}, {}
+    df = pd.read_csv(path, sep="\t", usecols=["adm_id", "harvest_year", "harvest_area"])
+    df = df[df["harvest_area"] > 0]
+    reported = df.groupby(["adm_id", "harvest_year"])["harvest_area"].mean()
+    medians = df.groupby("adm_id")["harvest_area"].median()
+    return {(a, int(y)): float(v) for (a, y), v in reported.items()}, medians.to_dict()
+
+
+def grid_rows(crop, season=None, data_dir=DATA_DIR):
+    """
+    Model input rows for every district of a crop, from the feature
+    store's first year through season (default: the current year).
+    Years past the stored range reuse the last stored year's features.
+    """
+    store = get_feature_store()
+    entry = store.crops[crop]
+    season = season or datetime.now().year
+    reported, medians = harvest_areas(crop, data_dir)
+    positions = [store.features.index(f) for f in MODEL_FEATURES + ["crop_area_percentage"]]
+    drainage = MODEL_FEATURES.index("drainage_class")
+
+    rows = []
+    for pos, adm_id in enumerate(entry["adm_ids"]):
+        median = medians.get(adm_id)
+        if median is None:
+            continue
+        for year in range(entry["first_year"], season + 1):
+            y = min(year, entry["last_year"]) - entry["first_year"]
+            values = entry["values"][pos, y, positions].tolist()
+            features = dict(zip(MODEL_FEATURES, values[:-1]))
+            features["drainage_class"] = int(round(values[drainage]))
+            area = reported.get((adm_id, year), median)
+            rows.append({
+                **features,
+                "adm_id": adm_id,
+                # Same spelling as the API's sample input.
+                "crop_name": crop.title(),
+                "harvest_area": area,
+                "harvest_year": year,
+                "crop_area_percentage": values[-1],
+            })
+    return rows
+
+
+def load_predictor(template, paths):
+    """
+    The production pipeline, compiled when possible, as a function from
+    rows to (predicted production, attributions); None when the model
+    can't be loaded. attributions is (names, contributions, bias), or None
+    without the compiled model.
+    """
+    import pandas as pd
+    from core.inference import compile_predictor
+
+    try:
+        pipeline, encoder = load_production(paths)
+    except Exception as e:
+        print(f"Prediction grid: model not loaded: {e}")
+        return None
+
+    compiled = compile_predictor(pipeline, encoder, template)
+    if compiled:
+        def predict(rows):
+            X = compiled.vectorize(rows)
+            return compiled.predict_matrix(X), compiled.explain_matrix(X)
+        return predict
+    return lambda rows: (pipeline.predict(encoder.transform(pd.DataFrame(rows))), None)
+
+
+def _init_worker(template, paths):
+    # Workers are spawned, not forked: score_grid runs inside the API's or
+    # the ETL's event loop, next to executor threads and a motor client.
+    # Each one loads the model itself and runs the booster single threaded.
+    from threadpoolctl import threadpool_limits
+
+    global _predictor
+    threadpool_limits(1)
+    _predictor = load_predictor(template, paths)
+
+
+def score_chunk(rows):
+    """
+    Predicted production and attributions for a chunk of rows, or None
+    when the worker couldn't load the model.
+    """
+    if _predictor is None:
+        return None
+    return _predictor(rows)
+
+
+def _documents(crop, rows, production, attributions, model_version, scored_at):
+    docs = []
+    for i, (row, p) in enumerate(zip(rows, production)):
+        area = row["harvest_area"]
+        doc = {
+            "_id": f"{crop}|{row['harvest_year']}|{row['adm_id']}",
+            "crop": crop,
+            "year": row["harvest_year"],
+            "adm_id": row["adm_id"],
+            "harvest_area": area,
+            "predicted_production": float(p),
+            "predicted_yield": float(p) / area,
+            "model_version": model_version,
+            "scored_at": scored_at,
+        }
+        if attributions is not None:
+            names, contributions, bias = attributions
+            doc["base_value"] = float(bias[i]) / area
+            doc["contributions"] = {name: float(v) / area for name, v in zip(names, contributions[i])}
+        docs.append(doc)
+    return docs
+
+
+async def write_predictions(db, crop, docs, scored_at):
+    """
+    Replaces the crop's predictions with docs and bumps the version.
+    """
+    from pymongo import ReplaceOne
+
+    for start in range(0, len(docs), BATCH_SIZE):
+        ops = [ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in docs[start:start + BATCH_SIZE]]
+        await db[PREDICTIONS_COLLECTION].bulk_write(ops, ordered=False)
+    # Rows this run didn't rewrite: districts or years no longer scored.
+    await db[PREDICTIONS_COLLECTION].delete_many({"crop": crop, "scored_at": {"$lt": scored_at}})
+    await bump_version(db, PREDICTIONS_COLLECTION)
+
+
+async def score_grid(db, crops=None, season=None, workers=None):
+    """
+    Scores every district, crop and year and writes the predictions
+    collection. Returns the number of documents written.
+    """
+    loop = asyncio.get_running_loop()
+    # Picks up (and, after an ETL load, rebuilds) the current store.
+    await loop.run_in_executor(None, open_feature_store)
+    grids = {}
+    for crop in crops or CROPS:
+        grids[crop] = await loop.run_in_executor(None, grid_rows, crop, season)
+        if not grids[crop]:
+            print(f"Prediction grid: {crop} has no districts with a harvest area")
+            del grids[crop]
+    if not grids:
+        return 0
+
+    active = resolve("production")
+    if active is None:
+        print("Prediction grid: no production model version")
+        return 0
+    _, paths, model_version = active
+    template = next(iter(grids.values()))[0]
+
+    total = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count(),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(template, paths),
+    ) as pool:
+        for crop, rows in grids.items():
+            start = time.perf_counter()
+            chunks = [rows[i:i + CHUNK_ROWS] for i in range(0, len(rows), CHUNK_ROWS)]
+            results = await asyncio.gather(*(loop.run_in_executor(pool, score_chunk, c) for c in chunks))
+            if any(r is None for r in results):
+                print("Prediction grid: model not loaded in the worker processes")
+                return total
+            production = np.concatenate([p for p, _ in results])
+            attributions = None
+            if all(a is not None for _, a in results):
+                names = results[0][1][0]
+                attributions = (names, np.concatenate([a[1] for _, a in results]), np.concatenate([a[2] for _, a in results]))
+            scored_at = time.time()
+            docs = _documents(crop, rows, production, attributions, model_version, scored_at)
+            await write_predictions(db, crop, docs, scored_at)
+            total += len(docs)
+            print(f"Prediction grid: {crop} {len(docs)} rows in {time.perf_counter() - start:.2f}s")
+    return total
+
+
+async def etl_hook(db, crop, result):
+    """
+    etl.POST_LOAD_HOOKS entry: rescore the crop after a load.
+    """
+    await score_grid(db, [crop])
+
+
+class PredictionGridCache:
+    """
+    In-process copy of the predictions collection.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+        self.by_key = {}
+        self.by_crop_year = {}
+        self.latest_year = {}
+        self.model_versions = set()
+
+    async def get(self, db):
+        """
+        Returns self after making sure it's no older than CHECK_SECONDS.
+        """
+        now = time.monotonic()
+        if self.version is not None and now - self.checked_at < CHECK_SECONDS:
+            return self
+        async with self.lock:
+            if self.version is not None and now - self.checked_at < CHECK_SECONDS:
+                return self
+            version = await get_version(db, PREDICTIONS_COLLECTION)
+            if version != self.version:
+                await self._load(db)
+                self.version = version
+            self.checked_at = now
+        return self
+
+    def invalidate(self):
+        self.checked_at = 0.0
+
+    async def _load(self, db):
+        projection = {"_id": 0, "crop": 1, "year": 1, "adm_id": 1, "predicted_yield": 1, "model_version": 1}
+        docs = await db[PREDICTIONS_COLLECTION].find({}, projection).to_list(None)
+        by_key, by_crop_year, latest_year, versions = {}, {}, {}, set()
+        for d in docs:
+            by_key[(d["crop"], d["year"], d["adm_id"])] = d["predicted_yield"]
+            count, total = by_crop_year.get((d["crop"], d["year"]), (0, 0.0))
+            by_crop_year[(d["crop"], d["year"])] = (count + 1, total + d["predicted_yield"])
+            latest_year[d["crop"]] = max(latest_year.get(d["crop"], d["year"]), d["year"])
+            versions.add(d["model_version"])
+        self.by_key = by_key
+        self.by_crop_year = by_crop_year
+        self.latest_year = latest_year
+        self.model_versions = versions
+
+    def predicted_yield(self, crop, adm_id, year=None):
+        """
+        Predicted yield for a district, for year or the latest scored season.
+        """
+        crop = crop.lower()
+        year = year or self.latest_year.get(crop)
+        return self.by_key.get((crop, year, adm_id))
+
+    def trend(self):
+        """
+        Mean predicted yield across districts, per year and crop.
+        """
+        years = {}
+        for (crop, year), (count, total) in self.by_crop_year.items():
+            years.setdefault(year, {})[crop] = total / count
+        return [{"year": str(year), **{c: crops.get(c, 0) for c in CROPS}} for year, crops in sorted(years.items())]
+
+
+prediction_grid = PredictionGridCache()
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Score every district, crop and year into the predictions collection.")
+    parser.add_argument("--crops", nargs="*")
+    parser.add_argument("--season", type=int, help="Last year to score (default: the current year)")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    async def main():
+        load_dotenv()
+        import database
+        db = database.connect()
+        try:
+            n = await score_grid(db, args.crops, args.season, args.workers)
+            print(f"Prediction grid: {n} predictions")
+        finally:
+            database.close()
+
+    asyncio.run(main())
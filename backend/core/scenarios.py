@@ -0,0 +1,105 @@
+import numpy as np
+
+# What-if sweeps over the production model's inputs.
+#
+# A scenario is a base input plus axes, each a list of values for one
+# feature given as absolute values, deltas or percent changes from the
+# base. The Cartesian product of the axes is scored in one call (see
+# CompiledPredictor.vectorize_grid) and summarised here: one partial
+# dependence curve per axis (mean predicted yield at each value, averaged
+# over every other axis), two-way tables for each pair of axes, and the
+# best and worst combinations.
+
+MODES = ("absolute", "delta", "percent")
+
+
+def axis_values(base_value, values=None, start=None, stop=None, steps=5, mode="absolute"):
+    """
+    The absolute values an axis takes, from an explicit list or an evenly
+    spaced start..stop range, applied to base_value according to mode.
+    """
+    if values is None:
+        if start is None or stop is None:
+            raise ValueError("Give either values or start and stop")
+        values = np.linspace(start, stop, max(int(steps), 1))
+    values = np.asarray(values, dtype=np.float64)
+    if mode == "delta":
+        return base_value + values
+    if mode == "percent":
+        return base_value * (1 + values / 100)
+    if mode == "absolute":
+        return values
+    raise ValueError(f"Unknown mode {mode!r}; expected one of {MODES}")
+
+
+def grid_shape(axes):
+    return tuple(len(values) for _, values in axes)
+
+
+def grid_column(axes, name):
+    """
+    Per-row values of input name over the grid, or None when it isn't an axis.
+    """
+    shape = grid_shape(axes)
+    for i, (col, values) in enumerate(axes):
+        if col == name:
+            index = np.indices(shape).reshape(len(shape), -1)[i]
+            return np.asarray(values, dtype=np.float64)[index]
+    return None
+
+
+def _combination(axes, flat_index):
+    position = np.unravel_index(flat_index, grid_shape(axes))
+    return {col: float(values[i]) for (col, values), i in zip(axes, position)}
+
+
+def summarize(axes, yields, base_yield=None, max_table_cells=2500):
+    """
+    Partial dependence summaries of predicted yields over the grid.
+    Two-way tables larger than max_table_cells are left out.
+    """
+    shape = grid_shape(axes)
+    Y = np.asarray(yields, dtype=np.float64).reshape(shape)
+    n_axes = len(axes)
+
+    partial_dependence = []
+    for i, (col, values) in enumerate(axes):
+        others = tuple(j for j in range(n_axes) if j != i)
+        curve = Y.mean(axis=others) if others else Y
+        partial_dependence.append({
+            "feature": col,
+            "values": [float(v) for v in values],
+            "mean_yield": [float(v) for v in curve],
+            "range": float(curve.max() - curve.min()),
+        })
+
+    interactions = []
+    for i in range(n_axes):
+        for j in range(i + 1, n_axes):
+            if shape[i] * shape[j] > max_table_cells:
+                continue
+            others = tuple(k for k in range(n_axes) if k not in (i, j))
+            table = Y.mean(axis=others) if others else Y
+            interactions.append({
+                "features": [axes[i][0], axes[j][0]],
+                "mean_yield": table.tolist(),
+            })
+
+    flat = Y.ravel()
+    best, worst = int(np.argmax(flat)), int(np.argmin(flat))
+    return {
+        "rows": int(flat.size),
+        "base_yield": base_yield,
+        "yield": {
+            "mean": float(flat.mean()),
+            "min": float(flat[worst]),
+            "max": float(flat[best]),
+            "p10": float(np.percentile(flat, 10)),
+            "p90": float(np.percentile(flat, 90)),
+        },
+        "best": {**_combination(axes, best), "predicted_yield": float(flat[best])},
+        "worst": {**_combination(axes, worst), "predicted_yield": float(flat[worst])},
+        # Features whose curve moves yield the most come first.
+        "partial_dependence": sorted(partial_dependence, key=lambda p: p["range"], reverse=True),
+        "interactions": interactions,
+    }
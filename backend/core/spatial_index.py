@@ -0,0 +1,271 @@
+import asyncio
+import os
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from core.aggregates import bump_version, get_version, CHECK_SECONDS
+
+# In-memory spatial index over the districts collection.
+#
+# Centroids go into a KD-tree on unit-sphere xyz coordinates, so the
+# straight-line distance between points is a monotone function of the
+# great-circle distance and nearest-neighbour queries are exact on the
+# globe. Districts whose geometry is a Polygon/MultiPolygon are also kept
+# for point-in-polygon tests, prefiltered by bounding box.
+#
+# The ETL bumps the "districts" version in materialized_meta after a load
+# and DistrictIndexCache reloads when it moves, like YieldAggregateCache.
+
+EARTH_RADIUS_KM = 6371.0088
+MAX_DISTANCE_KM = float(os.getenv("NEARBY_MAX_DISTANCE_KM", 100))
+META_NAME = "districts"
+
+DISTRICT_PROJECTION = {"_id": 0, "crop_name": 1, "adm_id": 1, "latitude": 1, "longitude": 1, "geometry": 1}
+
+
+class NoDistrictNearby(LookupError):
+    def __init__(self, lat, lon, max_km):
+        super().__init__(f"No district within {max_km:g} km of ({lat}, {lon})")
+        self.lat = lat
+        self.lon = lon
+        self.max_km = max_km
+
+
+def _xyz(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def _chord(km):
+    return 2.0 * np.sin(np.minimum(km / EARTH_RADIUS_KM, np.pi) / 2.0)
+
+
+def _km(chord):
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord, 2.0) / 2.0)
+
+
+def _polygons(geometry):
+    """
+    GeoJSON Polygon/MultiPolygon -> list of polygons, each a list of
+    (n, 2) lon/lat rings with the exterior first.
+    """
+    if not isinstance(geometry, dict):
+        return []
+    if geometry.get("type") == "Polygon":
+        polys = [geometry["coordinates"]]
+    elif geometry.get("type") == "MultiPolygon":
+        polys = geometry["coordinates"]
+    else:
+        return []
+    return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in poly] for poly in polys if poly]
+
+
+def _in_ring(lon, lat, ring):
+    """
+    Even-odd ray casting of one point against one ring.
+    """
+    x0, y0 = ring[:, 0], ring[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    crosses = (y0 > lat) != (y1 > lat)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_at = x0 + (lat - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.count_nonzero(crosses & (lon < x_at)) % 2)
+
+
+def _in_polygons(lon, lat, polygons):
+    for rings in polygons:
+        if _in_ring(lon, lat, rings[0]) and not any(_in_ring(lon, lat, hole) for hole in rings[1:]):
+            return True
+    return False
+
+
+class _Partition:
+    """
+    KD-tree and polygons for one crop (or for all districts).
+    """
+
+    def __init__(self, docs):
+        docs = [d for d in docs if d.get("latitude") is not None and d.get("longitude") is not None]
+        self.adm_ids = [d["adm_id"] for d in docs]
+        self.crops = [d.get("crop_name") for d in docs]
+        self.latitude = np.array([float(d["latitude"]) for d in docs], dtype=np.float64)
+        self.longitude = np.array([float(d["longitude"]) for d in docs], dtype=np.float64)
+        self.tree = cKDTree(_xyz(self.latitude, self.longitude)) if docs else None
+
+        self.polygons = []
+        bounds = []
+        for i, d in enumerate(docs):
+            polys = _polygons(d.get("geometry"))
+            if polys:
+                points = np.concatenate([rings[0] for rings in polys])
+                self.polygons.append((i, polys))
+                bounds.append([*points.min(axis=0), *points.max(axis=0)])
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.adm_ids)
+
+    def containing(self, lat, lon):
+        """
+        Index of the district whose polygon contains the point, or None.
+        """
+        if not self.polygons:
+            return None
+        b = self.bounds
+        candidates = np.flatnonzero((b[:, 0] <= lon) & (lon <= b[:, 2]) & (b[:, 1] <= lat) & (lat <= b[:, 3]))
+        for c in candidates:
+            i, polys = self.polygons[c]
+            if _in_polygons(lon, lat, polys):
+                return i
+        return None
+
+    def query(self, lat, lon, k, max_km):
+        """
+        Vectorized k-nearest query. Returns (distance_km, index) arrays
+        shaped (n, k); misses have distance inf and index len(self).
+        """
+        xyz = _xyz(lat, lon).reshape(-1, 3)
+        chord, idx = self.tree.query(xyz, k=k, distance_upper_bound=float(_chord(max_km)))
+        chord = np.asarray(chord, dtype=np.float64).reshape(len(xyz), k)
+        idx = np.asarray(idx).reshape(len(xyz), k)
+        return np.where(np.isfinite(chord), _km(chord), np.inf), idx
+
+
+class DistrictIndex:
+    """
+    Nearest-district and point-in-polygon lookups, optionally per crop.
+    """
+
+    def __init__(self, docs):
+        docs = list(docs)
+        self.all = _Partition(docs)
+        by_crop = {}
+        for d in docs:
+            by_crop.setdefault(str(d.get("crop_name", "")).lower(), []).append(d)
+        self.by_crop = {crop: _Partition(ds) for crop, ds in by_crop.items() if crop}
+        self._centroids = None
+
+    def __len__(self):
+        return len(self.all)
+
+    def centroids(self):
+        """
+        adm_id -> (latitude, longitude), first district doc per adm_id.
+        """
+        if self._centroids is None:
+            part = self.all
+            centroids = {}
+            for adm_id, lat, lon in zip(part.adm_ids, part.latitude.tolist(), part.longitude.tolist()):
+                centroids.setdefault(adm_id, (lat, lon))
+            self._centroids = centroids
+        return self._centroids
+
+    def _partition(self, crop_name):
+        # Crops without their own districts fall back to every district.
+        part = self.by_crop.get((crop_name or "").lower())
+        return part if part is not None and len(part) else self.all
+
+    def _doc(self, part, i, distance_km):
+        return {
+            "adm_id": part.adm_ids[i],
+            "crop_name": part.crops[i],
+            "latitude": float(part.latitude[i]),
+            "longitude": float(part.longitude[i]),
+            "distance_km": float(distance_km),
+        }
+
+    def nearest(self, lat, lon, k=1, max_km=MAX_DISTANCE_KM, crop_name=None):
+        """
+        Up to k districts closest to (lat, lon) within max_km, nearest first.
+        Raises NoDistrictNearby when there are none.
+        """
+        part = self._partition(crop_name)
+        if part.tree is None:
+            raise NoDistrictNearby(lat, lon, max_km)
+        distance, idx = part.query(lat, lon, min(k, len(part)), max_km)
+        hits = [self._doc(part, i, d) for d, i in zip(distance[0], idx[0]) if np.isfinite(d)]
+        if not hits:
+            raise NoDistrictNearby(lat, lon, max_km)
+        return hits
+
+    def locate(self, lat, lon, max_km=MAX_DISTANCE_KM, crop_name=None):
+        """
+        District containing (lat, lon) when polygons are known, otherwise
+        the nearest centroid within max_km.
+        """
+        part = self._partition(crop_name)
+        i = part.containing(lat, lon)
+        if i is not None:
+            return {**self._doc(part, i, 0.0), "match": "polygon"}
+        return {**self.nearest(lat, lon, 1, max_km, crop_name)[0], "match": "nearest"}
+
+    def locate_many(self, lats, lons, max_km=MAX_DISTANCE_KM, crop_name=None):
+        """
+        Bulk reverse geocode. Returns one dict per point, with an "error"
+        key for points that have no district within max_km.
+        """
+        part = self._partition(crop_name)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        if part.tree is None:
+            distance, idx = np.full((len(lats), 1), np.inf), np.zeros((len(lats), 1), dtype=int)
+        else:
+            distance, idx = part.query(lats, lons, 1, max_km)
+
+        results = []
+        for n, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+            i = part.containing(lat, lon)
+            if i is not None:
+                results.append({**self._doc(part, i, 0.0), "match": "polygon"})
+            elif np.isfinite(distance[n, 0]):
+                results.append({**self._doc(part, idx[n, 0], distance[n, 0]), "match": "nearest"})
+            else:
+                results.append({"error": str(NoDistrictNearby(lat, lon, max_km))})
+        return results
+
+
+class DistrictIndexCache:
+    """
+    Holds the current DistrictIndex and rebuilds it when the districts
+    version in materialized_meta moves.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+        self.index = DistrictIndex([])
+
+    async def get(self, db):
+        """
+        Returns the index after making sure it's no older than CHECK_SECONDS.
+        """
+        now = time.monotonic()
+        if self.version is not None and now - self.checked_at < CHECK_SECONDS:
+            return self.index
+        async with self.lock:
+            if self.version is not None and now - self.checked_at < CHECK_SECONDS:
+                return self.index
+            version = await get_version(db, META_NAME)
+            if version != self.version:
+                docs = await db["districts"].find({}, DISTRICT_PROJECTION).to_list(None)
+                self.index = DistrictIndex(docs)
+                self.version = version
+                print(f"District index: {len(self.index)} districts")
+            self.checked_at = now
+        return self.index
+
+    def invalidate(self):
+        self.checked_at = 0.0
+
+
+district_index = DistrictIndexCache()
+
+
+async def etl_hook(db, crop, result):
+    """
+    etl.POST_LOAD_HOOKS entry: tell running servers to reload the index.
+    """
+    await bump_version(db, META_NAME)
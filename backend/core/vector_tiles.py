@@ -0,0 +1,444 @@
+import asyncio
+import os
+import shutil
+import struct
+import threading
+from collections import OrderedDict
+import mercantile
+import numpy as np
+
+# Mapbox vector tiles (MVT 2.1) for the district map layer.
+#
+# Each tile carries one "districts" layer: district polygons when the
+# districts collection has them, their centroids otherwise, tagged with
+# per-(district, crop) yield attributes from the materialized aggregates.
+# Geometry is projected to web mercator once per data version; per tile it
+# is clipped to the buffered tile, snapped to the tile grid (which is the
+# zoom-dependent simplification) and protobuf-encoded by hand, so there is
+# no extra dependency beyond mercantile.
+#
+# Encoded tiles are kept in an in-memory LRU and under TILE_CACHE_DIR,
+# keyed by the district index and yield aggregate versions, so an ETL load
+# or a yield change stream event makes every cached tile stale at once.
+
+EXTENT = 4096
+BUFFER = 64
+LAYER_NAME = "districts"
+MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", 16))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", 4096))
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", "tile-cache")
+
+MERCATOR_RADIUS = 6378137.0
+MAX_LATITUDE = 85.0511287798066
+
+
+def lonlat_to_mercator(lon, lat):
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE)
+    x = np.radians(lon) * MERCATOR_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * MERCATOR_RADIUS
+    return x, y
+
+
+# --- protobuf ---------------------------------------------------------------
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 31)
+
+
+def _field(number, wire_type):
+    return _varint((number << 3) | wire_type)
+
+
+def _bytes_field(number, payload):
+    return _field(number, 2) + _varint(len(payload)) + payload
+
+
+def _packed(number, values):
+    return _bytes_field(number, b"".join(_varint(v) for v in values))
+
+
+def _value(v):
+    """
+    Encodes one tile Value message.
+    """
+    if isinstance(v, bool):
+        return _field(7, 0) + _varint(int(v))
+    if isinstance(v, int):
+        return _field(6, 0) + _varint((v << 1) ^ (v >> 63))
+    if isinstance(v, float):
+        return _field(3, 1) + struct.pack("<d", v)
+    return _bytes_field(1, str(v).encode())
+
+
+def _command(cmd, count):
+    return (cmd & 0x7) | (count << 3)
+
+
+# --- geometry ---------------------------------------------------------------
+
+def _clip_ring(points, lo, hi):
+    """
+    Sutherland-Hodgman clip of a closed ring (list of (x, y)) to the box
+    [lo, hi] x [lo, hi].
+    """
+    for axis, bound, keep_below in ((0, lo, False), (0, hi, True), (1, lo, False), (1, hi, True)):
+        if not points:
+            return points
+        inside = (lambda p: p[axis] <= bound) if keep_below else (lambda p: p[axis] >= bound)
+        clipped = []
+        prev = points[-1]
+        for cur in points:
+            if inside(cur):
+                if not inside(prev):
+                    clipped.append(_intersect(prev, cur, axis, bound))
+                clipped.append(cur)
+            elif inside(prev):
+                clipped.append(_intersect(prev, cur, axis, bound))
+            prev = cur
+        points = clipped
+    return points
+
+
+def _intersect(a, b, axis, bound):
+    t = (bound - a[axis]) / (b[axis] - a[axis])
+    other = 1 - axis
+    p = [0.0, 0.0]
+    p[axis] = bound
+    p[other] = a[other] + t * (b[other] - a[other])
+    return tuple(p)
+
+
+def _ring_area(ring):
+    # Shoelace in tile coordinates (y down): positive means clockwise on screen.
+    area = 0
+    for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]):
+        area += x0 * y1 - x1 * y0
+    return area / 2
+
+
+def _snap(points):
+    """
+    Rounds to the tile grid and drops repeated vertices; this is what
+    simplifies geometry at low zoom, where many vertices share a cell.
+    """
+    out = []
+    for x, y in points:
+        p = (int(round(x)), int(round(y)))
+        if not out or out[-1] != p:
+            out.append(p)
+    if len(out) > 1 and out[0] == out[-1]:
+        out.pop()
+    return out
+
+
+def _encode_polygon(polygons):
+    """
+    polygons: list of polygons, each a list of rings in tile coordinates
+    with the exterior first. Returns geometry commands, or [] if nothing
+    survives clipping and snapping.
+    """
+    commands = []
+    cx = cy = 0
+    for rings in polygons:
+        for n, ring in enumerate(rings):
+            ring = _snap(_clip_ring(ring, -BUFFER, EXTENT + BUFFER))
+            if len(ring) < 3:
+                if n == 0:
+                    break
+                continue
+            area = _ring_area(ring)
+            if area == 0:
+                if n == 0:
+                    break
+                continue
+            # Exterior rings are clockwise in tile space, holes counter-clockwise.
+            if (area > 0) != (n == 0):
+                ring.reverse()
+            x, y = ring[0]
+            commands += [_command(1, 1), _zigzag(x - cx), _zigzag(y - cy)]
+            cx, cy = x, y
+            commands.append(_command(2, len(ring) - 1))
+            for x, y in ring[1:]:
+                commands += [_zigzag(x - cx), _zigzag(y - cy)]
+                cx, cy = x, y
+            commands.append(_command(7, 1))
+    return commands
+
+
+def _encode_point(x, y):
+    return [_command(1, 1), _zigzag(int(round(x))), _zigzag(int(round(y)))]
+
+
+class _Feature:
+    __slots__ = ("properties", "polygons", "x", "y")
+
+    def __init__(self, properties, polygons, x, y):
+        self.properties = properties
+        # Polygons as lists of (n, 2) mercator arrays, or None for a point.
+        self.polygons = polygons
+        self.x = x
+        self.y = y
+
+
+def _mercator_polygons(geometry):
+    if not isinstance(geometry, dict):
+        return None
+    if geometry.get("type") == "Polygon":
+        polys = [geometry["coordinates"]]
+    elif geometry.get("type") == "MultiPolygon":
+        polys = geometry["coordinates"]
+    else:
+        return None
+    out = []
+    for poly in polys:
+        rings = []
+        for ring in poly:
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            if len(ring) >= 3:
+                rings.append(np.stack(lonlat_to_mercator(ring[:, 0], ring[:, 1]), axis=-1))
+        if rings:
+            out.append(rings)
+    return out or None
+
+
+def district_attributes(aggregates):
+    """
+    (adm_id, crop) -> yield attributes from the aggregate cells.
+    """
+    by_key = {}
+    for c in aggregates.cells:
+        a = by_key.setdefault((c["adm_id"], c["crop"]), {"count": 0, "sum": 0.0, "years": 0, "latest_year": None, "latest_yield": None})
+        a["count"] += c["count"]
+        a["sum"] += c["sum"]
+        a["years"] += 1
+        if a["latest_year"] is None or c["year"] > a["latest_year"]:
+            a["latest_year"] = int(c["year"])
+            a["latest_yield"] = round(c["sum"] / c["count"], 3) if c["count"] else None
+    return {
+        key: {
+            "avg_yield": round(a["sum"] / a["count"], 3) if a["count"] else None,
+            "years": a["years"],
+            "latest_year": a["latest_year"],
+            "latest_yield": a["latest_yield"],
+        }
+        for key, a in by_key.items()
+    }
+
+
+class TileLayer:
+    """
+    District features projected to web mercator, with a bounding-box
+    array for picking the features that touch a tile.
+    """
+
+    def __init__(self, docs, attributes):
+        self.features = []
+        bounds = []
+        for d in docs:
+            if d.get("latitude") is None or d.get("longitude") is None:
+                continue
+            crop = str(d.get("crop_name", "")).lower()
+            props = {"adm_id": d["adm_id"], "crop_name": crop}
+            for k, v in attributes.get((d["adm_id"], crop), {}).items():
+                if v is not None:
+                    props[k] = v
+            x, y = lonlat_to_mercator(float(d["longitude"]), float(d["latitude"]))
+            polygons = _mercator_polygons(d.get("geometry"))
+            self.features.append(_Feature(props, polygons, float(x), float(y)))
+            if polygons:
+                points = np.concatenate([rings[0] for rings in polygons])
+                bounds.append([*points.min(axis=0), *points.max(axis=0)])
+            else:
+                bounds.append([x, y, x, y])
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.features)
+
+    def render(self, z, x, y, crop=None):
+        """
+        Encoded MVT bytes for one tile; b"" when no district touches it.
+        """
+        b = mercantile.xy_bounds(x, y, z)
+        scale = EXTENT / (b.right - b.left)
+        pad = BUFFER / scale
+        hits = np.flatnonzero(
+            (self.bounds[:, 0] <= b.right + pad) & (self.bounds[:, 2] >= b.left - pad)
+            & (self.bounds[:, 1] <= b.top + pad) & (self.bounds[:, 3] >= b.bottom - pad)
+        )
+
+        keys, key_index = [], {}
+        values, value_index = [], {}
+        features = []
+        for i in hits.tolist():
+            f = self.features[i]
+            if crop and f.properties["crop_name"] != crop:
+                continue
+            if f.polygons:
+                polygons = [
+                    [list(zip(((r[:, 0] - b.left) * scale).tolist(), ((b.top - r[:, 1]) * scale).tolist())) for r in rings]
+                    for rings in f.polygons
+                ]
+                geometry, geom_type = _encode_polygon(polygons), 3
+            else:
+                px, py = (f.x - b.left) * scale, (b.top - f.y) * scale
+                if not (-BUFFER <= px <= EXTENT + BUFFER and -BUFFER <= py <= EXTENT + BUFFER):
+                    continue
+                geometry, geom_type = _encode_point(px, py), 1
+            if not geometry:
+                continue
+
+            tags = []
+            for k, v in f.properties.items():
+                if k not in key_index:
+                    key_index[k] = len(keys)
+                    keys.append(k)
+                vk = (type(v), v)
+                if vk not in value_index:
+                    value_index[vk] = len(values)
+                    values.append(v)
+                tags += [key_index[k], value_index[vk]]
+
+            features.append(
+                _field(1, 0) + _varint(i + 1)
+                + _packed(2, tags)
+                + _field(3, 0) + _varint(geom_type)
+                + _packed(4, geometry)
+            )
+
+        if not features:
+            return b""
+        layer = (
+            _field(15, 0) + _varint(2)
+            + _bytes_field(1, LAYER_NAME.encode())
+            + b"".join(_bytes_field(2, f) for f in features)
+            + b"".join(_bytes_field(3, k.encode()) for k in keys)
+            + b"".join(_bytes_field(4, _value(v)) for v in values)
+            + _field(5, 0) + _varint(EXTENT)
+        )
+        return _bytes_field(3, layer)
+
+
+class TileCache:
+    """
+    Encoded tiles by (version, crop, z, x, y): an in-memory LRU in front of
+    a directory per version on disk. Older version directories are removed
+    when the version moves.
+    """
+
+    def __init__(self, max_entries=TILE_CACHE_SIZE, directory=TILE_CACHE_DIR):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.layer = None
+        self.layer_lock = asyncio.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, version, crop, z, x, y):
+        return os.path.join(self.directory, version, crop or "all", str(z), str(x), f"{y}.mvt")
+
+    def get(self, version, crop, z, x, y):
+        key = (version, crop, z, x, y)
+        with self.lock:
+            tile = self.entries.get(key)
+            if tile is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return tile
+        if self.directory:
+            try:
+                with open(self._path(version, crop, z, x, y), "rb") as fh:
+                    tile = fh.read()
+            except OSError:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, tile)
+            return tile
+        self.misses += 1
+        return None
+
+    def put(self, version, crop, z, x, y, tile):
+        self._remember((version, crop, z, x, y), tile)
+        if self.directory:
+            path = self._path(version, crop, z, x, y)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as fh:
+                    fh.write(tile)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"Tile cache write failed: {e}")
+
+    def _remember(self, key, tile):
+        with self.lock:
+            self.entries[key] = tile
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    async def layer_for(self, version, build):
+        """
+        Returns the TileLayer for version, building it with build() and
+        dropping tiles of older versions when the version moves.
+        """
+        if self.version == version:
+            return self.layer
+        async with self.layer_lock:
+            if self.version != version:
+                self.layer = await build()
+                old = self.version
+                self.version = version
+                with self.lock:
+                    self.entries.clear()
+                if self.directory:
+                    await asyncio.get_running_loop().run_in_executor(None, self._prune, version)
+                print(f"Tile layer {version}: {len(self.layer)} districts (was {old})")
+        return self.layer
+
+    def _prune(self, keep):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name != keep:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+tile_cache = TileCache()
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
@@ -0,0 +1,127 @@
+import heapq
+import os
+
+# Per-district yield statistics for the variability views.
+#
+# Every yield_aggregates cell (crop, year, adm_id) carries the count, mean
+# and M2 (sum of squared deviations) of its yield rows, materialized by
+# core/aggregates.py. YieldStats merges those cells with the parallel form
+# of Welford's update into running stats per (adm_id, crop) and per
+# adm_id, and keeps them ranked by sample standard deviation, so the
+# unfiltered top-K is a slice. Year-range queries merge only the cells in
+# range.
+
+TOP_K = int(os.getenv("VARIABILITY_TOP_K", 500))
+
+
+class RunningStats:
+    """
+    Count, mean and M2 of a set of yield rows, built by merging
+    partitions (the parallel form of Welford's update).
+    """
+
+    __slots__ = ("count", "mean", "m2", "total")
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.total = count * mean
+
+    def merge(self, count, mean, m2):
+        """
+        Folds in the stats of another partition (Chan et al.).
+        """
+        if not count:
+            return self
+        n = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / n
+        self.m2 += m2 + delta * delta * self.count * count / n
+        self.count = n
+        self.total += count * mean
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    @property
+    def std(self):
+        v = self.variance
+        return max(v, 0.0) ** 0.5 if v is not None else None
+
+
+def _row(adm_id, crop, stats):
+    return {
+        "adm_id": adm_id,
+        "zone": adm_id,
+        "crop": crop,
+        "variability": round(stats.std, 2),
+        "yield": stats.total,
+        "mean_yield": round(stats.mean, 4),
+        "count": stats.count,
+    }
+
+
+def _ranked(items, k):
+    """
+    (adm_id, crop, stats) items with at least two rows, most variable first.
+    """
+    items = [i for i in items if i[2].count > 1]
+    return heapq.nlargest(k, items, key=lambda i: i[2].std) if k else sorted(items, key=lambda i: i[2].std, reverse=True)
+
+
+class YieldStats:
+    def __init__(self, cells, top_k=TOP_K):
+        self.top_k = top_k
+        self.cells = [c for c in cells if "m2" in c]
+        self.by_district = {}
+        self.by_adm = {}
+        for c in self.cells:
+            mean = c["sum"] / c["count"] if c["count"] else 0.0
+            self.by_district.setdefault((c["adm_id"], c["crop"]), RunningStats()).merge(c["count"], mean, c["m2"])
+            self.by_adm.setdefault(c["adm_id"], RunningStats()).merge(c["count"], mean, c["m2"])
+
+        self.rankings = {None: _ranked([(a, None, s) for a, s in self.by_adm.items()], top_k)}
+        per_crop = {}
+        for (adm_id, crop), s in self.by_district.items():
+            per_crop.setdefault(crop, []).append((adm_id, crop, s))
+        for crop, items in per_crop.items():
+            self.rankings[crop] = _ranked(items, top_k)
+
+    def top(self, limit=25, crop=None, from_year=None, to_year=None, where=None):
+        """
+        Most variable districts. Without a year range this walks the
+        precomputed ranking; with one it merges the cells in range.
+        Without a crop, each district's crops are pooled. where(adm_id)
+        can exclude districts.
+        """
+        crop = crop.lower() if crop else None
+        if from_year is None and to_year is None:
+            ranking = self.rankings.get(crop, [])
+            if where is None:
+                picked = ranking[:limit]
+            else:
+                picked = []
+                for i in ranking:
+                    if where(i[0]):
+                        picked.append(i)
+                        if len(picked) == limit:
+                            break
+            if len(picked) == limit or len(ranking) < self.top_k:
+                return [_row(*i) for i in picked]
+
+        merged = {}
+        for c in self.cells:
+            if crop and c["crop"] != crop:
+                continue
+            if from_year is not None and c["year"] < from_year:
+                continue
+            if to_year is not None and c["year"] > to_year:
+                continue
+            if where is not None and not where(c["adm_id"]):
+                continue
+            mean = c["sum"] / c["count"] if c["count"] else 0.0
+            merged.setdefault(c["adm_id"], RunningStats()).merge(c["count"], mean, c["m2"])
+        return [_row(*i) for i in _ranked([(a, crop, s) for a, s in merged.items()], limit)]
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from core.constant import CROP_CONFIG
+from core.feature_store import source_files, STATIC_SOURCES
+from core.aggregates import etl_hook as refresh_yield_aggregates, begin_etl_load, cover_etl_load, abort_etl_load
+from core.spatial_index import etl_hook as refresh_district_index
+from core.heatmaps import etl_hook as refresh_heatmaps
+from core.prediction_grid import etl_hook as refresh_predictions
+
+# Rebuilds final-data/<crop>/<merged_file> from the per-variable CSVs and
+# bulk-loads the yield, districts and crop_mask collections.
+#
+# Only crops whose source CSVs changed (by content hash) are rebuilt. The
+# joins run per crop in parallel worker processes; Mongo writes happen in
+# the parent with unordered bulk_write batches through the shared motor
+# client in database.py.
+#
+#   python etl.py [--crops wheat maize] [--force] [--no-db] [--workers N]
+
+DATA_DIR = os.getenv("FINAL_DATA_DIR", "../final-data")
+STATE_FILE = os.getenv("ETL_STATE_FILE", "data/etl_state.json")
+BATCH_SIZE = 1000
+
+MERGED_COLUMNS = [
+    "crop_name", "adm_id", "latitude", "longitude", "region_area", "harvest_year",
+    "yield", "production", "harvest_area", "awc", "bulk_density", "drainage_class",
+    "ssm", "rsm", "ndvi", "tmin", "tmax", "prec", "rad", "tavg", "et0", "vpd", "cwb",
+    "fpar", "crop_area", "crop_area_percentage",
+]
+DISTRICT_COLUMNS = ["latitude", "longitude", "region_area"]
+YIELD_COLUMNS = ["crop_name", "adm_id", "harvest_year", "yield", "production", "harvest_area"]
+YEARLY_ORDER = ["soil_moisture", "ndvi", "meteo", "fpar"]
+
+# Awaited as hook(db, crop, frames) after a crop has been loaded into Mongo.
+POST_LOAD_HOOKS = [refresh_yield_aggregates, refresh_district_index, refresh_heatmaps, refresh_predictions]
+
+
+def crop_inputs(crop, data_dir=DATA_DIR):
+    """
+    Source CSVs for one crop: the feature sources plus yield and
+    districts_*.csv with latitude/longitude/region_area.
+    """
+    crop_dir = os.path.join(data_dir, crop)
+    files = dict(source_files(data_dir).get(crop, {}))
+    for name in sorted(os.listdir(crop_dir)):
+        lower = name.lower()
+        if lower.startswith("yield_") and lower.endswith(".csv"):
+            files["yield"] = os.path.join(crop_dir, name)
+        elif lower.startswith("districts_") and lower.endswith(".csv"):
+            files["districts"] = os.path.join(crop_dir, name)
+    return files
+
+
+def seed_districts(crop, data_dir=DATA_DIR):
+    """
+    District coordinates and area aren't in any per-variable CSV; so far
+    they only exist in the merged file. Extract them once into
+    districts_<crop>.csv so they become a regular source and don't depend
+    on the file this script overwrites.
+    """
+    import pandas as pd
+
+    merged_path = os.path.join(data_dir, crop, CROP_CONFIG[crop]["merged_file"])
+    path = os.path.join(data_dir, crop, f"districts_{crop}.csv")
+    if not os.path.exists(merged_path):
+        return None
+    df = pd.read_csv(merged_path, sep="\t", usecols=["crop_name", "adm_id"] + DISTRICT_COLUMNS)
+    df.drop_duplicates("adm_id").to_csv(path, sep="\t", index=False, float_format="%.15g")
+    print(f"{crop}: wrote {path} from {merged_path}")
+    return path
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def crop_hash(crop, files):
+    """
+    Content hash of everything a crop's merge depends on.
+    """
+    h = hashlib.sha256(json.dumps(CROP_CONFIG[crop], sort_keys=True).encode())
+    for source in sorted(files):
+        h.update(source.encode())
+        h.update(file_hash(files[source]).encode())
+    return h.hexdigest()
+
+
+def build_crop(crop, files, data_dir=DATA_DIR):
+    """
+    Joins one crop's sources into its merged yearly table, writes it and
+    returns the frames to load. Runs in a worker process.
+    """
+    import pandas as pd
+
+    read = lambda source: pd.read_csv(files[source], sep="\t")
+    merged_path = os.path.join(data_dir, crop, CROP_CONFIG[crop]["merged_file"])
+
+    yields = read("yield")[YIELD_COLUMNS].dropna(subset=["yield", "production", "harvest_area"])
+    yields["harvest_year"] = yields["harvest_year"].astype(int)
+
+    df = yields
+    for source in YEARLY_ORDER:
+        table = read(source).drop(columns="crop_name").rename(columns={"year": "harvest_year"})
+        df = df.merge(table, on=["adm_id", "harvest_year"], how="inner")
+    for source in sorted(STATIC_SOURCES):
+        df = df.merge(read(source).drop(columns="crop_name"), on="adm_id", how="inner")
+
+    districts = None
+    if "districts" in files:
+        districts = read("districts").drop_duplicates("adm_id")[["adm_id"] + DISTRICT_COLUMNS]
+        df = df.merge(districts, on="adm_id", how="left")
+    else:
+        for col in DISTRICT_COLUMNS:
+            df[col] = float("nan")
+
+    df = df[MERGED_COLUMNS]
+    df.to_csv(merged_path, sep="\t", index=False, float_format="%.15g")
+
+    crop_mask = read("crop_mask")
+    if districts is not None:
+        districts = districts.dropna(subset=["latitude", "longitude"])
+        districts.insert(0, "crop_name", crop)
+    return {
+        "crop": crop,
+        "merged_path": merged_path,
+        "rows": len(df),
+        "yield": yields,
+        "districts": districts,
+        "crop_mask": crop_mask,
+    }
+
+
+def _documents(collection, frame, version):
+    docs = frame.to_dict("records")
+    for doc in docs:
+        doc["etl_version"] = version
+        if collection == "districts":
+            doc["geometry"] = {"type": "Point", "coordinates": [doc["longitude"], doc["latitude"]]}
+    return docs
+
+
+KEYS = {
+    "yield": ["crop_name", "adm_id", "harvest_year"],
+    "districts": ["crop_name", "adm_id"],
+    "crop_mask": ["crop_name", "adm_id"],
+}
+
+
+async def load_crop(db, result, version):
+    """
+    Upserts one crop's documents in unordered bulk_write batches, then
+    removes documents left over from an older load of the same crop.
+    """
+    from pymongo import ReplaceOne
+
+    crop = result["crop"]
+    # Tells the yield change stream watcher that the aggregates hook below
+    # rebuilds this crop, so it doesn't refresh every row written here.
+    await begin_etl_load(db, crop, version)
+    try:
+        for collection, keys in KEYS.items():
+            frame = result[collection]
+            if frame is None:
+                continue
+            docs = _documents(collection, frame, version)
+            for start in range(0, len(docs), BATCH_SIZE):
+                batch = docs[start:start + BATCH_SIZE]
+                ops = [ReplaceOne({k: d[k] for k in keys}, d, upsert=True) for d in batch]
+                await db[collection].bulk_write(ops, ordered=False)
+            await db[collection].delete_many({"crop_name": crop, "etl_version": {"$ne": version}})
+            print(f"  {collection}: {len(docs)} documents")
+    except BaseException:
+        await abort_etl_load(db, crop)
+        raise
+    await cover_etl_load(db, crop)
+
+    for hook in POST_LOAD_HOOKS:
+        await hook(db, crop, result)
+
+
+async def ensure_indexes(db):
+    from pymongo import ASCENDING, GEOSPHERE
+
+    for collection, keys in KEYS.items():
+        await db[collection].create_index([(k, ASCENDING) for k in keys], unique=True)
+    await db["districts"].create_index([("geometry", GEOSPHERE)])
+
+
+def load_state():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state):
+    os.makedirs(os.path.dirname(STATE_FILE) or ".", exist_ok=True)
+    with open(STATE_FILE, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+async def run(crops=None, force=False, use_db=True, workers=None):
+    start = time.perf_counter()
+    crops = crops or list(CROP_CONFIG)
+    state = load_state()
+
+    pending = {}
+    for crop in crops:
+        if crop not in CROP_CONFIG:
+            print(f"Skipping {crop}: no entry in CROP_CONFIG")
+            continue
+        files = crop_inputs(crop)
+        if "districts" not in files and seed_districts(crop):
+            files = crop_inputs(crop)
+        missing = [s for s in ["yield", "crop_mask", *STATIC_SOURCES, *YEARLY_ORDER] if s not in files]
+        if missing:
+            print(f"Skipping {crop}: missing sources {missing}")
+            continue
+        version = crop_hash(crop, files)
+        if force or state.get(crop) != version:
+            pending[crop] = (files, version)
+        else:
+            print(f"{crop}: unchanged")
+
+    if not pending:
+        print("Nothing to do.")
+        return
+
+    db = None
+    if use_db:
+        load_dotenv()
+        import database
+        db = database.connect()
+        await ensure_indexes(db)
+
+    loop = asyncio.get_running_loop()
+    try:
+        with ProcessPoolExecutor(max_workers=workers or len(pending)) as pool:
+            futures = {crop: loop.run_in_executor(pool, build_crop, crop, files) for crop, (files, _) in pending.items()}
+            for crop, future in futures.items():
+                result = await future
+                version = pending[crop][1]
+                print(f"{crop}: {result['rows']} merged rows -> {result['merged_path']}")
+                # State tracks what is loaded in Mongo, so CSV-only runs don't record it.
+                if db is not None:
+                    await load_crop(db, result, version)
+                    state[crop] = version
+                    save_state(state)
+    finally:
+        if db is not None:
+            database.close()
+
+    print(f"Done in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild merged yearly CSVs and load MongoDB.")
+    parser.add_argument("--crops", nargs="*", help="Crops to process (default: all in CROP_CONFIG)")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if sources are unchanged")
+    parser.add_argument("--no-db", action="store_true", help="Only rebuild the CSVs")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per crop)")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.crops, args.force, not args.no_db, args.workers)))
@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, JSONResponse
+
+# Stand-in for the Cerebras chat completions API, for tests and benchmarks.
+#
+# Streams a canned recommendation as OpenAI-style chat.completion.chunk
+# server-sent events, one word per chunk, after FAKE_LLM_FIRST_TOKEN_MS and
+# then every FAKE_LLM_TOKEN_MS. Point the backend at it with
+#
+#   python fake_llm.py --port 8100
+#   LLM_BASE_URL=http://127.0.0.1:8100 CEREBRAS_API_KEY=fake uvicorn main:app
+#
+# GET /stats reports how many completions were requested.
+
+FIRST_TOKEN_MS = float(os.getenv("FAKE_LLM_FIRST_TOKEN_MS", 300))
+TOKEN_MS = float(os.getenv("FAKE_LLM_TOKEN_MS", 10))
+
+ANSWER = (
+    "Consider mustard or chickpea as a rabi alternative. "
+    "Soil: the loamy soil here holds moderate moisture, which suits deep rooted pulses. "
+    "Weather: low winter rainfall favours crops with lower water demand. "
+    "Other factors: rotating with a legume restores nitrogen and breaks pest cycles."
+)
+
+app = FastAPI()
+counts = {"completions": 0, "streams": 0, "active": 0}
+
+
+def chunk(completion_id, model, content=None, finish_reason=None):
+    delta = {"content": content} if content is not None else {}
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "system_fingerprint": "fake",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+@app.post("/v1/chat/completions")
+async def completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake")
+    counts["completions"] += 1
+    completion_id = f"chatcmpl-fake-{random.getrandbits(48):x}"
+    prompt = " ".join(m.get("content", "") for m in body.get("messages", []))
+    words = (ANSWER + f" (prompt {len(prompt)} chars)").split(" ")
+
+    if not body.get("stream"):
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "system_fingerprint": "fake",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+        })
+
+    async def events():
+        counts["streams"] += 1
+        counts["active"] += 1
+        try:
+            await asyncio.sleep(FIRST_TOKEN_MS / 1000)
+            for i, word in enumerate(words):
+                text = word if i == 0 else " " + word
+                yield f"data: {json.dumps(chunk(completion_id, model, text))}\n\n"
+                await asyncio.sleep(TOKEN_MS / 1000)
+            yield f"data: {json.dumps(chunk(completion_id, model, finish_reason='stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            counts["active"] -= 1
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def stats():
+    return counts
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake streaming chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
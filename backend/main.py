@@ -1,17 +1,66 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from dotenv import load_dotenv
 from routes.maps import router as maps_router
-from routes.predict import router as predict_router
+from routes.heatmaps import router as heatmap_router
+from routes.predict import router as predict_router, production_models
 from routes.dashboard import router as dashboard_router
 from routes.llm import router as llm_router
-from routes.predict_guj import router as guj_router
-from routes.complaint import router as complaint_router
+from routes.predict_guj import router as guj_router, gujarat_models
+from routes.complaint import router as complaint_router, ensure_complaint_indexes
+import database
+from core import metrics
+from core.aggregates import start_yield_watcher
+from core.spatial_index import district_index
+from core.outbox import start_outbox_dispatcher
+from core.model_registry import start_model_watcher
+from core.feature_store import open_feature_store
 
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One motor client (and connection pool) for the whole process.
+    db = database.connect()
+    # Keeps the materialized yield aggregates in step with yield writes.
+    watcher = start_yield_watcher(db)
+    # Open (or build) the feature store before serving; request handlers
+    # only read it and fail fast until it's there.
+    try:
+        await run_in_threadpool(open_feature_store)
+    except Exception as e:
+        print(f"Feature store not loaded at startup: {e}")
+    # Load the district index up front so the first lookup doesn't pay for it.
+    try:
+        await district_index.get(db)
+    except Exception as e:
+        print(f"District index not loaded at startup: {e}")
+    try:
+        await ensure_complaint_indexes(db)
+    except Exception as e:
+        print(f"Complaint indexes not created: {e}")
+    # Sends complaint notifications queued in the outbox.
+    dispatcher = start_outbox_dispatcher(db)
+    # Hot-swaps new model versions dropped into model/versions.
+    model_watcher = start_model_watcher([production_models, gujarat_models])
+    yield
+    if model_watcher:
+        model_watcher.cancel()
+    for registry in (production_models, gujarat_models):
+        registry.close()
+    if dispatcher:
+        await dispatcher.stop()
+    watcher.cancel()
+    database.close()
+
+app = FastAPI(lifespan=lifespan)
+
+if metrics.ENABLED:
+    app.add_middleware(metrics.TimingMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,6 +71,7 @@ app.add_middleware(
 )
 
 app.include_router(maps_router)
+app.include_router(heatmap_router)
 app.include_router(predict_router)
 app.include_router(dashboard_router)
 app.include_router(llm_router)
@@ -32,5 +82,9 @@ app.include_router(complaint_router)
 def read_root():
     return {"message": "API for SIH"}
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     uvicorn.run("main:app", port=8000, reload=True, host="0.0.0.0")
@@ -1,11 +1,14 @@
-from fastapi import APIRouter, status, HTTPException
+from fastapi import APIRouter, status, HTTPException, Header, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, BeforeValidator, ConfigDict, field_serializer
-from typing import Annotated
-from database import db
+from typing import Annotated, List
+from database import get_db
 from bson import ObjectId
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from core.metrics import stage
+from core import outbox
+import csv
+import io
+import json
 import os
 
 router = APIRouter(prefix="/complaint", tags=["complaint"])
@@ -35,6 +38,8 @@ class Complaint(BaseModel):
     def serialize_id(self, id: PyObjectId):
         return str(id)
 
+STATUS_PROJECTION = {"issue": 1, "crop": 1, "details": 1, "status": 1}
+
 class ComplaintStatus(BaseModel): # New model for status display
     id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
     issue: str
@@ -47,32 +52,86 @@ class ComplaintStatus(BaseModel): # New model for status display
     def serialize_id(self, id: PyObjectId):
         return str(id)
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
-def create_complaint(complaint: Complaint):
+# Fields officers get in listings and exports; Aadhaar is masked.
+LIST_FIELDS = ["_id", "name", "phone", "issue", "aadhaar", "pmfby", "crop", "details", "status"]
+LIST_PROJECTION = {f: 1 for f in LIST_FIELDS}
+MAX_BULK_IDS = 1000
+MAX_PAGE_SIZE = 500
+ADMIN_TOKEN = os.getenv("COMPLAINT_ADMIN_TOKEN")
+
+# Keyset pagination walks _id newest first within each filter combination.
+COMPLAINT_INDEXES = [
+    [("status", 1), ("crop", 1), ("_id", -1)],
+    [("status", 1), ("_id", -1)],
+    [("crop", 1), ("_id", -1)],
+    [("issue", 1), ("_id", -1)],
+]
+
+class BulkStatusRequest(BaseModel):
+    ids: List[str]
+
+def id_filter(ids):
   """
-  Receives complaint data and adds it to the 'complaints' collection in MongoDB.
+  _id filter for valid ObjectId strings. Also matches complaints stored
+  with a string _id by older versions, in case the migration hasn't run.
   """
-  complaint_data = complaint.model_dump(by_alias=True)
-  db.complaints.insert_one(complaint_data)
-
-  # Send email notification
-  try:
-      mail_username = os.getenv("MAIL_USERNAME")
-      mail_password = os.getenv("MAIL_PASSWORD")
-      mail_from = os.getenv("MAIL_FROM")
-      mail_to = os.getenv("MAIL_TO") # The recipient address
-      mail_server = os.getenv("MAIL_SERVER")
-      mail_port = int(os.getenv("MAIL_PORT", 587))
-
-      if not all([mail_username, mail_password, mail_from, mail_to, mail_server]):
-          print("Email configuration is incomplete. Skipping email notification.")
-      else:
-          message = MIMEMultipart()
-          message['From'] = mail_from
-          message['To'] = mail_to
-          message['Subject'] = f"New Complaint Registered: {complaint.issue}"
-
-          body = f"""
+  valid = [i for i in ids if ObjectId.is_valid(i)]
+  return {"_id": {"$in": [ObjectId(i) for i in valid] + valid}}
+
+def list_filter(crop, issue, status_, after):
+  query = {}
+  if crop:
+    query["crop"] = crop
+  if issue:
+    query["issue"] = issue
+  if status_:
+    query["status"] = status_
+  if after:
+    if not ObjectId.is_valid(after):
+      raise HTTPException(status_code=400, detail="Invalid cursor")
+    query["_id"] = {"$lt": ObjectId(after)}
+  return query
+
+def list_item(doc):
+  item = {f: doc.get(f, "") for f in LIST_FIELDS}
+  item["_id"] = str(item["_id"])
+  item["status"] = item["status"] or "complaint-registered"
+  aadhaar = str(item["aadhaar"])
+  item["aadhaar"] = "X" * max(len(aadhaar) - 4, 0) + aadhaar[-4:]
+  return item
+
+def require_admin(token):
+  if not ADMIN_TOKEN:
+    raise HTTPException(status_code=403, detail="Complaint listing is disabled; set COMPLAINT_ADMIN_TOKEN")
+  if token != ADMIN_TOKEN:
+    raise HTTPException(status_code=401, detail="Invalid admin token")
+
+async def ensure_complaint_indexes(db):
+  """
+  Creates the listing indexes and moves complaints stored with a string
+  _id (written before ids were stored as ObjectId) to ObjectId ids.
+  """
+  for keys in COMPLAINT_INDEXES:
+    await db.complaints.create_index(keys)
+  moved = 0
+  async for doc in db.complaints.find({"_id": {"$type": "string"}}):
+    if not ObjectId.is_valid(doc["_id"]):
+      continue
+    old_id = doc["_id"]
+    doc["_id"] = ObjectId(old_id)
+    await db.complaints.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+    await db.complaints.delete_one({"_id": old_id})
+    await db[outbox.OUTBOX_COLLECTION].update_many({"source_id": old_id}, {"$set": {"source_id": doc["_id"]}})
+    moved += 1
+  if moved:
+    print(f"Migrated {moved} complaints to ObjectId ids")
+
+def complaint_email(complaint: Complaint):
+  """
+  Subject and body of the notification sent to MAIL_TO.
+  """
+  subject = f"New Complaint Registered: {complaint.issue}"
+  body = f"""
           A new complaint has been registered.
 
           Details:
@@ -86,35 +145,122 @@ def create_complaint(complaint: Complaint):
           Details: {complaint.details}
           Status: {complaint.status}
           """
-          message.attach(MIMEText(body, 'plain'))
+  return subject, body
 
-          server = smtplib.SMTP(mail_server, mail_port)
-          server.starttls()
-          server.login(mail_username, mail_password)
-          text = message.as_string()
-          server.sendmail(mail_from, mail_to, text)
-          server.quit()
-          print("Email notification sent successfully.")
 
-  except Exception as e:
-      print(f"Failed to send email notification: {e}")
+@router.post("/", status_code=status.HTTP_201_CREATED)
+async def create_complaint(complaint: Complaint):
+  """
+  Receives complaint data and adds it to the 'complaints' collection in MongoDB.
+  The e-mail notification goes through the outbox, so it never waits on SMTP.
+  """
+  complaint_data = complaint.model_dump(by_alias=True)
+  # model_dump runs serialize_id; store the real ObjectId.
+  complaint_data["_id"] = complaint.id
+  db = get_db()
+  with stage("mongo"):
+    if outbox.dispatcher:
+      subject, body = complaint_email(complaint)
+      message = outbox.outbox_message("complaint_email", subject, body, "complaints", complaint_data["_id"])
+      await outbox.insert_with_outbox(db, "complaints", complaint_data, message)
+    else:
+      await db.complaints.insert_one(complaint_data)
+
+  if outbox.dispatcher:
+    outbox.dispatcher.notify()
 
   return {"message": "Complaint submitted successfully", "complaint_id": str(complaint.id)}
 
 
 @router.get("/check", response_model=ComplaintStatus)
-def get_complaint_data(complaint_id: str):
+async def get_complaint_data(complaint_id: str):
     """
     Retrieves the status of a complaint by its ID, excluding sensitive data.
     """
     if not ObjectId.is_valid(complaint_id):
         raise HTTPException(status_code=400, detail="Invalid Complaint ID format")
 
-    complaint_doc = db.complaints.find_one({"_id": complaint_id})
+    with stage("mongo"):
+        complaint_doc = await get_db().complaints.find_one(id_filter([complaint_id]), STATUS_PROJECTION)
 
     if complaint_doc:
         # Ensure status is present, assign default if not (for older entries)
         if "status" not in complaint_doc:
             complaint_doc["status"] = "complaint-registered"
         return ComplaintStatus(**complaint_doc)
-    raise HTTPException(status_code=404, detail="Complaint not found")
\ No newline at end of file
+    raise HTTPException(status_code=404, detail="Complaint not found")
+
+
+@router.post("/status", response_model=List[ComplaintStatus])
+async def get_complaint_statuses(body: BulkStatusRequest):
+    """
+    Statuses of many complaints in one query. Unknown or malformed IDs
+    are left out of the result.
+    """
+    if len(body.ids) > MAX_BULK_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_IDS} ids per request")
+
+    with stage("mongo"):
+        docs = await get_db().complaints.find(id_filter(body.ids), STATUS_PROJECTION).to_list(None)
+
+    for doc in docs:
+        doc.setdefault("status", "complaint-registered")
+    return [ComplaintStatus(**doc) for doc in docs]
+
+
+@router.get("/list")
+async def list_complaints(
+  crop: str | None = None,
+  issue: str | None = None,
+  status: str | None = None,
+  after: str | None = None,
+  limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+  x_admin_token: str | None = Header(None),
+):
+  """
+  Newest-first page of complaints for district officers. Pass the returned
+  next_cursor as `after` to get the following page.
+  """
+  require_admin(x_admin_token)
+  query = list_filter(crop, issue, status, after)
+  with stage("mongo"):
+    docs = await get_db().complaints.find(query, LIST_PROJECTION).sort("_id", -1).limit(limit).to_list(None)
+  items = [list_item(d) for d in docs]
+  next_cursor = items[-1]["_id"] if len(items) == limit else None
+  return {"items": items, "next_cursor": next_cursor}
+
+
+@router.get("/export")
+async def export_complaints(
+  format: str = Query("csv", pattern="^(csv|ndjson)$"),
+  crop: str | None = None,
+  issue: str | None = None,
+  status: str | None = None,
+  x_admin_token: str | None = Header(None),
+):
+  """
+  Streams every complaint matching the filters as CSV or NDJSON.
+  """
+  require_admin(x_admin_token)
+  query = list_filter(crop, issue, status, None)
+  cursor = get_db().complaints.find(query, LIST_PROJECTION).sort("_id", -1).batch_size(1000)
+
+  async def rows():
+    if format == "csv":
+      buf = io.StringIO()
+      writer = csv.DictWriter(buf, fieldnames=LIST_FIELDS)
+      writer.writeheader()
+      async for doc in cursor:
+        writer.writerow(list_item(doc))
+        if buf.tell() > 65536:
+          yield buf.getvalue()
+          buf.seek(0)
+          buf.truncate()
+      yield buf.getvalue()
+    else:
+      async for doc in cursor:
+        yield json.dumps(list_item(doc)) + "\n"
+
+  media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+  headers = {"Content-Disposition": f'attachment; filename="complaints.{format}"'}
+  return StreamingResponse(rows(), media_type=media_type, headers=headers)
@@ -1,109 +1,128 @@
-from fastapi import APIRouter
-from database import db
-from bson import Decimal128
+from fastapi import APIRouter, Request, Response
+from database import get_db
 import random
+import json
+import asyncio
+import hashlib
+import time
 from core.constant import CROPS
+from core.aggregates import get_version, yield_aggregates, CHECK_SECONDS
+from core.metrics import stage
+from core.prediction_grid import prediction_grid, PREDICTIONS_COLLECTION
 
 router = APIRouter(prefix="/dashboard", tags=["dashboard"])
 
-def to_float(v):
-    if v is None:
-        return 0.0
-    if isinstance(v, (int, float)):
-        return float(v)
-    if isinstance(v, Decimal128):
-        return float(v.to_decimal())
-    try:
-        return float(v)
-    except:
-        return 0.0
+FARM_COMPARISON_LIMIT = 75
 
-def normalize(lst):
-    out = []
-    for doc in lst:
-        d = dict(doc)
-        for k,v in d.items():
-            if isinstance(v, Decimal128):
-                d[k] = float(v.to_decimal())
-        out.append(d)
-    return out
 
+async def build_summary():
+  """
+  Builds the dashboard summary from the in-memory yield aggregates and
+  prediction grid, without touching the yield collection.
+  """
+  aggregates = await yield_aggregates.get(get_db())
 
-@router.get("/summary")
-def summary():
-  trend_pipeline = [
-    {"$match": {"crop_name": {"$exists": True}, "harvest_year": {"$type": "int"}, "yield": {"$type": "number"}}},
-    {"$addFields": {"_crop": {"$toLower": "$crop_name"}}},
-    {"$match": {"_crop": {"$in": CROPS}}},
-    {"$group": {"_id": {"year": "$harvest_year", "crop": "$_crop"}, "totalYield": {"$sum": "$yield"}}},
-    {"$group": {"_id": "$_id.year", "crops": {"$push": {"k": "$_id.crop", "v": "$totalYield"}}}},
-    {"$sort": {"_id": 1}}
-  ]
-
-  trend_raw = list(db["yield"].aggregate(trend_pipeline, allowDiskUse=True))
   avg_yield = 0
   yieldTrendData = []
-  c = 0
-  for r in trend_raw:
-      year_label = str(r["_id"])
-      crop_map = {c: 0 for c in CROPS}
-      for kv in r.get("crops", []):
-          crop_map[kv["k"]] = to_float(kv["v"]) # type: ignore
+  years = sorted({year for crop, year in aggregates.by_crop_year if crop in CROPS})
+  for year in years:
+      crop_map = {c: aggregates.by_crop_year.get((c, year), (0, 0.0))[1] for c in CROPS}
       avg_yield += crop_map.get("wheat", 0)
       avg_yield += crop_map.get("maize", 0)
       yieldTrendData.append({
-          "year": year_label,
+          "year": str(year),
           "wheat": crop_map.get("wheat", 0),
           "maize": crop_map.get("maize", 0),
       })
-      c += 1
-      
-
-  farm_pipeline = [
-    {"$match": {"adm_id": {"$exists": True}, "yield": {"$type": "number"}}},
-    {"$group": {"_id": "$adm_id", "totalYield": {"$sum": "$yield"}}},
-    {"$sort": {"totalYield": -1}},
-    {"$limit": 75}
-  ]
-
-  farm_raw = list(db["yield"].aggregate(farm_pipeline, allowDiskUse=True))
-  farmComparison = [{"name": f["_id"], "yield": to_float(f["totalYield"]), "target": to_float(f["totalYield"]) + random.randint(-10, 10)} for f in farm_raw]
-
-
-  crop_pipeline = [
-    {"$match": {"crop_name": {"$exists": True}, "yield": {"$type": "number"}}},
-    {"$addFields": {"_crop": {"$toLower": "$crop_name"}}},
-    {"$group": {"_id": "$_crop", "total": {"$sum": "$yield"}}},
-    {"$match": {"_id": {"$in": CROPS}}},
-    {"$group": {"_id": None, "totals": {"$push": {"crop": "$_id", "total": "$total"}}, "grandTotal": {"$sum": "$total"}}}
-  ]
-  crop_raw_list = list(db["yield"].aggregate(crop_pipeline, allowDiskUse=True))
-  crop_totals = crop_raw_list[0] if crop_raw_list else {"totals": [], "grandTotal": 0}
-  grand_total = to_float(crop_totals.get("grandTotal", 0))
+  c = len(years)
+
+  farms = sorted(aggregates.by_adm.items(), key=lambda item: (-item[1][1], item[0]))[:FARM_COMPARISON_LIMIT]
+  farmComparison = [{"name": adm_id, "yield": total, "target": total + random.randint(-10, 10)} for adm_id, (_, total) in farms]
+
+  crop_totals = [(crop, aggregates.by_crop[crop][1]) for crop in sorted(aggregates.by_crop) if crop in CROPS]
+  grand_total = sum(total for _, total in crop_totals)
   fill_map = {"wheat": "var(--color-chart-1)", "maize": "var(--color-chart-2)", "rice": "var(--color-chart-3)"}
   cropDistribution = []
-  for t in crop_totals.get("totals", []):
-      name = t["crop"].capitalize()
-      total = to_float(t["total"])
+  for crop, total in crop_totals:
       pct = round((total / grand_total) * 100) if grand_total else 0
-      cropDistribution.append({"name": name, "value": int(pct), "fill": fill_map.get(t["crop"], "")})
-
+      cropDistribution.append({"name": crop.capitalize(), "value": int(pct), "fill": fill_map.get(crop, "")})
 
-  variability_pipeline = [
-    {"$match": {"adm_id": {"$exists": True}, "yield": {"$type": "number"}}},
-    {"$group": {"_id": "$adm_id", "variability": {"$stdDevSamp": "$yield"}, "totalYield": {"$sum": "$yield"}, "count": {"$sum": 1}}},
-    {"$project": {"_id": 0, "zone": "$_id", "variability": {"$round": ["$variability", 2]}, "yield": "$totalYield"}},
-    {"$sort": {"variability": -1}},
-    {"$limit": 50}
-  ]
-  variabilityData = list(db["yield"].aggregate(variability_pipeline, allowDiskUse=True))
+  variabilityData = aggregates.stats.top(50)
+  predictions = await prediction_grid.get(get_db())
 
-  variabilityData = normalize(variabilityData)
-
-  return { 
+  return {
     "yield_trend": yieldTrendData,
+    "predicted_trend": predictions.trend(),
     "farm_comparison": farmComparison,
     "crop_distribution": cropDistribution,
     "variability": variabilityData,
-    "avg_yield": avg_yield // c
-  }
\ No newline at end of file
+    "avg_yield": avg_yield // c if c else 0
+  }
+
+
+class SummarySnapshot:
+  """
+  Serialized summary tagged with the yield data and predictions versions
+  it was built from.
+  When the version moves the old snapshot keeps being served while a new
+  one is built in the background.
+  """
+
+  def __init__(self):
+    self.version = None
+    self.body = b""
+    self.etag = ""
+    self.checked_at = 0.0
+    self.lock = asyncio.Lock()
+    self.rebuilding = None
+
+  async def _build(self, version):
+    body = json.dumps(await build_summary()).encode()
+    self.body = body
+    self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    self.version = version
+
+  async def _rebuild_in_background(self, version):
+    try:
+      await self._build(version)
+    except Exception as e:
+      print(f"Dashboard snapshot rebuild failed: {e}")
+    finally:
+      self.rebuilding = None
+
+  async def get(self):
+    now = time.monotonic()
+    if self.version is not None and now - self.checked_at < CHECK_SECONDS:
+      return self
+    async with self.lock:
+      version = (await get_version(get_db()), await get_version(get_db(), PREDICTIONS_COLLECTION))
+      self.checked_at = now
+      if self.version is None:
+        await self._build(version)
+      elif version != self.version and self.rebuilding is None:
+        # Keep a reference so the task isn't garbage collected mid-build.
+        self.rebuilding = asyncio.create_task(self._rebuild_in_background(version))
+    return self
+
+
+summary_snapshot = SummarySnapshot()
+
+
+@router.get("/summary")
+async def summary(request: Request):
+  with stage("summary"):
+    snapshot = await summary_snapshot.get()
+  headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+  if snapshot.etag in request.headers.get("if-none-match", ""):
+    return Response(status_code=304, headers=headers)
+  return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+
+@router.get("/variability")
+async def variability(crop: str | None = None, from_year: int | None = None, to_year: int | None = None, limit: int = 50):
+  """
+  Most variable districts, optionally for one crop and a year range.
+  """
+  with stage("aggregates"):
+    aggregates = await yield_aggregates.get(get_db())
+  return aggregates.stats.top(max(1, min(limit, 500)), crop, from_year, to_year)
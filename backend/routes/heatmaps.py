@@ -0,0 +1,89 @@
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from enum import Enum
+import os
+from core.heatmaps import HEATMAP_DIR, LAYERS, read_index, cog_path
+from core.metrics import stage
+
+router = APIRouter(prefix="/maps/heatmap", tags=["maps"])
+
+TILE_HEADERS = {"Cache-Control": "public, max-age=3600"}
+DEFAULT_COLORMAP = "rdylgn"
+
+Layer = Enum("Layer", {name: name for name in LAYERS}, type=str)
+
+
+class HeatmapIndex:
+    """
+    index.json from the heatmap build, re-read when the file changes.
+    """
+
+    def __init__(self, directory=HEATMAP_DIR):
+        self.path = os.path.join(directory, "index.json")
+        self.mtime = None
+        self.index = read_index(directory)
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return self.index
+        if mtime != self.mtime:
+            self.index = read_index(os.path.dirname(self.path))
+            self.mtime = mtime
+        return self.index
+
+
+heatmap_index = HeatmapIndex()
+
+
+def render_tile(path, band, z, x, y, value_range, colormap):
+    """
+    Windowed read of one web mercator tile from a COG, colour-mapped to
+    PNG. Returns None when the tile is outside the raster.
+    """
+    from rio_tiler.io import Reader
+    from rio_tiler.colormap import cmap
+    from rio_tiler.errors import TileOutsideBounds
+
+    try:
+        with Reader(path) as cog:
+            img = cog.tile(x, y, z, indexes=band)
+    except TileOutsideBounds:
+        return None
+    if value_range:
+        img.rescale(in_range=[tuple(value_range)])
+    return img.render(img_format="PNG", colormap=cmap.get(colormap))
+
+
+@router.get("")
+async def get_heatmaps():
+    """
+    Crops, years and layers with heatmaps, plus each layer's value range.
+    """
+    return heatmap_index.get()
+
+
+@router.get("/{layer}/{crop}/{year}/{z}/{x}/{y}.png")
+async def get_heatmap_tile(layer: Layer, crop: str, year: int, z: int, x: int, y: int, colormap: str = DEFAULT_COLORMAP):
+    """
+    PNG heatmap tile for one layer, crop and harvest year.
+    """
+    from rio_tiler.colormap import cmap
+
+    entry = heatmap_index.get()["crops"].get(crop.lower())
+    if entry is None or year not in entry["years"]:
+        raise HTTPException(status_code=404, detail=f"No heatmap for {crop} {year}")
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=404, detail=f"No tile {z}/{x}/{y}")
+    if colormap not in cmap.list():
+        raise HTTPException(status_code=400, detail=f"Unknown colormap {colormap!r}")
+
+    band = LAYERS.index(layer.value) + 1
+    value_range = entry["layers"].get(layer.value)
+    with stage("heatmap.tile"):
+        png = await run_in_threadpool(render_tile, cog_path(crop.lower(), year), band, z, x, y, value_range, colormap)
+
+    if png is None:
+        return Response(status_code=204, headers=TILE_HEADERS)
+    return Response(content=png, media_type="image/png", headers=TILE_HEADERS)
@@ -1,42 +1,114 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 import os
-from cerebras.cloud.sdk import Cerebras
+import time
+from cerebras.cloud.sdk import AsyncCerebras
+from core.llm_stream import StreamCache, LLMBusy, GenerationFailed
+from core.metrics import observe_stage, register_collector
 
 router = APIRouter(prefix='/llm', tags=['llm'])
 
-client = Cerebras(
-    api_key="csk-chrxcp8pc98wk2vj8nvc585m9f3vx3xvfh5jrfydh6td9p58"
+# LLM_BASE_URL points the client at another OpenAI-compatible server,
+# e.g. fake_llm.py for tests and benchmarks.
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-oss-120b")
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", 8192))
+
+# Answers are cached per question with lat/lon rounded to
+# LLM_CACHE_LATLON_DECIMALS (1 ~ 11 km) and the yield to LLM_CACHE_YIELD_BUCKET.
+LATLON_DECIMALS = int(os.getenv("LLM_CACHE_LATLON_DECIMALS", 1))
+YIELD_BUCKET = float(os.getenv("LLM_CACHE_YIELD_BUCKET", 0.25))
+
+client = None
+if os.getenv("CEREBRAS_API_KEY"):
+    client = AsyncCerebras(api_key=os.getenv("CEREBRAS_API_KEY"), base_url=os.getenv("LLM_BASE_URL") or None)
+else:
+    print("CEREBRAS_API_KEY is not set. /llm/analysis is disabled.")
+
+answers = StreamCache(
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("LLM_CACHE_TTL", 86400)),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8)),
+    queue_timeout=float(os.getenv("LLM_QUEUE_SECONDS", 10)),
 )
+register_collector("llm", answers.stats)
 
-@router.get("/analysis")
-def ai_analysis(lat: float, lon: float, crop_name: str, predicted_yield: float):
-    prompt = f"""
-Given the following data:
-- Location: ({lat}, {lon})
-- Crop: {crop_name}
-- Predicted Yield: {predicted_yield}
 
-Concisely recommend other suitable crops for this area for a better yield. Justify your answer with brief points on soil, weather, and other key factors.
-Give the output which does use any markdown format.
-"""
+def question_key(lat: float, lon: float, crop_name: str, predicted_yield: float):
+    bucket = round(predicted_yield / YIELD_BUCKET) * YIELD_BUCKET if YIELD_BUCKET > 0 else predicted_yield
+    return (round(lat, LATLON_DECIMALS), round(lon, LATLON_DECIMALS), crop_name.strip().lower(), round(bucket, 4))
+
 
-    def generate():
-        stream = client.chat.completions.create(
+def completion(prompt: str):
+    async def generate():
+        # The body streams after the response has started, so these only
+        # go to /metrics, not Server-Timing.
+        start = time.perf_counter()
+        first = None
+        stream = await client.chat.completions.create( # type: ignore
             messages=[
                 {
                     "role": "system",
                     "content": prompt
                 }
             ],
-            model="gpt-oss-120b",
+            model=LLM_MODEL,
             stream=True,
-            max_completion_tokens=65536,
+            max_completion_tokens=LLM_MAX_TOKENS,
             temperature=1,
             top_p=1,
             reasoning_effort="medium"
         )
-        for chunk in stream:
-            yield chunk.choices[0].delta.content or ""
+        async for chunk in stream:
+            if first is None:
+                first = time.perf_counter()
+                observe_stage("llm.first_token", first - start)
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+        observe_stage("llm.stream", time.perf_counter() - start)
+
+    return generate
+
+
+@router.get("/analysis")
+async def ai_analysis(lat: float, lon: float, crop_name: str, predicted_yield: float):
+    if client is None:
+        raise HTTPException(status_code=503, detail="LLM analysis is not configured")
+
+    key = question_key(lat, lon, crop_name, predicted_yield)
+    # The prompt uses the rounded values so one answer fits every question in the bucket.
+    q_lat, q_lon, q_crop, q_yield = key
+    prompt = f"""
+Given the following data:
+- Location: ({q_lat}, {q_lon})
+- Crop: {q_crop}
+- Predicted Yield: {q_yield}
+
+Concisely recommend other suitable crops for this area for a better yield. Justify your answer with brief points on soil, weather, and other key factors.
+Give the output which does use any markdown format.
+"""
+
+    try:
+        chunks = await answers.open(key, completion(prompt))
+    except LLMBusy as e:
+        raise HTTPException(status_code=503, detail=f"LLM analysis is busy, try again shortly ({e})", headers={"Retry-After": "5"})
+
+    # Wait for the first chunk so an upstream failure before any output is
+    # still a proper error status. A failure after that raises out of the
+    # body, which aborts the response instead of ending it cleanly.
+    try:
+        first = await anext(chunks, None)
+    except GenerationFailed as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    async def body():
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+
+    return StreamingResponse(body(), media_type="text/event-stream")
+
 
-    return StreamingResponse(generate(), media_type="text/event-stream")
+@router.get("/cache")
+async def llm_cache_stats():
+    return answers.stats()
@@ -1,9 +1,16 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field, BeforeValidator, AfterValidator, ConfigDict, field_serializer
 from pydantic_core import CoreSchema, PydanticCustomError, core_schema
-from bson import ObjectId, Decimal128
-from typing import List, Annotated
-from database import db
+from bson import ObjectId
+from typing import List, Annotated, Tuple
+import os
+from database import get_db, analytics
+from core.aggregates import yield_aggregates
+from core.prediction_grid import prediction_grid
+from core.spatial_index import district_index, NoDistrictNearby, MAX_DISTANCE_KM
+from core.metrics import stage, register_collector
+from core.vector_tiles import TileLayer, district_attributes, tile_cache, valid_tile
 from typing import Union
 from enum import Enum
 
@@ -25,6 +32,8 @@ class District(BaseModel):
     longitude : float
     region_area : int
     avg_yield: float
+    predicted_yield: float | None = None
+    prediction_year: int | None = None
     model_config = ConfigDict(arbitrary_types_allowed=True, populate_by_name=True)
 
     @field_serializer("id")
@@ -36,74 +45,132 @@ class Crops(str, Enum):
     wheat = "wheat"
     maize = "maize"
 
-def normalize(lst):
-    out = []
-    for doc in lst:
-        d = dict(doc)
-        for k,v in d.items():
-            if isinstance(v, Decimal128):
-                d[k] = float(v.to_decimal())
-        out.append(d)
-    return out
-
 router = APIRouter(prefix="/maps", tags=["maps"])
 
+DISTRICT_PROJECTION = {"crop_name": 1, "adm_id": 1, "latitude": 1, "longitude": 1, "region_area": 1}
+
 @router.get("/districts", response_model=List[District])
-def get_districts(crop: Crops | None = None):
+async def get_districts(crop: Crops | None = None, year: int | None = None):
   """
   Retrieves a list of districts from the database, optionally filtered by crop name.
+  predicted_yield comes from the offline prediction grid, for year or
+  the latest scored season.
   """
   query = {}
   if crop and crop != "all":
     query["crop_name"] = crop.value
 
-  results = list(db["districts"].find(query))
-
-  avg_yield = list(db["yield"].aggregate(
-        [
-            {"$group": {"_id": {"year": "$harvest_year", "crop": "$_crop"}, "avgYield": {"$avg": "$yield"}}},
-        ]
-        , allowDiskUse=True
+  with stage("mongo"):
+    results = await analytics("districts").find(query, DISTRICT_PROJECTION).to_list(None)
+
+  with stage("aggregates"):
+    average_yield = (await yield_aggregates.get(get_db())).average_yield
+    predictions = await prediction_grid.get(get_db())
+
+  districts = []
+  for document in results:
+    crop_name = document["crop_name"].lower()
+    prediction_year = year or predictions.latest_year.get(crop_name)
+    districts.append(District(
+      avg_yield=average_yield,
+      predicted_yield=predictions.predicted_yield(crop_name, document["adm_id"], prediction_year),
+      prediction_year=prediction_year,
+      **document,
     ))
-  average_yield = 0.0
-  for y in avg_yield:
-    average_yield += y["avgYield"]
-
-  return [District(avg_yield=average_yield, **document) for document in results]
+  return districts
 
 
 @router.get("/variability")
-def get_variability():
-    variability_pipeline = [
-        {"$match": {"adm_id": {"$exists": True}, "yield": {"$type": "number"}}},
-        {"$group": {
-            "_id": "$adm_id",
-            "variability": {"$stdDevSamp": "$yield"},
-            "totalYield": {"$sum": "$yield"},
-            "count": {"$sum": 1}
-        }},
-        {"$lookup": {
-            "from": "districts",
-            "localField": "_id",
-            "foreignField": "adm_id",
-            "as": "district_info"
-        }},
-        {"$unwind": "$district_info"},
-        {"$project": {
-            "_id": 0,
-            "adm_id": "$_id",
-            "zone": "$_id",
-            "variability": {"$round": ["$variability", 2]},
-            "yield": "$totalYield",
-            "latitude": "$district_info.latitude",
-            "longitude": "$district_info.longitude"
-        }},
-        {"$sort": {"variability": -1}},
-        {"$limit": 25}
+async def get_variability(crop: Crops | None = None, from_year: int | None = None, to_year: int | None = None, limit: int = 25):
+    """
+    Districts with the most variable yield (sample standard deviation),
+    from the in-memory yield statistics.
+    """
+    db = get_db()
+    with stage("aggregates"):
+        aggregates = await yield_aggregates.get(db)
+        index = await district_index.get(db)
+    crop_name = crop.value if crop and crop != "all" else None
+
+    # Like the old $lookup/$unwind, districts without a location are skipped.
+    centroids = index.centroids()
+    rows = aggregates.stats.top(max(1, min(limit, 500)), crop_name, from_year, to_year, where=centroids.__contains__)
+    variabilityData = [
+        {**row, "latitude": centroids[row["adm_id"]][0], "longitude": centroids[row["adm_id"]][1]}
+        for row in rows
     ]
 
-    variabilityData = list(db["yield"].aggregate(variability_pipeline, allowDiskUse=True))
-
-    variabilityData = normalize(variabilityData)
-
-    return variabilityData
\ No newline at end of file
+    return variabilityData
+
+
+REVERSE_GEOCODE_MAX_POINTS = int(os.getenv("REVERSE_GEOCODE_MAX_POINTS", 100000))
+
+class ReverseGeocodeRequest(BaseModel):
+    points: List[Tuple[float, float]] # (lat, lon)
+    crop: Crops | None = None
+    max_km: float = MAX_DISTANCE_KM
+
+@router.get("/nearest")
+async def get_nearest_districts(lat: float, lon: float, k: int = 1, crop: Crops | None = None, max_km: float = MAX_DISTANCE_KM):
+    """
+    Up to k districts nearest to a point, within max_km.
+    """
+    index = await district_index.get(get_db())
+    crop_name = crop.value if crop and crop != "all" else None
+    try:
+        return index.nearest(lat, lon, max(1, min(k, 100)), max_km, crop_name)
+    except NoDistrictNearby as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.post("/reverse-geocode")
+async def reverse_geocode(body: ReverseGeocodeRequest):
+    """
+    Resolves many (lat, lon) points to districts in one call. Points with
+    no district within max_km get an inline error.
+    """
+    if len(body.points) > REVERSE_GEOCODE_MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"At most {REVERSE_GEOCODE_MAX_POINTS} points per request")
+    index = await district_index.get(get_db())
+    crop_name = body.crop.value if body.crop and body.crop != "all" else None
+    lats = [p[0] for p in body.points]
+    lons = [p[1] for p in body.points]
+    results = await run_in_threadpool(index.locate_many, lats, lons, body.max_km, crop_name)
+    return {"count": len(results), "results": results}
+
+
+TILE_PROJECTION = {"_id": 0, "crop_name": 1, "adm_id": 1, "latitude": 1, "longitude": 1, "geometry": 1}
+TILE_HEADERS = {"Cache-Control": "public, max-age=300"}
+
+register_collector("map_tiles", tile_cache.stats)
+
+@router.get("/tiles/{z}/{x}/{y}.mvt")
+async def get_tile(z: int, x: int, y: int, crop: Crops | None = None):
+    """
+    Mapbox vector tile with a "districts" layer: district geometry plus
+    avg_yield, years, latest_year and latest_yield per district and crop.
+    """
+    if not valid_tile(z, x, y):
+        raise HTTPException(status_code=404, detail=f"No tile {z}/{x}/{y}")
+    crop_name = crop.value if crop and crop != "all" else None
+
+    db = get_db()
+    with stage("aggregates"):
+        aggregates = await yield_aggregates.get(db)
+        await district_index.get(db)
+    version = f"d{district_index.version}-y{aggregates.version}"
+
+    tile = await run_in_threadpool(tile_cache.get, version, crop_name, z, x, y)
+    if tile is None:
+        async def build():
+            docs = await analytics("districts").find({}, TILE_PROJECTION).to_list(None)
+            return await run_in_threadpool(TileLayer, docs, district_attributes(aggregates))
+
+        with stage("tiles.layer"):
+            layer = await tile_cache.layer_for(version, build)
+        with stage("tiles.render"):
+            tile = await run_in_threadpool(layer.render, z, x, y, crop_name)
+            await run_in_threadpool(tile_cache.put, version, crop_name, z, x, y, tile)
+
+    if not tile:
+        return Response(status_code=204, headers=TILE_HEADERS)
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=TILE_HEADERS)
@@ -1,34 +1,210 @@
-from fastapi import APIRouter
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
+from typing import Literal
+import numpy as np
 import pandas as pd
-import joblib
-from core.predict import TargetEncoder
-import sys
-from core.get_agri_data import get_agri_data
-from core.get_nearby_field import get_nearby_field
-from database import db
+import json
+from core.inference import compile_predictor
+from core.scenarios import axis_values, grid_column, grid_shape, summarize
+from core.batching import MicroBatcher
+from core.prediction_cache import PredictionCache
+from core.metrics import stage, register_collector
+from core.executor import InferenceExecutor
+from core.model_registry import ModelRegistry, ModelVersion, in_worker_process, load_production, model_dependency
+import asyncio
+import os
+from core.get_agri_data import lookup_agri_data
+from core.feature_store import FeatureStoreUnavailable
+from core.spatial_index import district_index, NoDistrictNearby, MAX_DISTANCE_KM
+from database import get_db
 from core.constant import CROPS
+from core.aggregates import yield_aggregates
 from datetime import datetime
 
 router = APIRouter(prefix="/predict", tags=["predict"])
 
-# This is a workaround for joblib/pickle unpickling issues
-# when a class was pickled in a __main__ context and unpickled
-# in a different __main__ context.
-sys.modules['__main__'].TargetEncoder = TargetEncoder # type: ignore
+# Known-good input used to verify the compiled fast path against the pipeline.
+SAMPLE_INPUT = {
+    "adm_id": "IN-14-0001",
+    "crop_name": "Wheat",
+    "awc": 12.0,
+    "bulk_density": 1.45,
+    "drainage_class": 3,
+    "ssm": 15.6,
+    "rsm": 326.0,
+    "ndvi": 0.3,
+    "tmin": 13.5,
+    "tmax": 25.1,
+    "prec": 0.0,
+    "rad": 16028750.0,
+    "tavg": 18.8,
+    "et0": 3.37,
+    "vpd": 2.09,
+    "cwb": -3.37,
+    "fpar": 0.21,
+    "harvest_area": 2000,
+    "harvest_year": 2020,
+    "crop_area_percentage": 0.7,
+}
 
-crop_mask_collection = db["crop_mask"]
+PREDICT_WORKERS = int(os.getenv("PREDICT_WORKERS", 0))
+# Batch sizes a new model version is scored on before it takes traffic.
+WARMUP_BATCH_SIZES = (1, 32, 1024)
 
 
-# Load the trained model and encoder
-try:
-    loaded_pipeline = joblib.load('model/final_production_pipeline.pkl')
-    loaded_encoder = joblib.load('model/target_encoder.pkl')
-except FileNotFoundError as e:
-    print(f"Error loading model files: {e}")
-    # Handle the error appropriately, maybe disable the endpoint
-    loaded_pipeline = None
-    loaded_encoder = None
+class ProductionModel:
+    """
+    One version of the production pipeline with its compiled fast path,
+    worker pool and micro-batcher. Built by production_models.
+    """
+
+    def __init__(self, name, paths):
+        self.pipeline, self.encoder = load_production(paths)
+        self.compiled = compile_predictor(self.pipeline, self.encoder, SAMPLE_INPUT)
+
+        # With PREDICT_WORKERS > 0 inference runs in a pool of worker
+        # processes, so it scales across cores. compile_predictor has already
+        # run the booster here, so the workers are spawned and each gets a
+        # copy of the compiled model.
+        self.executor = None
+        self.executor_key = f"production:{name}"
+        if self.compiled and PREDICT_WORKERS > 0:
+            self.executor = InferenceExecutor(PREDICT_WORKERS)
+            self.executor.register(self.executor_key, self.compiled)
+            self.executor.start()
+
+        # Concurrent single predictions are queued for up to
+        # PREDICT_MAX_WAIT_MS (or PREDICT_MAX_BATCH_SIZE rows) and scored
+        # together.
+        self.batcher = None
+        if os.getenv("PREDICT_BATCHING", "1") == "1":
+            self.batcher = MicroBatcher(
+                self.score,
+                max_batch_size=int(os.getenv("PREDICT_MAX_BATCH_SIZE", 64)),
+                max_wait_ms=float(os.getenv("PREDICT_MAX_WAIT_MS", 2)),
+                workers=self.executor.workers if self.executor else 1,
+            )
+
+    def predict_matrix(self, X):
+        if self.executor:
+            return self.executor.predict(self.executor_key, X)
+        return self.compiled.predict_matrix(X) # type: ignore
+
+    def score(self, rows: list) -> list:
+        """
+        Predicts production for a list of input dicts in one vectorized call.
+        """
+        if self.compiled:
+            with stage("encode"):
+                X = self.compiled.vectorize(rows)
+            with stage("model"):
+                production = self.predict_matrix(X)
+        else:
+            with stage("encode"):
+                X_encoded = self.encoder.transform(pd.DataFrame(rows))
+            with stage("model"):
+                production = self.pipeline.predict(X_encoded)
+        return [float(p) for p in production]
+
+    async def predict(self, data: dict) -> float:
+        """
+        Predicts production for one input dict, through the micro-batcher
+        when enabled. Never blocks the event loop.
+        """
+        if self.batcher:
+            return await asyncio.wrap_future(self.batcher.submit(data))
+        return (await run_in_threadpool(self.score, [data]))[0]
+
+    def close(self):
+        if self.batcher:
+            self.batcher.close()
+        if self.executor:
+            self.executor.shutdown()
+
+
+def warm_up_production(model: ProductionModel):
+    """
+    Scores synthetic batches around SAMPLE_INPUT through every path a
+    request can take, so a new version is compiled, its workers are up and
+    its results are sane before it takes traffic.
+    """
+    rng = np.random.default_rng(0)
+    for size in WARMUP_BATCH_SIZES:
+        rows = []
+        for jitter in rng.uniform(0.9, 1.1, size):
+            row = dict(SAMPLE_INPUT)
+            for col in ("ndvi", "fpar", "tavg", "prec", "ssm"):
+                row[col] = row[col] * jitter
+            rows.append(row)
+        production = np.asarray(model.score(rows), dtype=np.float64)
+        if len(production) != size or not np.all(np.isfinite(production)):
+            raise ValueError(f"Warm-up batch of {size} gave non-finite or missing predictions")
+    if model.batcher:
+        model.batcher.submit(SAMPLE_INPUT).result(timeout=30)
+
+
+# Serving (and optionally shadow) versions of the production model; see
+# core/model_registry.py. main.py starts the watcher that hot-swaps them.
+production_models = ModelRegistry(
+    "production",
+    ProductionModel,
+    warm_up=warm_up_production,
+)
+if not in_worker_process() and production_models.refresh() is None:
+    print("Error loading model files: no production model version found")
+use_production = model_dependency(production_models)
+
+
+# Results of /year and /my-field are cached per canonical input and model
+# version. PREDICT_CACHE_AREA_BUCKET > 1 rounds harvest_area to that step
+# before predicting, trading exactness for hit rate.
+AREA_BUCKET = int(os.getenv("PREDICT_CACHE_AREA_BUCKET", 1))
+
+prediction_cache = None
+if os.getenv("PREDICT_CACHE", "1") == "1":
+    prediction_cache = PredictionCache(
+        max_entries=int(os.getenv("PREDICT_CACHE_SIZE", 10000)),
+        ttl=float(os.getenv("PREDICT_CACHE_TTL", 3600)),
+        model_version=production_models.active.fingerprint if production_models.active else None,
+    )
+    # Entries from the previous version are dropped on a swap.
+    production_models.on_swap.append(lambda version: prediction_cache.set_model_version(version.fingerprint)) # type: ignore
+
+
+def batcher_stats():
+    active = production_models.active
+    if active is None or active.model.batcher is None:
+        return {}
+    return active.model.batcher.stats()
+
+
+register_collector("predict_batcher", batcher_stats)
+register_collector("model_registry_production", production_models.gauges)
+if prediction_cache:
+    register_collector("predict_cache", prediction_cache.stats)
+
+
+def cache_area(harvest_area: int) -> int:
+    if AREA_BUCKET <= 1:
+        return harvest_area
+    return max(AREA_BUCKET, round(harvest_area / AREA_BUCKET) * AREA_BUCKET)
+
+
+async def cached_prediction(key, compute):
+    if not prediction_cache:
+        return await compute()
+    return await prediction_cache.get_or_compute(key, compute, cacheable=lambda r: "error" not in r)
+
+
+def with_harvest_area(result: dict, harvest_area: int) -> dict:
+    """
+    Echoes the requested area, which can differ from the bucketed one.
+    """
+    if "error" in result:
+        return result
+    return {**result, "Harvest Area": harvest_area}
+
 
 def rename_response_keys(data_dict):
     rename_map = {
@@ -60,6 +236,46 @@ def rename_response_keys(data_dict):
             renamed_data[new_key] = value
     return renamed_data
 
+EXPLAIN_UNAVAILABLE = "Explanations need the compiled model. Check server logs."
+
+
+def explain_rows(model: ProductionModel, rows: list) -> list:
+    """
+    Per-feature contributions to predicted yield for each row, from the
+    booster's own TreeSHAP (pred_contribs). Each row's contributions plus
+    its "Base Value" add up to its predicted yield, up to float32 rounding.
+    """
+    with stage("encode"):
+        X = model.compiled.vectorize(rows) # type: ignore
+    with stage("explain"):
+        names, contributions, bias = model.compiled.explain_matrix(X) # type: ignore
+    explanations = []
+    for row, c, b in zip(rows, contributions, bias):
+        area = row["harvest_area"]
+        explanations.append({
+            "Base Value": float(b / area),
+            "Feature Contributions": {name: float(v / area) for name, v in zip(names, c)},
+        })
+    return explanations
+
+
+async def cached_grid_explanation(version: ModelVersion, crop_name: str, harvest_year: int, adm_id: str, area: int):
+    """
+    Attributions precomputed by the prediction grid job for this district
+    and year, when they were made with the same model version and harvest
+    area.
+    """
+    from core.prediction_grid import PREDICTIONS_COLLECTION
+
+    doc = await get_db()[PREDICTIONS_COLLECTION].find_one(
+        {"_id": f"{crop_name.lower()}|{harvest_year}|{adm_id}", "model_version": version.fingerprint, "harvest_area": area},
+        {"_id": 0, "base_value": 1, "contributions": 1},
+    )
+    if not doc or "contributions" not in doc:
+        return None
+    return {"Base Value": doc["base_value"], "Feature Contributions": doc["contributions"]}
+
+
 class PredictionInput(BaseModel):
     adm_id: str
     crop_name: str
@@ -83,95 +299,465 @@ class PredictionInput(BaseModel):
     crop_area_percentage: float
 
 @router.post("/")
-def predict_yield(input_data: PredictionInput):
+async def predict_yield(input_data: PredictionInput, explain: bool = False, version: ModelVersion | None = Depends(use_production)):
     """
     Predicts crop yield based on input data.
+    With explain, also returns each feature's contribution to the prediction.
     """
-    if not loaded_pipeline or not loaded_encoder:
+    if version is None:
         return {"error": "Model not loaded. Check server logs."}
+    model = version.model
+    if explain and not model.compiled:
+        return {"error": EXPLAIN_UNAVAILABLE}
 
     try:
-        new_data = pd.DataFrame([input_data.model_dump()])
-        
-        # The TargetEncoder expects the original column name to be present for transformation
-        # and then it drops it.
-        X_new_encoded = loaded_encoder.transform(new_data)
-        
-        production = loaded_pipeline.predict(X_new_encoded)
+        data = input_data.model_dump()
+        with stage("inference"), version.timed():
+            production = await model.predict(data)
+        production_models.shadow_score([data], [production])
 
-        predicted_yield = float(float(production[0]) / input_data.harvest_area)
+        predicted_yield = float(production / input_data.harvest_area)
 
+        if explain:
+            explanation = (await run_in_threadpool(explain_rows, model, [data]))[0]
+            return {"Predicted Yield": predicted_yield, **explanation}
         return {"Predicted Yield": predicted_yield}
 
     except Exception as e:
         return {"error": f"Error during prediction: {e}"}
 
 @router.post("/year")
-def predict_yield_with_year(lat: float, lon: float, harvest_area: int, adm_id:str, crop_name:str, harvest_year: int):
+async def predict_yield_with_year(lat: float, lon: float, harvest_area: int, adm_id:str, crop_name:str, harvest_year: int, explain: bool = False, version: ModelVersion | None = Depends(use_production)):
     """
     Predicts crop yield based on input data.
+    With explain, also returns each feature's contribution to the prediction.
     """
-    if not loaded_pipeline or not loaded_encoder:
+    if version is None:
         return {"error": "Model not loaded. Check server logs."}
+    model = version.model
+    if explain and not model.compiled:
+        return {"error": EXPLAIN_UNAVAILABLE}
 
-    data = get_agri_data(lat, lon)
-    cap = crop_mask_collection.find_one({ "adm_id": adm_id })
-    avg_yield = list(db["yield"].aggregate(
-        [
-            {"$group": {"_id": {"year": "$harvest_year", "crop": "$_crop"}, "avgYield": {"$avg": "$yield"}}},
-        ]
-        , allowDiskUse=True
-    ))
-    average_yield = 0.0
-    for y in avg_yield:
-        average_yield += y["avgYield"]
-    data["harvest_area"] = harvest_area
-    data["adm_id"] = adm_id
-    data["harvest_year"] = harvest_year
-    data["crop_name"] = crop_name
-    data["crop_area_percentage"] = cap["crop_area_percentage"] if cap else 0.5
+    with stage("aggregates"):
+        aggregates = await yield_aggregates.get(get_db())
+    area = cache_area(harvest_area)
 
-    try:
-        new_data = pd.DataFrame([data])
-        X_new_encoded = loaded_encoder.transform(new_data)
-        production = loaded_pipeline.predict(X_new_encoded)
-        predicted_yield = float(float(production[0]) / data["harvest_area"])
+    async def compute():
+        try:
+            with stage("features"):
+                data, quality = lookup_agri_data(lat, lon, crop_name, harvest_year, adm_id)
+        except KeyError as e:
+            return {"error": f"No agri data for this district: {e}"}
+        except FeatureStoreUnavailable as e:
+            return {"error": str(e)}
+        data["harvest_area"] = area
+        data["adm_id"] = adm_id
+        data["harvest_year"] = harvest_year
+        data["crop_name"] = crop_name
+        data["crop_area_percentage"] = quality["crop_area_percentage"]
 
-        response_data = rename_response_keys(data)
-        return {"Predicted Yield": predicted_yield, **response_data, "Average Yield": average_yield}
+        try:
+            with stage("inference"), version.timed():
+                production = await model.predict(data)
+            production_models.shadow_score([data], [production])
+            predicted_yield = float(production / data["harvest_area"])
 
-    except Exception as e:
-        return {"error": f"Error during prediction: {e}"}
+            explanation = {}
+            if explain:
+                explanation = await cached_grid_explanation(version, crop_name, harvest_year, adm_id, area)
+                if explanation is None:
+                    explanation = (await run_in_threadpool(explain_rows, model, [data]))[0]
+
+            response_data = rename_response_keys(data)
+            return {"Predicted Yield": predicted_yield, **response_data, "Average Yield": aggregates.average_yield, "Imputed Features": quality["imputed"], **explanation}
+
+        except Exception as e:
+            return {"error": f"Error during prediction: {e}"}
+
+    # lat/lon don't matter once adm_id is given; the aggregates version keys
+    # "Average Yield". The model version keeps a request that started on the
+    # previous version during a swap from caching its result for the new one.
+    key = ("year", adm_id, crop_name, harvest_year, area, aggregates.version, explain, version.fingerprint)
+    return with_harvest_area(await cached_prediction(key, compute), harvest_area)
 
 @router.post("/my-field")
-def predict_yield_for_my_field(lat: float, lon: float, harvest_area: int, crop_name:str, crop_area_percentage: float = 0.5):
-    if not loaded_pipeline or not loaded_encoder:
+async def predict_yield_for_my_field(lat: float, lon: float, harvest_area: int, crop_name:str, crop_area_percentage: float = 0.5, version: ModelVersion | None = Depends(use_production)):
+    if version is None:
         return {"error": "Model not loaded. Check server logs."}
 
-    is_found = False
-    viewing_distance = 1000
-    while not is_found:
-        field = get_nearby_field(lat, lon, viewing_distance)
-        if field:
-           is_found = True
-        else:
-            viewing_distance *= 10
+    try:
+        with stage("district_index"):
+            index = await district_index.get(get_db())
+            field = index.locate(lat, lon, MAX_DISTANCE_KM, crop_name)
+    except NoDistrictNearby as e:
+        return {"error": str(e)}
 
     harvest_year = datetime.now().year
+    area = cache_area(harvest_area)
+
+    async def compute():
+        try:
+            with stage("features"):
+                data, quality = lookup_agri_data(lat, lon, crop_name, harvest_year, field["adm_id"])
+        except KeyError as e:
+            return {"error": f"No agri data for this district: {e}"}
+        except FeatureStoreUnavailable as e:
+            return {"error": str(e)}
+        data["harvest_area"] = area
+        data["adm_id"] = field["adm_id"]
+        data["harvest_year"] = harvest_year
+        data["crop_name"] = crop_name
+        data["crop_area_percentage"] = crop_area_percentage
+        try:
+            with stage("inference"), version.timed():
+                production = await version.model.predict(data)
+            production_models.shadow_score([data], [production])
+            predicted_yield = float(production / data["harvest_area"])
+            response_data = rename_response_keys(data)
+            return {"predicted_yield": predicted_yield, **response_data, "Imputed Features": quality["imputed"]}
+        except Exception as e:
+            return {"error": f"Error during prediction: {e}"}
+
+    # Every point that resolves to the same district shares the entry.
+    key = ("my-field", field["adm_id"], crop_name, harvest_year, area, crop_area_percentage, version.fingerprint)
+    return with_harvest_area(await cached_prediction(key, compute), harvest_area)
+
+
+@router.get("/grid/{crop_name}/{adm_id}")
+async def get_grid_prediction(crop_name: str, adm_id: str, harvest_year: int | None = None):
+    """
+    Offline prediction for a district and year (default: the latest scored
+    season) from the prediction grid, with its precomputed attributions.
+    No inference runs here.
+    """
+    from core.prediction_grid import PREDICTIONS_COLLECTION, prediction_grid
+
+    db = get_db()
+    grid = await prediction_grid.get(db)
+    year = harvest_year or grid.latest_year.get(crop_name.lower())
+    doc = await db[PREDICTIONS_COLLECTION].find_one({"_id": f"{crop_name.lower()}|{year}|{adm_id}"}, {"_id": 0, "scored_at": 0})
+    if not doc:
+        return {"error": f"No grid prediction for {adm_id} ({crop_name}, {year})"}
+    result = {
+        "Predicted Yield": doc["predicted_yield"],
+        "Harvest Area": doc["harvest_area"],
+        "Harvest Year": doc["year"],
+        "Model Version": doc["model_version"],
+    }
+    if "contributions" in doc:
+        result.update({"Base Value": doc["base_value"], "Feature Contributions": doc["contributions"]})
+    return result
+
+
+@router.get("/cache")
+def get_cache_stats():
+    """
+    Hit/miss/eviction counters of the prediction cache.
+    """
+    if not prediction_cache:
+        return {"enabled": False}
+    return {"enabled": True, **prediction_cache.stats()}
 
-    data = get_agri_data(lat, lon)
-    data["harvest_area"] = harvest_area
-    data["adm_id"] = field["adm_id"] # type: ignore
-    data["harvest_year"] = harvest_year
-    data["crop_name"] = crop_name
-    data["crop_area_percentage"] = crop_area_percentage
+
+def parse_batch_rows(raw: bytes, content_type: str):
+    """
+    Parses a batch body into a list of row dicts. Accepts a JSON array, or
+    NDJSON (one JSON object per line) when the content type says so.
+    Rows that are not valid JSON are returned as error strings so the
+    rest of the batch can still be scored.
+    """
+    text = raw.decode("utf-8")
+    if "ndjson" in content_type or "jsonl" in content_type:
+        rows = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                rows.append(f"Invalid JSON: {e}")
+        return rows
+
+    rows = json.loads(text)
+    if not isinstance(rows, list):
+        raise ValueError("Expected a JSON array of prediction inputs")
+    return rows
+
+
+def score_batch(model: ProductionModel, inputs):
+    """
+    Scores a list of validated PredictionInput rows in a single
+    vectorized predict call.
+    Returns one predicted yield (or error string) per input, in order.
+    """
+    rows = [i.model_dump() for i in inputs]
+    try:
+        production = model.score(rows)
+    except Exception:
+        if len(inputs) == 1:
+            raise
+        # Something in the batch broke the vectorized call,
+        # fall back to scoring row by row so only the bad rows fail.
+        results = []
+        for i in inputs:
+            try:
+                results.extend(score_batch(model, [i]))
+            except Exception as e:
+                results.append(f"Error during prediction: {e}")
+        return results
+
+    production_models.shadow_score(rows, production)
+    results = []
+    for i, p in zip(inputs, production):
+        if i.harvest_area == 0:
+            results.append("harvest_area must be non-zero")
+        else:
+            results.append(float(p / i.harvest_area))
+    return results
+
+
+@router.post("/batch")
+async def predict_yield_batch(request: Request, explain: bool = False, version: ModelVersion | None = Depends(use_production)):
+    """
+    Predicts crop yield for many rows at once.
+    The body is a JSON array of PredictionInput objects, or NDJSON with
+    content type application/x-ndjson (also accepted as a multipart upload
+    in a field named "file"). Invalid rows are reported inline and do not
+    abort the rest of the batch. With explain, every scored row also gets
+    its feature contributions, computed for the whole batch in one call.
+    """
+    if version is None:
+        return {"error": "Model not loaded. Check server logs."}
+    model = version.model
+    if explain and not model.compiled:
+        return {"error": EXPLAIN_UNAVAILABLE}
+
+    content_type = request.headers.get("content-type", "")
+    try:
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                return {"error": "Expected an NDJSON or JSON file in the 'file' field"}
+            name = upload.filename or ""
+            upload_type = upload.content_type or ""
+            if name.endswith((".ndjson", ".jsonl")):
+                upload_type = "application/x-ndjson"
+            rows = parse_batch_rows(await upload.read(), upload_type)
+        else:
+            rows = parse_batch_rows(await request.body(), content_type)
+    except (ValueError, UnicodeDecodeError) as e:
+        return {"error": f"Invalid batch body: {e}"}
+
+    results: list = [None] * len(rows)
+    valid_idx = []
+    valid_inputs = []
+    for idx, row in enumerate(rows):
+        if isinstance(row, str):
+            results[idx] = {"index": idx, "error": row}
+            continue
+        try:
+            valid_inputs.append(PredictionInput.model_validate(row))
+            valid_idx.append(idx)
+        except ValidationError as e:
+            results[idx] = {"index": idx, "error": e.errors(include_url=False, include_input=False)}
+
+    if valid_inputs:
+        try:
+            with version.timed():
+                scored = await run_in_threadpool(score_batch, model, valid_inputs)
+        except Exception as e:
+            scored = [f"Error during prediction: {e}"] * len(valid_inputs)
+        for idx, value in zip(valid_idx, scored):
+            if isinstance(value, str):
+                results[idx] = {"index": idx, "error": value}
+            else:
+                results[idx] = {"index": idx, "Predicted Yield": value}
+
+        if explain:
+            scored = [(idx, i) for idx, i in zip(valid_idx, valid_inputs) if "error" not in results[idx]]
+            scored_idx = [idx for idx, _ in scored]
+            rows_to_explain = [i.model_dump() for _, i in scored]
+            if rows_to_explain:
+                try:
+                    explanations = await run_in_threadpool(explain_rows, model, rows_to_explain)
+                except Exception as e:
+                    explanations = [{"Explanation Error": str(e)}] * len(rows_to_explain)
+                for idx, explanation in zip(scored_idx, explanations):
+                    results[idx].update(explanation)
+
+    failed = sum(1 for r in results if "error" in r)
+    return {
+        "count": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "results": results,
+    }
+
+
+# Inputs a scenario axis may sweep.
+SCENARIO_FEATURES = [
+    "awc", "bulk_density", "drainage_class", "ssm", "rsm", "ndvi", "tmin", "tmax", "prec",
+    "rad", "tavg", "et0", "vpd", "cwb", "fpar", "harvest_area", "harvest_year", "crop_area_percentage",
+]
+SCENARIO_MAX_ROWS = int(os.getenv("SCENARIO_MAX_ROWS", 100000))
+
+
+class ScenarioAxis(BaseModel):
+    feature: str
+    values: list[float] | None = None
+    start: float | None = None
+    stop: float | None = None
+    steps: int = Field(5, ge=1, le=1000)
+    mode: Literal["absolute", "delta", "percent"] = "absolute"
+
+
+class ScenarioRequest(BaseModel):
+    """
+    Either a full base input, or adm_id/crop_name/harvest_year (plus
+    harvest_area) with the rest of the base taken from the feature store.
+    """
+    base: PredictionInput | None = None
+    adm_id: str | None = None
+    crop_name: str | None = None
+    harvest_year: int | None = None
+    harvest_area: int | None = None
+    axes: list[ScenarioAxis]
+    include_grid: bool = False
+
+
+def resolve_scenario_base(body: ScenarioRequest) -> dict:
+    if body.base is not None:
+        return body.base.model_dump()
+    if not (body.adm_id and body.crop_name and body.harvest_year and body.harvest_area):
+        raise ValueError("Give a base input, or adm_id, crop_name, harvest_year and harvest_area")
+    data, quality = lookup_agri_data(0, 0, body.crop_name, body.harvest_year, body.adm_id)
+    data["adm_id"] = body.adm_id
+    data["crop_name"] = body.crop_name
+    data["harvest_year"] = body.harvest_year
+    data["harvest_area"] = body.harvest_area
+    data["crop_area_percentage"] = quality["crop_area_percentage"]
+    return data
+
+
+def scenario_axes(base: dict, specs: list[ScenarioAxis]):
+    axes = []
+    for spec in specs:
+        if spec.feature not in SCENARIO_FEATURES:
+            raise ValueError(f"Can't sweep {spec.feature!r}; expected one of {SCENARIO_FEATURES}")
+        if any(col == spec.feature for col, _ in axes):
+            raise ValueError(f"{spec.feature!r} appears in more than one axis")
+        values = axis_values(base[spec.feature], spec.values, spec.start, spec.stop, spec.steps, spec.mode)
+        if spec.feature in ("drainage_class", "harvest_year"):
+            values = np.unique(np.round(values)).astype(np.int64)
+        if len(values) == 0:
+            raise ValueError(f"Axis {spec.feature!r} has no values")
+        axes.append((spec.feature, values.tolist()))
+    return axes
+
+
+def score_scenarios(model: ProductionModel, base: dict, axes):
+    """
+    Predicted yield for every combination of the axes, in np.indices
+    order, plus the yield of the base input.
+    """
+    if model.compiled:
+        with stage("encode"):
+            X = model.compiled.vectorize_grid(base, axes)
+            X = np.vstack([model.compiled.vectorize([base]), X])
+        with stage("model"):
+            production = model.predict_matrix(X)
+    else:
+        with stage("encode"):
+            shape = grid_shape(axes)
+            n = int(np.prod(shape))
+            frame = pd.DataFrame([base] * (n + 1))
+            index = np.indices(shape).reshape(len(shape), -1)
+            for (col, values), idx in zip(axes, index):
+                frame.loc[1:, col] = np.asarray(values)[idx]
+            X_encoded = model.encoder.transform(frame)
+        with stage("model"):
+            production = model.pipeline.predict(X_encoded)
+
+    production = np.asarray(production, dtype=np.float64)
+    areas = grid_column(axes, "harvest_area")
+    if areas is None:
+        areas = float(base["harvest_area"])
+    yields = production[1:] / areas
+    return float(production[0] / base["harvest_area"]), yields
+
+
+def run_scenarios(version: ModelVersion, body: ScenarioRequest) -> dict:
+    """
+    Resolves the base input, checks the axes and scores the grid. Blocking
+    (the feature store lookup and the model both run here), so the route
+    calls it in the threadpool.
+    """
     try:
-        new_data = pd.DataFrame([data])
-        X_new_encoded = loaded_encoder.transform(new_data)
-        production = loaded_pipeline.predict(X_new_encoded)
-        predicted_yield = float(float(production[0]) / data["harvest_area"])
-        response_data = rename_response_keys(data)
-        return {"predicted_yield": predicted_yield, **response_data}
+        with stage("features"):
+            base = resolve_scenario_base(body)
+        axes = scenario_axes(base, body.axes)
+    except KeyError as e:
+        return {"error": f"No agri data for this district: {e}"}
+    except (ValueError, FeatureStoreUnavailable) as e:
+        return {"error": str(e)}
+    if base["harvest_area"] == 0 or any(col == "harvest_area" and 0 in values for col, values in axes):
+        return {"error": "harvest_area must be non-zero"}
+
+    rows = int(np.prod(grid_shape(axes)))
+    if rows > SCENARIO_MAX_ROWS:
+        return {"error": f"Scenario grid has {rows} rows; at most {SCENARIO_MAX_ROWS} are allowed"}
+
+    try:
+        # Synthetic grids, so they aren't shadow scored.
+        with version.timed():
+            base_yield, yields = score_scenarios(version.model, base, axes)
     except Exception as e:
         return {"error": f"Error during prediction: {e}"}
 
+    result = {"base": base, **summarize(axes, yields, base_yield)}
+    if body.include_grid:
+        result["grid"] = {
+            "axes": [col for col, _ in axes],
+            "shape": list(grid_shape(axes)),
+            "predicted_yield": yields.tolist(),
+        }
+    return result
+
+
+@router.post("/scenarios")
+async def predict_scenarios(body: ScenarioRequest, version: ModelVersion | None = Depends(use_production)):
+    """
+    What-if sweep: predicted yield over the Cartesian product of the axes
+    around a base input, scored in one call and summarised as partial
+    dependence curves per axis and two-way tables per pair of axes.
+    Axis values are absolute, or deltas / percent changes from the base.
+    """
+    if version is None:
+        return {"error": "Model not loaded. Check server logs."}
+    if not body.axes:
+        return {"error": "Give at least one axis"}
+
+    return await run_in_threadpool(run_scenarios, version, body)
+
+
+@router.get("/batching")
+def get_batching_stats():
+    """
+    Queue depth and batch size histogram of the active version's
+    micro-batcher.
+    """
+    stats = batcher_stats()
+    if not stats:
+        return {"enabled": False}
+    return {"enabled": True, **stats}
+
+
+@router.get("/models")
+def get_model_versions():
+    """
+    Serving and shadow versions of the production model, with in-flight
+    requests per version and how far the shadow's predictions land from
+    the active one's.
+    """
+    return production_models.stats()
@@ -1,92 +1,144 @@
-from fastapi import APIRouter
-from pydantic import BaseModel, Field
-import pandas as pd
-import joblib
-import pandas as pd
-import pickle
-from xgboost import XGBRegressor
-from core.predict import TargetEncoder
-import sys
-from core.get_agri_data import get_agri_data
-from core.get_nearby_field import get_nearby_field
-from database import db
-from core.constant import CROPS
-import time
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, field_validator
+from typing import List
+import os
+import numpy as np
+from core.guj_predictor import GujaratPredictor, UnknownCrop
+from core.metrics import stage, register_collector
+from core.model_registry import MODEL_DIR, ModelRegistry, ModelVersion, in_worker_process, model_dependency, version_dir
 
 router = APIRouter(prefix="/predict-guj", tags=["predict-guj"])
 
-# This is a workaround for joblib/pickle unpickling issues
-# when a class was pickled in a __main__ context and unpickled
-# in a different __main__ context.
-
-crop_mask_collection = db["crop_mask"]
-
-
-model = XGBRegressor()
-model.load_model("model/xgb_crop_yield_model.json")
-
-with open("model/crop_label_encoder.pkl", "rb") as f:
-    le = pickle.load(f)
-
-def rename_response_keys(data_dict):
-    rename_map = {
-        "awc": "Available Water Capacity",
-        "bulk_density": "Bulk Density",
-        "drainage_class": "Drainage Class",
-        "ssm": "Surface Soil Moisture",
-        "rsm": "Root Zone Soil Moisture",
-        "ndvi": "NDVI",
-        "tmin": "Minimum Temperature",
-        "tmax": "Maximum Temperature",
-        "prec": "Precipitation",
-        "rad": "Solar Radiation",
-        "tavg": "Average Temperature",
-        "et0": "Reference Evapotranspiration",
-        "vpd": "Vapour Pressure Deficit",
-        "cwb": "Climatic Water Balance",
-        "fpar": "FPAR",
-        "harvest_area": "Harvest Area",
-        "adm_id": "District Id",
-        "harvest_year": "Harvest Year",
-        "crop_name": "Crop Name",
-        "crop_area_percentage": "Crop Area Percentage"
+
+def load_gujarat(name, paths):
+    # A version may ship its own dataset.csv (the label codes come from it).
+    dataset = os.path.join(version_dir(name), "dataset.csv")
+    if not os.path.exists(dataset):
+        dataset = os.path.join(MODEL_DIR, "dataset.csv")
+    return GujaratPredictor(paths[0], dataset)
+
+
+def warm_up_gujarat(predictor: GujaratPredictor):
+    """
+    Scores a synthetic batch so a new version is known to load and give
+    finite predictions before it takes traffic.
+    """
+    row = {col: 1.0 for col in predictor.raw_columns}
+    row["crop_name"] = next(iter(predictor.crops))
+    row["harvest_year"] = int(predictor.years[-1])
+    for size in (1, 256):
+        production = predictor.predict([row] * size)
+        if len(production) != size or not np.all(np.isfinite(production)):
+            raise ValueError(f"Warm-up batch of {size} gave non-finite or missing predictions")
+
+
+# Serving (and optionally shadow) versions of the Gujarat model; see
+# core/model_registry.py.
+gujarat_models = ModelRegistry(
+    "gujarat",
+    load_gujarat,
+    warm_up=warm_up_gujarat,
+    scorer=lambda predictor, fields: predictor.predict(fields),
+)
+if not in_worker_process() and gujarat_models.refresh() is None:
+    print("Error loading Gujarat model: no version found")
+use_gujarat = model_dependency(gujarat_models)
+register_collector("model_registry_gujarat", gujarat_models.gauges)
+
+MAX_BATCH_FIELDS = int(os.getenv("GUJ_MAX_BATCH_FIELDS", 100000))
+# Batches bigger than this are scored in a worker thread.
+THREADPOOL_FIELDS = 256
+
+
+class FieldInput(BaseModel):
+    """
+    One field, with the columns of model/dataset.csv.
+    """
+    lat: float
+    lon: float
+    adm_id: int
+    harvest_year: int
+    crop_name: str
+    harvest_area: float = Field(gt=0)
+    crop_area_percentage: float
+    awc: float
+    bulk_density: float
+    drainage_class: int
+    ssm: float
+    rsm: float
+    ndvi: float
+    tmin: float
+    tmax: float
+    tavg: float
+    prec: float
+    rad: float
+    et0: float
+    vpd: float
+    cwb: float
+    fpar: float
+
+    @field_validator("crop_name")
+    @classmethod
+    def known_crop(cls, v: str) -> str:
+        active = gujarat_models.active
+        if active is not None:
+            try:
+                active.model.crop_code(v)
+            except UnknownCrop as e:
+                raise ValueError(str(e))
+        return v.strip().lower()
+
+
+class FieldBatch(BaseModel):
+    fields: List[FieldInput]
+
+
+def field_result(production: float, harvest_area: float):
+    return {
+        "estimated_production": round(production, 2),
+        "estimated_yield": round(production / harvest_area, 3),
     }
-    renamed_data = {}
-    for key, value in data_dict.items():
-        if key != "crop_name":
-            new_key = rename_map.get(key, key)
-            renamed_data[new_key] = value
-    return renamed_data
+
 
 @router.post("/my-field")
-def predict_yield_for_my_field():
-    sample = {
-        "lat": 22.35,
-        "lon": 71.80,
-        "crop_name": "wheat",
-        "adm_id": 1234,
-        "harvest_year": 2021,
-        "harvest_area": 2.3,
-        "crop_area_percentage": 55,
-        "awc": 150,
-        "bulk_density": 1.3,
-        "drainage_class": 4,
-        "ssm": 22,
-        "rsm": 80,
-        "ndvi": 0.65,
-        "tmin": 14,
-        "tmax": 32,
-        "tavg": 23,
-        "prec": 12,
-        "rad": 18000,
-        "et0": 4.1,
-        "vpd": 1.3,
-        "cwb": -5,
-        "fpar": 0.72
-    }
-    time.sleep(2)
-    df = pd.DataFrame([sample])
-    df["crop_name"] = le.transform(df["crop_name"])
-    pred = model.predict(df)[0]
-    return {"estimated_production": round(pred, 2)}
+async def predict_yield_for_my_field(field: FieldInput, version: ModelVersion | None = Depends(use_gujarat)):
+    """
+    Production and yield (production per unit harvest area) for one field.
+    """
+    if version is None:
+        raise HTTPException(status_code=503, detail="Gujarat model is not loaded")
+    with stage("model"), version.timed():
+        production = float(version.model.predict([field])[0])
+    gujarat_models.shadow_score([field], [production])
+    return field_result(production, field.harvest_area)
+
+
+@router.post("/batch")
+async def predict_batch(body: FieldBatch, version: ModelVersion | None = Depends(use_gujarat)):
+    """
+    Scores many fields (e.g. a whole cooperative) in one vectorized call.
+    Results are in input order.
+    """
+    if version is None:
+        raise HTTPException(status_code=503, detail="Gujarat model is not loaded")
+    if len(body.fields) > MAX_BATCH_FIELDS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_FIELDS} fields per request")
+
+    with stage("model"), version.timed():
+        if len(body.fields) > THREADPOOL_FIELDS:
+            production = await run_in_threadpool(version.model.predict, body.fields)
+        else:
+            production = version.model.predict(body.fields)
+    gujarat_models.shadow_score(body.fields, production)
+
+    predictions = [field_result(p, f.harvest_area) for p, f in zip(production.tolist(), body.fields)]
+    return {"count": len(predictions), "predictions": predictions}
+
 
+@router.get("/models")
+def get_model_versions():
+    """
+    Serving and shadow versions of the Gujarat model.
+    """
+    return gujarat_models.stats()
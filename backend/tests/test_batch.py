@@ -0,0 +1,58 @@
+import pytest
+from routes.predict import SAMPLE_INPUT, PredictionInput, parse_batch_rows, score_batch
+
+
+class FakeModel:
+    """
+    Scores production as harvest_area * 2; a batch holding a row with
+    harvest_year -1 fails as a whole, the way one bad row can break the
+    vectorized call.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def score(self, rows):
+        self.calls.append(len(rows))
+        if any(row["harvest_year"] == -1 for row in rows):
+            raise ValueError("bad row")
+        return [row["harvest_area"] * 2.0 for row in rows]
+
+
+def inputs(*changes):
+    return [PredictionInput(**{**SAMPLE_INPUT, **change}) for change in changes]
+
+
+def test_parse_json_array():
+    assert parse_batch_rows(b'[{"a": 1}, {"a": 2}]', "application/json") == [{"a": 1}, {"a": 2}]
+
+
+def test_parse_json_rejects_a_single_object():
+    with pytest.raises(ValueError):
+        parse_batch_rows(b'{"a": 1}', "application/json")
+
+
+def test_parse_ndjson_reports_bad_lines_in_place():
+    rows = parse_batch_rows(b'{"a": 1}\n\nnot json\n{"a": 3}\n', "application/x-ndjson")
+    assert rows[0] == {"a": 1}
+    assert rows[1].startswith("Invalid JSON")
+    assert rows[2] == {"a": 3}
+
+
+def test_score_batch_uses_one_vectorized_call():
+    model = FakeModel()
+    assert score_batch(model, inputs({}, {"harvest_area": 500})) == [2.0, 2.0]
+    assert model.calls == [2]
+
+
+def test_score_batch_falls_back_to_single_rows():
+    model = FakeModel()
+    results = score_batch(model, inputs({}, {"harvest_year": -1}, {"harvest_area": 10}))
+    assert results[0] == 2.0
+    assert results[1] == "Error during prediction: bad row"
+    assert results[2] == 2.0
+    assert model.calls == [3, 1, 1, 1]
+
+
+def test_score_batch_rejects_zero_area():
+    assert score_batch(FakeModel(), inputs({"harvest_area": 0})) == ["harvest_area must be non-zero"]
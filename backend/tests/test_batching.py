@@ -0,0 +1,73 @@
+import threading
+import pytest
+from core.batching import MicroBatcher
+
+
+def doubling(calls):
+    def score(rows):
+        calls.append(list(rows))
+        if "bad" in rows:
+            raise ValueError("bad row")
+        return [row * 2 for row in rows]
+    return score
+
+
+def submit_together(batcher, rows):
+    """
+    Queues rows while the worker is held up, so they land in one batch.
+    """
+    gate = threading.Event()
+    blocker = batcher.submit(gate)
+    futures = [batcher.submit(row) for row in rows]
+    gate.set()
+    blocker.result(timeout=5)
+    return futures
+
+
+def gated(score):
+    # The first row is an Event to wait on; everything else goes to score.
+    def run(rows):
+        if isinstance(rows[0], threading.Event):
+            rows[0].wait(5)
+            return [None] + (score(rows[1:]) if len(rows) > 1 else [])
+        return score(rows)
+    return run
+
+
+def test_concurrent_rows_share_a_batch():
+    calls = []
+    batcher = MicroBatcher(gated(doubling(calls)), max_batch_size=64, max_wait_ms=50)
+    futures = submit_together(batcher, [1, 2, 3])
+    assert [f.result(timeout=5) for f in futures] == [2, 4, 6]
+    assert [1, 2, 3] in calls
+    batcher.close()
+
+
+def test_batch_is_capped_at_max_batch_size():
+    calls = []
+    batcher = MicroBatcher(gated(doubling(calls)), max_batch_size=2, max_wait_ms=50)
+    futures = submit_together(batcher, [1, 2, 3, 4, 5])
+    assert [f.result(timeout=5) for f in futures] == [2, 4, 6, 8, 10]
+    assert all(len(c) <= 2 for c in calls)
+    assert batcher.stats()["rows"] == 6
+    batcher.close()
+
+
+def test_failed_batch_falls_back_to_single_rows():
+    calls = []
+    batcher = MicroBatcher(gated(doubling(calls)), max_batch_size=64, max_wait_ms=50)
+    futures = submit_together(batcher, [1, "bad", 3])
+    assert futures[0].result(timeout=5) == 2
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) == 6
+    # The whole batch once, then each row on its own.
+    assert calls[-3:] == [[1], ["bad"], [3]]
+    batcher.close()
+
+
+def test_close_scores_queued_rows_first():
+    batcher = MicroBatcher(doubling([]), max_batch_size=4, max_wait_ms=1)
+    future = batcher.submit(21)
+    batcher.close()
+    assert future.result(timeout=5) == 42
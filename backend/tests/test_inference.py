@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from core.inference import CompiledPredictor, compile_predictor
+from train import PRODUCTION_COLUMNS, TARGET, ProductionTask
+
+NUMERIC = [c for c in PRODUCTION_COLUMNS if c not in ("adm_id", "crop_name")]
+
+
+@pytest.fixture(scope="module")
+def model():
+    """
+    A small production pipeline + TargetEncoder trained the way train.py
+    trains the real one, on synthetic districts.
+    """
+    rng = np.random.default_rng(0)
+    n = 600
+    frame = pd.DataFrame(rng.normal(size=(n, len(NUMERIC))), columns=NUMERIC)
+    frame["drainage_class"] = rng.integers(1, 6, n)
+    frame["harvest_year"] = rng.integers(2005, 2018, n)
+    frame["harvest_area"] = rng.uniform(100, 5000, n)
+    frame["adm_id"] = [f"IN-14-{i:04d}" for i in rng.integers(0, 40, n)]
+    frame["crop_name"] = rng.choice(["Wheat", "Maize", "Rice"], n)
+    frame[TARGET] = frame["harvest_area"] * (2 + frame["ndvi"]) + rng.normal(scale=50, size=n)
+    frame = frame[PRODUCTION_COLUMNS + [TARGET]]
+    fitted = ProductionTask(inner_folds=3).fit(frame, None, n_estimators=30, threads=1)
+    return fitted["pipeline"], fitted["encoder"], frame
+
+
+def rows_of(frame):
+    return frame[PRODUCTION_COLUMNS].to_dict("records")
+
+
+def expected(pipeline, encoder, rows):
+    return np.asarray(pipeline.predict(encoder.transform(pd.DataFrame(rows))))
+
+
+def test_predict_matrix_matches_pipeline(model):
+    pipeline, encoder, frame = model
+    predictor = CompiledPredictor(pipeline, encoder)
+    rows = rows_of(frame)
+    # Both the tree walk (small batches) and the booster (large ones).
+    for batch in (rows[:1], rows[:16], rows):
+        np.testing.assert_array_equal(predictor.predict_matrix(predictor.vectorize(batch)), expected(pipeline, encoder, batch))
+
+
+def test_unseen_adm_id_uses_global_mean(model):
+    pipeline, encoder, frame = model
+    predictor = CompiledPredictor(pipeline, encoder)
+    rows = [{**row, "adm_id": "IN-99-9999"} for row in rows_of(frame)[:20]]
+    X = predictor.vectorize(rows)
+    _, _, _, offset = next(s for s in predictor.slots if s[1] == predictor.encoded_col)
+    assert np.all(X[:, offset] == np.float32(encoder.global_mean))
+    np.testing.assert_array_equal(predictor.predict_matrix(X), expected(pipeline, encoder, rows))
+
+
+def test_missing_values_take_the_default_branch(model):
+    pipeline, encoder, frame = model
+    predictor = CompiledPredictor(pipeline, encoder)
+    rows = rows_of(frame)[:40]
+    for i, row in enumerate(rows):
+        row[NUMERIC[i % len(NUMERIC)]] = np.nan
+        row["ndvi"] = np.nan
+    for batch in (rows[:8], rows):
+        np.testing.assert_array_equal(predictor.predict_matrix(predictor.vectorize(batch)), expected(pipeline, encoder, batch))
+
+
+def test_unknown_crop_is_ignored_like_the_one_hot_encoder(model):
+    pipeline, encoder, frame = model
+    predictor = CompiledPredictor(pipeline, encoder)
+    rows = [{**row, "crop_name": "Sorghum"} for row in rows_of(frame)[:10]]
+    np.testing.assert_array_equal(predictor.predict_many(rows), expected(pipeline, encoder, rows))
+
+
+def test_compile_predictor_checks_parity(model):
+    pipeline, encoder, frame = model
+    assert compile_predictor(pipeline, encoder, rows_of(frame)[0]) is not None
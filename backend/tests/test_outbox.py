@@ -0,0 +1,196 @@
+import asyncio
+from datetime import timedelta
+import core.outbox as outbox
+from core.outbox import OUTBOX_COLLECTION, OutboxDispatcher, outbox_message, utcnow
+
+
+def matches(doc, query):
+    for field, cond in query.items():
+        value = doc.get(field)
+        if isinstance(cond, dict):
+            if "$in" in cond and value not in cond["$in"]:
+                return False
+            if "$lte" in cond and not (value is not None and value <= cond["$lte"]):
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+def apply(doc, update):
+    doc.update(update.get("$set", {}))
+    for field in update.get("$unset", {}):
+        doc.pop(field, None)
+
+
+class Cursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction=1):
+        self.docs.sort(key=lambda d: d[field], reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, length):
+        return [dict(d) for d in self.docs]
+
+
+class Collection:
+    """
+    The few motor collection calls the dispatcher makes, over a list.
+    """
+
+    def __init__(self):
+        self.docs = []
+
+    def find(self, query, projection=None):
+        return Cursor([d for d in self.docs if matches(d, query)])
+
+    async def update_many(self, query, update):
+        for d in self.docs:
+            if matches(d, query):
+                apply(d, update)
+
+    async def distinct(self, field, query):
+        return list({d[field] for d in self.docs if matches(d, query)})
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            for d in self.docs:
+                if matches(d, op._filter):
+                    apply(d, op._doc)
+
+
+class Database(dict):
+    def __missing__(self, name):
+        self[name] = Collection()
+        return self[name]
+
+
+class Sender:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.sent = []
+
+    def send_many(self, messages):
+        self.sent.extend(m["_id"] for m in messages)
+        return [self.results.pop(0) for _ in messages]
+
+
+OK = (True, False, None)
+TEMPORARY = (False, False, "421 try later")
+PERMANENT = (False, True, "550 no such user")
+
+
+def queue(db, n):
+    for i in range(n):
+        db[OUTBOX_COLLECTION].docs.append({**outbox_message("complaint", "s", "body", "complaints", i), "_id": i})
+        db["complaints"].docs.append({"_id": i})
+
+
+def by_id(db):
+    return {d["_id"]: d for d in db[OUTBOX_COLLECTION].docs}
+
+
+def test_claim_takes_a_bounded_batch_of_due_messages(monkeypatch):
+    monkeypatch.setattr(outbox, "BATCH_SIZE", 3)
+    db = Database()
+    queue(db, 5)
+    db[OUTBOX_COLLECTION].docs.append({**outbox_message("complaint", "s", "b", "complaints", 9), "_id": 9, "next_attempt_at": utcnow() + timedelta(hours=1)})
+    dispatcher = OutboxDispatcher(db, Sender())
+
+    first = asyncio.run(dispatcher.claim())
+    second = asyncio.run(dispatcher.claim())
+    assert len(first) == 3 and len(second) == 2
+    assert {m["_id"] for m in first + second} == {0, 1, 2, 3, 4}
+    assert all(m["status"] == "sending" for m in first + second)
+    assert first[0]["claim"] != second[0]["claim"]
+    # Leased, and message 9 isn't due yet.
+    assert asyncio.run(dispatcher.claim()) == []
+
+
+def test_dispatch_state_transitions():
+    db = Database()
+    queue(db, 3)
+    by_id(db)[2]["attempts"] = outbox.MAX_ATTEMPTS - 1
+    sender = Sender(OK, PERMANENT, TEMPORARY)
+    dispatcher = OutboxDispatcher(db, sender)
+
+    asyncio.run(dispatcher.dispatch(asyncio.run(dispatcher.claim())))
+    docs = by_id(db)
+    assert docs[0]["status"] == "sent" and "body" not in docs[0] and docs[0]["sent_at"]
+    assert docs[1]["status"] == "dead" and docs[1]["last_error"] == PERMANENT[2] and docs[1]["closed_at"]
+    # A temporary failure on the last allowed attempt is final too.
+    assert docs[2]["status"] == "dead" and docs[2]["attempts"] == outbox.MAX_ATTEMPTS
+    assert dispatcher.counts["sent"] == 1 and dispatcher.counts["dead"] == 2
+
+
+def test_temporary_failure_is_retried_later():
+    db = Database()
+    queue(db, 1)
+    dispatcher = OutboxDispatcher(db, Sender(TEMPORARY))
+    asyncio.run(dispatcher.dispatch(asyncio.run(dispatcher.claim())))
+    doc = by_id(db)[0]
+    assert doc["status"] == "pending" and doc["attempts"] == 1 and doc["body"] == "body"
+    assert doc["next_attempt_at"] > utcnow()
+    assert dispatcher.counts["retried"] == 1
+
+
+def test_message_without_its_document_waits_then_is_orphaned():
+    db = Database()
+    queue(db, 2)
+    db["complaints"].docs.clear()
+    by_id(db)[1]["created_at"] = utcnow() - timedelta(seconds=outbox.ORPHAN_SECONDS + 1)
+    sender = Sender()
+    dispatcher = OutboxDispatcher(db, sender)
+    asyncio.run(dispatcher.dispatch(asyncio.run(dispatcher.claim())))
+    docs = by_id(db)
+    assert docs[0]["status"] == "pending"
+    assert docs[1]["status"] == "orphaned" and docs[1]["closed_at"]
+    assert sender.sent == []
+
+
+def test_run_survives_errors_and_stops_on_cancel(monkeypatch):
+    monkeypatch.setattr(outbox, "POLL_SECONDS", 0.001)
+    db = Database()
+    queue(db, 1)
+
+    class Flaky(OutboxDispatcher):
+        failures = 2
+
+        async def claim(self):
+            if self.failures:
+                self.failures -= 1
+                raise KeyError("boom")
+            return await super().claim()
+
+    class IdleSender(Sender):
+        conn = None
+
+        def close_if_idle(self):
+            pass
+
+        def close(self):
+            pass
+
+    async def main():
+        db[OUTBOX_COLLECTION].create_index = _noop
+        dispatcher = Flaky(db, IdleSender(OK)).start()
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if dispatcher.counts["sent"]:
+                break
+        await dispatcher.stop()
+        return dispatcher
+
+    dispatcher = asyncio.run(main())
+    assert dispatcher.counts["sent"] == 1
+    assert dispatcher.task.cancelled()
+
+
+async def _noop(*args, **kwargs):
+    pass
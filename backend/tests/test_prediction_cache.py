@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+import core.prediction_cache as prediction_cache
+from core.prediction_cache import PredictionCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache, "time", clock)
+    return clock
+
+
+def test_concurrent_misses_are_coalesced():
+    cache = PredictionCache(model_version="v1")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"yield": 3.0}
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_compute("k", compute) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert results == [{"yield": 3.0}] * 5
+    assert len(calls) == 1
+    assert (cache.misses, cache.coalesced) == (1, 4)
+    assert cache.get("k") == {"yield": 3.0}
+
+
+def test_failures_are_shared_but_not_cached():
+    cache = PredictionCache()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("model down")
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_compute("k", compute) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert cache.get("k") is None
+    assert not cache.inflight
+
+
+def test_uncacheable_results_are_returned_not_stored():
+    cache = PredictionCache()
+
+    async def compute():
+        return {"error": "no data"}
+
+    result = asyncio.run(cache.get_or_compute("k", compute, cacheable=lambda r: "error" not in r))
+    assert result == {"error": "no data"}
+    assert cache.get("k") is None
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = PredictionCache(ttl=60)
+    cache.put("k", 1)
+    clock.now += 59
+    assert cache.get("k") == 1
+    clock.now += 2
+    assert cache.get("k") is None
+    assert cache.expirations == 1
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = PredictionCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.evictions == 1
+
+
+def test_model_change_drops_entries_and_late_results(clock):
+    cache = PredictionCache(model_version="v1")
+    cache.put("k", 1)
+    cache.set_model_version("v2")
+    assert cache.get("k") is None
+    # Computed against v1, finished after the swap.
+    cache.put("k", 1, version="v1")
+    assert cache.get("k") is None
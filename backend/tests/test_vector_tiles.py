@@ -0,0 +1,156 @@
+import struct
+import mercantile
+from core.vector_tiles import (
+    BUFFER, EXTENT, TileLayer, _clip_ring, _encode_polygon, _ring_area, _snap, _varint, _zigzag,
+    district_attributes,
+)
+
+
+def read_varint(buf, i):
+    n = shift = 0
+    while True:
+        byte = buf[i]
+        i += 1
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, i
+
+
+def fields(buf):
+    """
+    (field number, value) pairs of one protobuf message; length-delimited
+    values come back as bytes, fixed64 as a double.
+    """
+    out, i = [], 0
+    while i < len(buf):
+        key, i = read_varint(buf, i)
+        number, wire = key >> 3, key & 7
+        if wire == 0:
+            value, i = read_varint(buf, i)
+        elif wire == 1:
+            value, i = struct.unpack("<d", buf[i:i + 8])[0], i + 8
+        elif wire == 2:
+            length, i = read_varint(buf, i)
+            value, i = bytes(buf[i:i + length]), i + length
+        else:
+            raise ValueError(f"wire type {wire}")
+        out.append((number, value))
+    return out
+
+
+def packed(buf):
+    values, i = [], 0
+    while i < len(buf):
+        v, i = read_varint(buf, i)
+        values.append(v)
+    return values
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def test_varint_and_zigzag():
+    assert _varint(1) == b"\x01"
+    assert _varint(300) == b"\xac\x02"
+    assert [_zigzag(n) for n in (0, -1, 1, -2, 2)] == [0, 1, 2, 3, 4]
+
+
+def test_clip_ring_keeps_inside_and_cuts_at_the_box():
+    inside = [(10, 10), (20, 10), (20, 20), (10, 20)]
+    assert _clip_ring(inside, 0, 100) == inside
+    assert _clip_ring([(200, 200), (300, 200), (300, 300)], 0, 100) == []
+
+    clipped = _clip_ring([(-50, 10), (50, 10), (50, 20), (-50, 20)], 0, 100)
+    assert min(x for x, _ in clipped) == 0
+    assert abs(_ring_area(clipped)) == 500
+
+
+def test_snap_drops_repeated_and_closing_vertices():
+    assert _snap([(0.2, 0.1), (0.4, 0.3), (5.6, 0), (5.5, 0.4), (0, 0)]) == [(0, 0), (6, 0)]
+
+
+def test_polygon_winding_and_commands():
+    # Counter-clockwise on screen; exterior rings must come out clockwise.
+    ring = [(0, 0), (0, 10), (10, 10), (10, 0)]
+    commands = _encode_polygon([[ring]])
+    assert commands[0] == 9  # MoveTo x1
+    assert commands[3] == (2 | (3 << 3))  # LineTo x3
+    assert commands[-1] == 15  # ClosePath
+    x, y, points = 0, 0, []
+    for dx, dy in zip(commands[1:2] + commands[4:10:2], commands[2:3] + commands[5:10:2]):
+        x, y = x + unzigzag(dx), y + unzigzag(dy)
+        points.append((x, y))
+    assert len(points) == 4 and _ring_area(points) > 0
+    assert sorted(points) == sorted(ring)
+
+
+def test_degenerate_polygon_encodes_nothing():
+    assert _encode_polygon([[[(0, 0), (0.1, 0.1), (0.2, 0)]]]) == []
+
+
+def district(adm_id, lon, lat, size=None):
+    doc = {"adm_id": adm_id, "crop_name": "Wheat", "longitude": lon, "latitude": lat}
+    if size:
+        doc["geometry"] = {"type": "Polygon", "coordinates": [[
+            [lon - size, lat - size], [lon + size, lat - size], [lon + size, lat + size], [lon - size, lat + size], [lon - size, lat - size],
+        ]]}
+    return doc
+
+
+def test_render_encodes_one_layer_with_features_and_attributes():
+    attributes = {("IN-1", "wheat"): {"avg_yield": 3.5, "years": 4, "latest_year": None}}
+    layer = TileLayer([district("IN-1", 77.2, 28.6, 0.2), district("IN-2", 77.3, 28.7)], attributes)
+    tile = mercantile.tile(77.2, 28.6, 8)
+    data = layer.render(tile.z, tile.x, tile.y)
+
+    (number, payload), = fields(data)
+    assert number == 3
+    layer_fields = fields(payload)
+    assert (15, 2) in layer_fields and (1, b"districts") in layer_fields and (5, EXTENT) in layer_fields
+    features = [fields(v) for n, v in layer_fields if n == 2]
+    keys = [v.decode() for n, v in layer_fields if n == 3]
+    values = [fields(v)[0][1] for n, v in layer_fields if n == 4]
+
+    geom_types = sorted(dict(f)[3] for f in features)
+    assert geom_types == [1, 3]  # the centroid-only district is a point
+    polygon = next(dict(f) for f in features if dict(f)[3] == 3)
+    tags = packed(polygon[2])
+    props = {keys[k]: values[v] for k, v in zip(tags[::2], tags[1::2])}
+    assert props["adm_id"] == b"IN-1" and props["avg_yield"] == 3.5 and props["years"] == _zigzag(4)
+    assert "latest_year" not in props
+
+    # Polygon vertices stay within the buffered tile.
+    geometry = packed(polygon[4])
+    x = y = 0
+    i = 0
+    while i < len(geometry):
+        command, count = geometry[i] & 7, geometry[i] >> 3
+        i += 1
+        if command == 7:
+            continue
+        for _ in range(count):
+            x, y = x + unzigzag(geometry[i]), y + unzigzag(geometry[i + 1])
+            i += 2
+            assert -BUFFER <= x <= EXTENT + BUFFER and -BUFFER <= y <= EXTENT + BUFFER
+
+
+def test_render_filters_by_crop_and_skips_empty_tiles():
+    layer = TileLayer([district("IN-1", 77.2, 28.6, 0.2)], {})
+    tile = mercantile.tile(77.2, 28.6, 8)
+    assert layer.render(tile.z, tile.x, tile.y, crop="maize") == b""
+    far = mercantile.tile(-70.0, -30.0, 8)
+    assert layer.render(far.z, far.x, far.y) == b""
+
+
+def test_district_attributes_pool_cells():
+    class Aggregates:
+        cells = [
+            {"adm_id": "IN-1", "crop": "wheat", "year": 2019, "count": 2, "sum": 6.0},
+            {"adm_id": "IN-1", "crop": "wheat", "year": 2020, "count": 1, "sum": 4.5},
+        ]
+
+    assert district_attributes(Aggregates())[("IN-1", "wheat")] == {
+        "avg_yield": 3.5, "years": 2, "latest_year": 2020, "latest_yield": 4.5,
+    }
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from core.yield_stats import RunningStats, YieldStats
+
+
+def partition(values):
+    values = np.asarray(values, dtype=np.float64)
+    return len(values), float(values.mean()), float(((values - values.mean()) ** 2).sum())
+
+
+def test_merge_matches_the_pooled_sample():
+    rng = np.random.default_rng(0)
+    parts = [rng.normal(3, s, n) for s, n in ((0.5, 7), (2.0, 1), (1.0, 40), (0.1, 3))]
+    stats = RunningStats()
+    for p in parts:
+        stats.merge(*partition(p))
+    pooled = np.concatenate(parts)
+    assert stats.count == len(pooled)
+    assert stats.mean == pytest.approx(pooled.mean())
+    assert stats.variance == pytest.approx(pooled.var(ddof=1))
+    assert stats.std == pytest.approx(pooled.std(ddof=1))
+    assert stats.total == pytest.approx(pooled.sum())
+
+
+def test_merge_order_does_not_matter():
+    parts = [[1.0, 2.0], [10.0], [4.0, 4.5, 5.0]]
+    forward, backward = RunningStats(), RunningStats()
+    for p in parts:
+        forward.merge(*partition(p))
+    for p in reversed(parts):
+        backward.merge(*partition(p))
+    assert forward.variance == pytest.approx(backward.variance)
+
+
+def test_empty_and_single_row_partitions():
+    stats = RunningStats().merge(0, 0.0, 0.0)
+    assert stats.count == 0 and stats.variance is None
+    stats.merge(1, 5.0, 0.0)
+    assert stats.mean == 5.0 and stats.std is None
+
+
+def cell(adm_id, crop, year, values):
+    count, mean, m2 = partition(values)
+    return {"adm_id": adm_id, "crop": crop, "year": year, "count": count, "sum": mean * count, "m2": m2}
+
+
+CELLS = [
+    cell("A", "wheat", 2019, [1.0, 2.0]),
+    cell("A", "wheat", 2020, [8.0, 9.0]),
+    cell("B", "wheat", 2019, [3.0, 3.2]),
+    cell("B", "maize", 2020, [1.0, 6.0]),
+    cell("C", "wheat", 2020, [4.0]),
+]
+
+
+def test_top_ranks_by_pooled_std():
+    stats = YieldStats(CELLS)
+    wheat = stats.top(10, "Wheat")
+    assert [r["adm_id"] for r in wheat] == ["A", "B"]  # C has a single row
+    assert wheat[0]["variability"] == round(float(np.std([1, 2, 8, 9], ddof=1)), 2)
+    # Without a crop, each district's crops are pooled.
+    assert stats.top(1)[0]["adm_id"] == "A"
+    assert stats.top(10)[1]["count"] == 4
+
+
+def test_year_range_merges_only_cells_in_range():
+    stats = YieldStats(CELLS)
+    rows = stats.top(10, "wheat", from_year=2019, to_year=2019)
+    assert [r["adm_id"] for r in rows] == ["A", "B"]
+    assert rows[0]["variability"] == round(float(np.std([1, 2], ddof=1)), 2)
+
+
+def test_where_filters_districts():
+    stats = YieldStats(CELLS)
+    assert [r["adm_id"] for r in stats.top(10, "wheat", where=lambda adm_id: adm_id != "A")] == ["B"]
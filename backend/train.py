@@ -0,0 +1,462 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from core.constant import CROP_CONFIG
+from core.predict import TargetEncoder
+
+# Trains the model/ artifacts.
+#
+#   production: final_production_pipeline.pkl + target_encoder.pkl, fitted on
+#               final-data/<crop>/<merged_file> (the /predict model)
+#   gujarat:    xgb_crop_yield_model.json, fitted on model/dataset.csv
+#               (the /predict-guj model)
+#
+# adm_id is target encoded with out-of-fold encodings, so a row's encoding
+# never includes its own production. XGBoost trains with tree_method=hist on
+# all cores. K-fold cross-validation runs the folds in parallel processes
+# with early stopping on each held-out fold; the final model is then fitted
+# on every row for the median best iteration.
+#
+# --warm-start continues boosting the current model for --warm-rounds more
+# rounds instead of retraining, provided the data only gained harvest years
+# since the run recorded in the report. The run report (timings, per-fold
+# and cross-validated metrics, the rows per year it trained on) is written
+# to TRAIN_REPORT.
+#
+# --version <name> writes the artifacts and report to model/versions/<name>
+# instead, continuing from the version the registry is serving, so the API
+# picks the new version up and swaps it in (see core/model_registry.py).
+#
+#   python train.py [--tasks production gujarat] [--folds 5] [--jobs N] [--warm-start] [--version NAME]
+
+DATA_DIR = os.getenv("FINAL_DATA_DIR", "../final-data")
+MODEL_DIR = os.getenv("MODEL_DIR", "model")
+REPORT_PATH = os.getenv("TRAIN_REPORT", os.path.join(MODEL_DIR, "train_report.json"))
+SEED = 0
+
+XGB_PARAMS = {
+    "tree_method": "hist",
+    "objective": "reg:squarederror",
+    "learning_rate": 0.05,
+    "max_depth": 6,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "max_bin": 256,
+}
+
+PRODUCTION_COLUMNS = [
+    "adm_id", "crop_name", "awc", "bulk_density", "drainage_class", "ssm", "rsm", "ndvi",
+    "tmin", "tmax", "prec", "rad", "tavg", "et0", "vpd", "cwb", "fpar",
+    "harvest_area", "harvest_year", "crop_area_percentage",
+]
+GUJARAT_FEATURES = [
+    "harvest_area", "adm_id", "harvest_year_enc", "crop_name_enc", "crop_area_percentage",
+    "awc", "bulk_density", "drainage_class", "ssm", "rsm", "ndvi", "tmin", "tmax", "prec",
+    "rad", "tavg", "et0", "vpd", "cwb", "fpar",
+]
+TARGET = "production"
+
+
+def regression_metrics(y_true, y_pred, area):
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    area = np.asarray(area, dtype=np.float64)
+    err = y_pred - y_true
+    ss_tot = float(((y_true - y_true.mean()) ** 2).sum())
+    ok = area > 0
+    yield_err = err[ok] / area[ok]
+    return {
+        "rows": int(len(y_true)),
+        "rmse": float(np.sqrt((err ** 2).mean())),
+        "mae": float(np.abs(err).mean()),
+        "r2": 1 - float((err ** 2).sum()) / ss_tot if ss_tot else None,
+        "yield_rmse": float(np.sqrt((yield_err ** 2).mean())) if ok.any() else None,
+        "yield_mae": float(np.abs(yield_err).mean()) if ok.any() else None,
+    }
+
+
+def year_fingerprints(frame):
+    """
+    Content hash of the training rows of each harvest year, so a warm start
+    can tell "a year was added" from "past data changed".
+    """
+    out = {}
+    for year, rows in frame.groupby("harvest_year"):
+        rows = rows.sort_values(list(rows.columns)).reset_index(drop=True)
+        out[str(int(year))] = hashlib.sha256(pd.util.hash_pandas_object(rows, index=False).values.tobytes()).hexdigest()[:16]
+    return out
+
+
+def atomic_write(path, write):
+    """
+    Calls write(tmp_path) and moves the result over path, so readers never
+    see a half-written artifact.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write(tmp)
+        # mkstemp creates the file 0600; keep the permissions path had.
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _regressor(n_estimators, threads, early_stopping_rounds=None):
+    from xgboost import XGBRegressor
+
+    return XGBRegressor(
+        **XGB_PARAMS,
+        n_estimators=n_estimators,
+        n_jobs=threads,
+        random_state=SEED,
+        early_stopping_rounds=early_stopping_rounds,
+    )
+
+
+class ProductionTask:
+    """
+    TargetEncoder(adm_id) -> one-hot crop_name -> XGBoost on production.
+    """
+
+    name = "production"
+    artifacts = ["final_production_pipeline.pkl", "target_encoder.pkl"]
+
+    def __init__(self, data_dir=DATA_DIR, model_dir=MODEL_DIR, previous_dir=None, smoothing=10.0, inner_folds=5):
+        self.data_dir = data_dir
+        self.model_dir = model_dir
+        self.previous_dir = previous_dir or model_dir
+        self.smoothing = smoothing
+        self.inner_folds = inner_folds
+
+    def load(self):
+        frames = []
+        for crop, config in CROP_CONFIG.items():
+            path = os.path.join(self.data_dir, crop, config["merged_file"])
+            if os.path.exists(path):
+                frames.append(pd.read_csv(path, sep="\t"))
+        if not frames:
+            raise FileNotFoundError(f"No merged yearly CSVs under {self.data_dir}; run etl.py first")
+        df = pd.concat(frames, ignore_index=True)
+        df = df.dropna(subset=PRODUCTION_COLUMNS + [TARGET])
+        # Same spelling the API sends (see SAMPLE_INPUT in routes/predict.py).
+        df["crop_name"] = df["crop_name"].str.title()
+        return df[PRODUCTION_COLUMNS + [TARGET]].reset_index(drop=True)
+
+    def oof_encode(self, X, y):
+        """
+        Target encodes adm_id out of fold: each row is encoded by an
+        encoder fitted on the other folds.
+        """
+        from sklearn.model_selection import KFold
+
+        parts = []
+        for fit_idx, enc_idx in KFold(self.inner_folds, shuffle=True, random_state=SEED).split(X):
+            encoder = TargetEncoder("adm_id", self.smoothing).fit(X.iloc[fit_idx], y.iloc[fit_idx])
+            parts.append(encoder.transform(X.iloc[enc_idx]))
+        return pd.concat(parts).loc[X.index]
+
+    def _preprocessor(self):
+        from sklearn.compose import ColumnTransformer
+        from sklearn.preprocessing import OneHotEncoder
+
+        return ColumnTransformer(
+            [("cat", OneHotEncoder(handle_unknown="ignore"), ["crop_name"])],
+            remainder="passthrough",
+        )
+
+    def fit(self, train, valid, n_estimators, threads, early_stopping_rounds=None, previous=None):
+        from sklearn.pipeline import Pipeline
+
+        X, y = train[PRODUCTION_COLUMNS], train[TARGET]
+        encoder = TargetEncoder("adm_id", self.smoothing).fit(X, y)
+        X_encoded = self.oof_encode(X, y)
+        if previous is not None:
+            # Continue the old trees on the same feature layout.
+            preprocessor = previous["pipeline"].named_steps["preprocessor"]
+            base_model = previous["pipeline"].named_steps["regressor"].get_booster()
+        else:
+            preprocessor = self._preprocessor().fit(X_encoded)
+            base_model = None
+
+        fit_args = {"xgb_model": base_model}
+        if valid is not None:
+            X_valid = preprocessor.transform(encoder.transform(valid[PRODUCTION_COLUMNS]))
+            fit_args["eval_set"] = [(X_valid, valid[TARGET])]
+            fit_args["verbose"] = False
+        regressor = _regressor(n_estimators, threads, early_stopping_rounds)
+        regressor.fit(preprocessor.transform(X_encoded), y, **fit_args)
+        pipeline = Pipeline([("preprocessor", preprocessor), ("regressor", regressor)])
+        return {"pipeline": pipeline, "encoder": encoder}
+
+    def predict(self, model, frame):
+        return model["pipeline"].predict(model["encoder"].transform(frame[PRODUCTION_COLUMNS]))
+
+    def best_iteration(self, model):
+        return model["pipeline"].named_steps["regressor"].best_iteration
+
+    def save(self, model):
+        import joblib
+
+        paths = [os.path.join(self.model_dir, a) for a in self.artifacts]
+        atomic_write(paths[1], lambda p: joblib.dump(model["encoder"], p))
+        atomic_write(paths[0], lambda p: joblib.dump(model["pipeline"], p))
+        return paths
+
+    def load_previous(self):
+        import joblib
+
+        sys.modules['__main__'].TargetEncoder = TargetEncoder # type: ignore
+        try:
+            pipeline = joblib.load(os.path.join(self.previous_dir, self.artifacts[0]))
+            encoder = joblib.load(os.path.join(self.previous_dir, self.artifacts[1]))
+        except Exception as e:
+            print(f"{self.name}: previous model not loaded: {e}")
+            return None
+        return {"pipeline": pipeline, "encoder": encoder}
+
+
+class GujaratTask:
+    """
+    Field-level booster on model/dataset.csv, with crop_name and
+    harvest_year label encoded the way core/guj_predictor.py rebuilds them.
+    """
+
+    name = "gujarat"
+    artifacts = ["xgb_crop_yield_model.json"]
+
+    def __init__(self, dataset=os.path.join(MODEL_DIR, "dataset.csv"), model_dir=MODEL_DIR, previous_dir=None):
+        self.dataset = dataset
+        self.model_dir = model_dir
+        self.previous_dir = previous_dir or model_dir
+
+    def load(self):
+        df = pd.read_csv(self.dataset, sep="\t", index_col=0)
+        df = df.dropna(subset=[TARGET])
+        crops = sorted(df["crop_name"].str.lower().unique())
+        years = sorted(df["harvest_year"].unique())
+        df["crop_name_enc"] = df["crop_name"].str.lower().map({c: i for i, c in enumerate(crops)})
+        df["harvest_year_enc"] = df["harvest_year"].map({y: i for i, y in enumerate(years)})
+        return df[GUJARAT_FEATURES + ["harvest_year", TARGET]].reset_index(drop=True)
+
+    def fit(self, train, valid, n_estimators, threads, early_stopping_rounds=None, previous=None):
+        fit_args = {"xgb_model": previous.get_booster() if previous is not None else None}
+        if valid is not None:
+            fit_args["eval_set"] = [(valid[GUJARAT_FEATURES], valid[TARGET])]
+            fit_args["verbose"] = False
+        regressor = _regressor(n_estimators, threads, early_stopping_rounds)
+        regressor.fit(train[GUJARAT_FEATURES], train[TARGET], **fit_args)
+        return regressor
+
+    def predict(self, model, frame):
+        return model.predict(frame[GUJARAT_FEATURES])
+
+    def best_iteration(self, model):
+        return model.best_iteration
+
+    def save(self, model):
+        path = os.path.join(self.model_dir, self.artifacts[0])
+        atomic_write(path, model.save_model)
+        return [path]
+
+    def load_previous(self):
+        from xgboost import XGBRegressor
+
+        model = XGBRegressor()
+        try:
+            model.load_model(os.path.join(self.previous_dir, self.artifacts[0]))
+        except Exception as e:
+            print(f"{self.name}: previous model not loaded: {e}")
+            return None
+        return model
+
+
+TASKS = {"production": ProductionTask, "gujarat": GujaratTask}
+
+
+def run_fold(task, frame, fold, train_idx, valid_idx, n_estimators, early_stopping_rounds, threads):
+    start = time.perf_counter()
+    train, valid = frame.iloc[train_idx], frame.iloc[valid_idx]
+    model = task.fit(train, valid, n_estimators, threads, early_stopping_rounds)
+    predicted = task.predict(model, valid)
+    return {
+        "fold": fold,
+        "best_iteration": int(task.best_iteration(model)),
+        "seconds": time.perf_counter() - start,
+        "metrics": regression_metrics(valid[TARGET], predicted, valid["harvest_area"]),
+    }
+
+
+def cross_validate(task, frame, folds, jobs, n_estimators, early_stopping_rounds):
+    """
+    K-fold CV with every fold fitted in its own process, each with an
+    equal share of the cores.
+    """
+    from joblib import Parallel, delayed
+    from sklearn.model_selection import KFold
+
+    jobs = max(1, min(jobs, folds))
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    splits = KFold(folds, shuffle=True, random_state=SEED).split(frame)
+    results = Parallel(n_jobs=jobs)(
+        delayed(run_fold)(task, frame, i, tr, va, n_estimators, early_stopping_rounds, threads)
+        for i, (tr, va) in enumerate(splits)
+    )
+    summary = {}
+    for key in results[0]["metrics"]:
+        values = [r["metrics"][key] for r in results if r["metrics"][key] is not None]
+        if key != "rows" and values:
+            summary[key] = {"mean": float(np.mean(values)), "std": float(np.std(values))}
+    return results, summary
+
+
+def warm_start_plan(task, frame, report):
+    """
+    Returns (previous model, new years) when the data only gained harvest
+    years since the last recorded run, else (None, reason).
+    """
+    previous_run = (report or {}).get("tasks", {}).get(task.name)
+    if not previous_run:
+        return None, "no previous run in the report"
+    old, new = previous_run.get("year_fingerprints", {}), year_fingerprints(frame)
+    changed = [y for y in old if new.get(y) != old[y]]
+    if changed:
+        return None, f"rows changed for years {changed}"
+    added = sorted(set(new) - set(old))
+    if not added:
+        return None, "no new years"
+    if min(int(y) for y in added) <= max(int(y) for y in old):
+        return None, f"new years {added} are not after the trained ones"
+    previous = task.load_previous()
+    if previous is None:
+        return None, "previous model could not be loaded"
+    return previous, added
+
+
+def train_task(task, args, report):
+    timings = {}
+    start = time.perf_counter()
+    frame = task.load()
+    timings["load"] = time.perf_counter() - start
+    result = {
+        "rows": int(len(frame)),
+        "years": [int(frame["harvest_year"].min()), int(frame["harvest_year"].max())],
+        "year_fingerprints": year_fingerprints(frame),
+        "params": {**XGB_PARAMS, "folds": args.folds, "early_stopping_rounds": args.early_stopping},
+    }
+    print(f"{task.name}: {len(frame)} rows, years {result['years'][0]}-{result['years'][1]}")
+
+    previous, plan = warm_start_plan(task, frame, report) if args.warm_start else (None, "not requested")
+    if previous is not None:
+        # Only new seasons: evaluate the current model on them, then keep boosting.
+        new_rows = frame[frame["harvest_year"].astype(str).isin(plan)]
+        result["mode"] = "warm_start"
+        result["new_years"] = [int(y) for y in plan]
+        result["before_on_new_years"] = regression_metrics(new_rows[TARGET], task.predict(previous, new_rows), new_rows["harvest_area"])
+        start = time.perf_counter()
+        model = task.fit(frame, None, args.warm_rounds, os.cpu_count(), previous=previous)
+        timings["fit"] = time.perf_counter() - start
+        result["after_on_new_years"] = regression_metrics(new_rows[TARGET], task.predict(model, new_rows), new_rows["harvest_area"])
+        print(f"{task.name}: warm start +{args.warm_rounds} rounds for {plan}, "
+              f"new-year rmse {result['before_on_new_years']['rmse']:.2f} before")
+    else:
+        if args.warm_start:
+            print(f"{task.name}: full retrain ({plan})")
+        result["mode"] = "full"
+        start = time.perf_counter()
+        folds, summary = cross_validate(task, frame, args.folds, args.jobs, args.n_estimators, args.early_stopping)
+        timings["cross_validation"] = time.perf_counter() - start
+        result["folds"] = folds
+        result["cv"] = summary
+        n_estimators = int(np.median([f["best_iteration"] for f in folds])) + 1
+        result["n_estimators"] = n_estimators
+        print(f"{task.name}: CV rmse {summary['rmse']['mean']:.2f} +/- {summary['rmse']['std']:.2f}, "
+              f"r2 {summary['r2']['mean']:.3f}, {n_estimators} rounds")
+
+        start = time.perf_counter()
+        model = task.fit(frame, None, n_estimators, os.cpu_count())
+        timings["fit"] = time.perf_counter() - start
+
+    result["train_metrics"] = regression_metrics(frame[TARGET], task.predict(model, frame), frame["harvest_area"])
+    if not args.dry_run:
+        start = time.perf_counter()
+        result["artifacts"] = task.save(model)
+        timings["save"] = time.perf_counter() - start
+    result["timings"] = timings
+    return result
+
+
+def read_report(path=REPORT_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Train the model/ artifacts.")
+    parser.add_argument("--tasks", nargs="*", default=list(TASKS), choices=list(TASKS))
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Folds trained at once")
+    parser.add_argument("--n-estimators", type=int, default=2000, help="Upper bound on boosting rounds")
+    parser.add_argument("--early-stopping", type=int, default=50, help="Rounds without improvement before a fold stops")
+    parser.add_argument("--warm-start", action="store_true", help="Continue the current model when only new years were added")
+    parser.add_argument("--warm-rounds", type=int, default=100)
+    parser.add_argument("--dry-run", action="store_true", help="Train and report without writing artifacts")
+    parser.add_argument("--report", default=REPORT_PATH)
+    parser.add_argument("--version", help="Write a new model version under model/versions instead of model/")
+    args = parser.parse_args()
+
+    tasks = {name: TASKS[name]() for name in args.tasks}
+    if args.version:
+        from core.model_registry import resolve, version_dir
+
+        out_dir = version_dir(args.version)
+        os.makedirs(out_dir, exist_ok=True)
+        for name, task in tasks.items():
+            active = resolve(name)
+            previous_dir = version_dir(active[0]) if active else MODEL_DIR
+            tasks[name] = TASKS[name](model_dir=out_dir, previous_dir=previous_dir)
+        if args.report == REPORT_PATH:
+            args.report = os.path.join(out_dir, "train_report.json")
+        previous_dir = tasks[args.tasks[0]].previous_dir if args.tasks else MODEL_DIR
+        previous_report = read_report(os.path.join(previous_dir, "train_report.json"))
+    else:
+        previous_report = read_report(args.report)
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "argv": sys.argv[1:],
+        "tasks": dict((previous_report or {}).get("tasks", {})),
+    }
+    start = time.perf_counter()
+    for name, task in tasks.items():
+        report["tasks"][name] = train_task(task, args, previous_report)
+    report["seconds"] = time.perf_counter() - start
+
+    def write_report(path):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if not args.dry_run:
+        atomic_write(args.report, write_report)
+    print(f"Done in {report['seconds']:.2f}s")
+
+
+if __name__ == "__main__":
+    main_cli()